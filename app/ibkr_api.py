@@ -1,19 +1,25 @@
 # app/ibkr_api.py
 from __future__ import annotations
-import os, math, logging, json, time
+import os, sys, math, logging, json, time, bisect, heapq, calendar, struct, mmap, queue, threading, zlib, hashlib
+from array import array
 from pathlib import Path
-from fastapi import APIRouter, HTTPException, Body, Query
+from fastapi import APIRouter, HTTPException, Body, Query, Response
 import subprocess, shlex
 import re
 from fastapi.responses import StreamingResponse
-from ib_insync import IB, util, Stock, Forex, Future, Contract, Order, MarketOrder, LimitOrder, BarData # type: ignore
+from ib_insync import IB, util, Stock, Forex, Future, Contract, Order, MarketOrder, LimitOrder, BarData, ExecutionFilter # type: ignore
 from typing import Any, Callable
 import asyncio
-from collections import defaultdict, deque
+import contextvars
+import inspect
+import sqlite3
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
 from fastapi import Request
 from xml.etree import ElementTree as ET
 from typing import Deque
+from types import SimpleNamespace
 
 # Router must be created before any @router.get/post decorators
 router = APIRouter(prefix="/ibkr", tags=["ibkr"])
@@ -56,6 +62,8 @@ def _names_write(d: dict[str, str]) -> None:
         if ks and vs:
             clean[ks] = vs
     _cache_write(PRETTY_NAMES_FILE.name, clean)
+    if _SEARCH_INDEX.built:
+        _SEARCH_INDEX.apply_names(clean)
 
 @router.get("/names")
 async def names_get():
@@ -233,39 +241,6 @@ def _name_prefix_variants(term: str, min_len: int = 3, max_per_word: int = 4) ->
     seen = set()
     return [x for x in out if not (x in seen or seen.add(x))]
 
-def _cache_scan_by_name_substring(term: str, limit: int = 30) -> list[dict]:
-    """
-    Fallback: scan our search cache for rows whose name contains the substring.
-    Helps when IB is sluggish and we’ve previously looked up related names.
-    """
-    tl = (term or "").strip().lower()
-    if not tl:
-        return []
-    cache = _cache_read("search_cache.json", {})
-    if not isinstance(cache, dict):
-        return []
-    out: list[dict] = []
-    seen = set()
-    for rows in cache.values():
-        if not isinstance(rows, list):
-            continue
-        for r in rows:
-            try:
-                name = (r.get("name") or r.get("description") or "").lower()
-                sym  = (r.get("symbol") or "").upper()
-                ex   = (r.get("exchange") or r.get("primaryExchange") or "SMART").upper()
-                key  = (r.get("conId") or f"{sym}-{ex}")
-                if key in seen:
-                    continue
-                if tl and tl in name:
-                    seen.add(key)
-                    out.append(dict(r))
-                    if len(out) >= limit:
-                        return out
-            except Exception:
-                continue
-    return out
-
 # --- quick heuristics so tickers/FX work even when offline -------------------
 _FX3 = {
     "USD","EUR","GBP","JPY","AUD","CAD","CHF","NZD","SEK","NOK","DKK",
@@ -319,7 +294,7 @@ async def _collect_from_matching_symbols(syms, qualify_limit: int = 12) -> list[
     # qualify a few to enrich metadata
     if to_qualify:
         try:
-            qcs = await ib.qualifyContractsAsync(*to_qualify)
+            qcs = await _IB_SCHED.run("details", lambda: ib.qualifyContractsAsync(*to_qualify))
             qmap = {qc.conId: qc for qc in (qcs or []) if getattr(qc, "conId", None)}
             for r in out:
                 cid = r.get("conId")
@@ -371,7 +346,7 @@ async def _enrich_names_with_details(rows: list[dict], maxn: int = 6) -> None:
         return
     for cid in need:
         try:
-            cds = await ib.reqContractDetailsAsync(Contract(conId=int(cid)))
+            cds = await _details_for(Contract(conId=int(cid)))
             if not cds:
                 continue
             cd = cds[0]
@@ -415,18 +390,25 @@ async def _match_batch(
     per_timeout: float = 3.5,
     overall_timeout: float = 6.5,
     max_conc: int = 3,
-    min_results: int = 5
+    min_results: int = 5,
+    on_batch: Callable | None = None,
+    status: dict | None = None,
 ) -> list[dict]:
     """
     Run reqMatchingSymbols over several variants with bounded concurrency and a global timeout.
     Return **early** as soon as we have a minimum number of results, and cancel stragglers.
+    `on_batch` (async) is awaited with each non-empty batch as it completes.
+    `status["answered"]` counts the variants IB actually replied to.
     """
     results: list[dict] = []
     sem = asyncio.Semaphore(max_conc)
     async def one(term: str) -> list[dict]:
         async with sem:
             try:
-                syms = await asyncio.wait_for(ib.reqMatchingSymbolsAsync(term), timeout=per_timeout)
+                syms = await asyncio.wait_for(
+                    _IB_SCHED.run("match", lambda: ib.reqMatchingSymbolsAsync(term)), timeout=per_timeout)
+                if status is not None:
+                    status["answered"] = status.get("answered", 0) + 1
                 return await _collect_from_matching_symbols(syms, qualify_limit=6)
             except Exception:
                 return []
@@ -439,6 +421,8 @@ async def _match_batch(
                 batch = await fut
                 if batch:
                     results.extend(batch)
+                    if on_batch is not None:
+                        await on_batch(batch)
                     if len(results) >= min_results:
                         # We got enough results; cancel any stragglers early to
                         # respect the time budget.
@@ -527,36 +511,399 @@ def _heuristic_seed(term: str) -> list[dict]:
         })
     return out
 
-def _local_match(term: str, limit: int = 50) -> list[dict]:
-    tl = (term or "").strip().lower()
-    if not tl:
-        return []
-    candidates = _universe()
-    vars = _alias_variants(term)
-    out: list[dict] = []
-    seen = set()
-    for v in vars:
-        vl = v.lower()
-        for r in candidates:
-            sym = (r.get("symbol") or "").upper()
-            name = (r.get("name") or r.get("description") or "")
-            key = (sym, r.get("exchange") or "SMART")
-            if key in seen: 
+# ----- in-memory search index (symbol trie + name tokens + trigrams) ---------
+_TOKEN_RE = re.compile(r"[A-Za-z0-9]+")
+
+def _trigrams(s: str) -> frozenset[str]:
+    t = " " + " ".join(_TOKEN_RE.findall((s or "").lower())) + " "
+    if len(t) < 3:
+        return frozenset()
+    return frozenset(t[i:i + 3] for i in range(len(t) - 2))
+
+class _SearchIndex:
+    """
+    Local instrument index so the offline part of /search never scans.
+      - symbol prefix trie (upper-case symbols)
+      - name-token inverted index + sorted token list for prefix ranges
+      - trigram postings for fuzzy ranking when exact/prefix matching runs dry
+    Rows are keyed by conId when known, else (SYMBOL, EXCHANGE) — the same
+    rule /search uses to de-dup, so IB rows replace offline seeds in place.
+    """
+    TOKEN_CAP = 500    # max postings unioned for a single token prefix
+    FUZZY_CAP = 1000   # max candidates scored by trigram similarity
+    FUZZY_MIN = 0.6    # share of the query's trigrams a fuzzy hit must contain
+
+    def __init__(self):
+        self.rows: dict[Any, dict] = {}
+        self.built = False
+        self._trie: dict = {}
+        self._tokens: dict[str, set] = defaultdict(set)
+        self._token_list: list[str] = []
+        self._grams: dict[str, set] = defaultdict(set)
+        self._gram_of: dict[Any, frozenset[str]] = {}
+        self._tok_of: dict[Any, tuple[str, ...]] = {}
+        self._by_sym_ex: dict[tuple[str, str], Any] = {}
+        self._bulk = False
+
+    @staticmethod
+    def _sym_ex(r: dict) -> tuple[str, str]:
+        return (str(r.get("symbol") or "").upper(),
+                str(r.get("exchange") or r.get("primaryExchange") or "SMART").upper())
+
+    # -- maintenance --
+    def add(self, r: dict) -> None:
+        if not isinstance(r, dict):
+            return
+        sym, ex = self._sym_ex(r)
+        if not sym:
+            return
+        cid = r.get("conId")
+        try:
+            cid = int(cid) if cid else None
+        except Exception:
+            cid = None
+        prev = self._by_sym_ex.get((sym, ex))
+        if cid:
+            key: Any = cid
+            # upgrade an offline seed for the same symbol/exchange
+            if prev is not None and not isinstance(prev, int):
+                self._remove(prev)
+        else:
+            if isinstance(prev, int):
+                return  # never downgrade an IB-backed row
+            key = (sym, ex)
+        old = self.rows.get(key)
+        row = dict(old or {})
+        for k, v in r.items():
+            if v not in (None, ""):
+                row[k] = v
+        row["symbol"] = sym
+        name = str(row.get("name") or row.get("description") or "")
+        if old is not None and old.get("name") and (not r.get("name") or str(r.get("name")).upper() == sym):
+            name = old["name"]  # keep a good name over a weak one
+        row["name"] = name or sym
+        if old is not None:
+            if old.get("name") == row["name"] and self._sym_ex(old) == self._sym_ex(row):
+                self.rows[key] = row
+                return
+            self._remove(key)
+        self.rows[key] = row
+        self._by_sym_ex[(sym, ex)] = key
+        self._trie_add(sym, key)
+        toks = tuple(sorted({t.lower() for t in _TOKEN_RE.findall(row["name"])}))
+        self._tok_of[key] = toks
+        for t in toks:
+            if t not in self._tokens:
+                if self._bulk:
+                    self._token_list.append(t)
+                else:
+                    bisect.insort(self._token_list, t)
+            self._tokens[t].add(key)
+        grams = _trigrams(f"{sym} {row['name']}")
+        self._gram_of[key] = grams
+        for g in grams:
+            self._grams[g].add(key)
+
+    def add_many(self, rows) -> None:
+        for r in rows or []:
+            try:
+                self.add(r)
+            except Exception:
                 continue
-            if sym == v.upper() or vl in name.lower():
-                out.append({
-                    "symbol": sym,
-                    "name": name or sym,
-                    "secType": r.get("secType") or "STK",
-                    "conId": r.get("conId"),  # may be None offline
-                    "currency": r.get("currency") or "USD",
-                    "exchange": r.get("exchange") or "SMART",
-                    "primaryExchange": r.get("primaryExchange"),
-                })
-                seen.add(key)
-                if len(out) >= limit:
-                    return out
-    return out
+
+    def apply_names(self, names: dict[str, str]) -> None:
+        """Fold pretty_names.json (CID:/SYM: keys) into indexed rows."""
+        for k, v in (names or {}).items():
+            if not v:
+                continue
+            if k.startswith("CID:"):
+                try:
+                    cid = int(k[4:])
+                except Exception:
+                    continue
+                r = self.rows.get(cid)
+                if r and r.get("name") != v:
+                    self.add({**r, "name": v})
+            elif k.startswith("SYM:"):
+                sym = k[4:].upper()
+                hits = list(self._trie_exact(sym))
+                if not hits:
+                    self.add({"symbol": sym, "name": v, "secType": "STK"})
+                for key in hits:
+                    r = self.rows.get(key)
+                    if r and (r.get("name") or "").upper() in ("", sym):
+                        self.add({**r, "name": v})
+
+    def _remove(self, key) -> None:
+        r = self.rows.pop(key, None)
+        if r is None:
+            return
+        se = self._sym_ex(r)
+        if self._by_sym_ex.get(se) == key:
+            self._by_sym_ex.pop(se, None)
+        node = self._trie
+        for ch in se[0]:
+            node = node.get(ch)
+            if node is None:
+                break
+        else:
+            node.get(None, set()).discard(key)
+        for t in self._tok_of.pop(key, ()):
+            self._tokens.get(t, set()).discard(key)
+        for g in self._gram_of.pop(key, ()):
+            self._grams.get(g, set()).discard(key)
+
+    def _trie_add(self, sym: str, key) -> None:
+        node = self._trie
+        for ch in sym:
+            node = node.setdefault(ch, {})
+        node.setdefault(None, set()).add(key)
+
+    # -- lookups --
+    def _trie_node(self, prefix: str) -> dict | None:
+        node = self._trie
+        for ch in prefix:
+            node = node.get(ch)
+            if node is None:
+                return None
+        return node
+
+    def _trie_exact(self, sym: str) -> set:
+        node = self._trie_node(sym)
+        return set(node.get(None, ())) if node else set()
+
+    def _trie_prefix(self, prefix: str, limit: int) -> list:
+        """Breadth-first so shorter symbols (closer matches) come first."""
+        node = self._trie_node(prefix)
+        if node is None:
+            return []
+        out: list = []
+        level = [node]
+        while level and len(out) < limit:
+            nxt = []
+            for n in level:
+                out.extend(n.get(None, ()))
+                nxt.extend(v for k, v in n.items() if k is not None)
+            level = nxt
+        return out[:limit]
+
+    def _token_prefix(self, tok: str) -> set:
+        if len(tok) < 2:
+            return set(self._tokens.get(tok, ()))
+        out: set = set()
+        i = bisect.bisect_left(self._token_list, tok)
+        while i < len(self._token_list) and self._token_list[i].startswith(tok):
+            out |= self._tokens.get(self._token_list[i], set())
+            if len(out) >= self.TOKEN_CAP:
+                break
+            i += 1
+        return out
+
+    def _fuzzy(self, term: str, limit: int) -> dict[Any, float]:
+        qg = _trigrams(term)
+        if not qg:
+            return {}
+        # seed candidates from the rarest grams only, then score exactly
+        rare = sorted(qg, key=lambda g: len(self._grams.get(g, ())))[:3]
+        cand: set = set()
+        for g in rare:
+            cand |= self._grams.get(g, set())
+            if len(cand) >= self.FUZZY_CAP:
+                break
+        # containment (not dice) so a short typeahead term still matches a long name
+        out: dict[Any, float] = {}
+        n = float(len(qg))
+        for k in cand:
+            sim = len(qg & (self._gram_of.get(k) or frozenset())) / n
+            if sim >= self.FUZZY_MIN:
+                out[k] = sim
+        return dict(heapq.nlargest(limit, out.items(), key=lambda kv: kv[1]))
+
+    def query(self, term: str, limit: int = 50) -> list[dict]:
+        if not (term or "").strip():
+            return []
+        scores: dict[Any, float] = {}
+        def hit(k, s: float):
+            if s > scores.get(k, -1.0):
+                scores[k] = s
+        for i, v in enumerate(_alias_variants(term)):
+            pen = 0.0 if i == 0 else 0.05  # alias/token variants rank just behind the literal term
+            vu = v.strip().upper()
+            for k in self._trie_exact(vu):
+                hit(k, 4.0 - pen)
+            for k in self._trie_prefix(vu, limit):
+                hit(k, 3.0 - pen)
+            toks = [t.lower() for t in _TOKEN_RE.findall(v)]
+            keys: set | None = None
+            for t in toks:
+                ks = self._token_prefix(t)
+                keys = ks if keys is None else keys & ks
+                if not keys:
+                    break
+            for k in keys or ():
+                hit(k, 2.0 - pen)
+        if len(scores) < limit:
+            for k, d in self._fuzzy(term, limit).items():
+                hit(k, d)  # similarity <= 1.0 keeps fuzzy hits below exact/prefix
+        ranked = heapq.nsmallest(limit, scores.items(), key=lambda kv: (
+            -kv[1], 0 if isinstance(kv[0], int) else 1, len(str(self.rows[kv[0]].get("name") or ""))))
+        out: list[dict] = []
+        for k, _ in ranked:
+            r = self.rows[k]
+            out.append({
+                "symbol": r.get("symbol"),
+                "name": r.get("name") or r.get("symbol"),
+                "secType": r.get("secType") or "STK",
+                "conId": r.get("conId"),  # may be None offline
+                "currency": r.get("currency") or ("USD" if not r.get("conId") else None),
+                "exchange": r.get("exchange") or ("SMART" if not r.get("conId") else None),
+                "primaryExchange": r.get("primaryExchange"),
+            })
+        return out
+
+    def build(self) -> None:
+        self._bulk = True  # append tokens unsorted, sort once at the end
+        try:
+            self.add_many(_universe())
+            self.add_many(_SEARCH_STORE.instruments())
+        finally:
+            self._bulk = False
+            self._token_list.sort()
+        self.apply_names(_names_read())
+        self.built = True
+
+_SEARCH_INDEX = _SearchIndex()
+
+def _search_index() -> _SearchIndex:
+    if not _SEARCH_INDEX.built:
+        _SEARCH_INDEX.build()
+    return _SEARCH_INDEX
+
+# ----- normalized search-result store (instruments + term postings) ---------
+# Replaces the old search_cache.json, which duplicated the full result list
+# under every alias/symbol/token key and was rewritten on every search.
+SEARCH_DB = CACHE_DIR / "search.db"
+SEARCH_TTL = float(os.getenv("IB_SEARCH_TTL", str(3 * 86400)))      # positive term entries
+SEARCH_NEG_TTL = float(os.getenv("IB_SEARCH_NEG_TTL", "900"))        # "IB had nothing" entries
+
+def _sqlite(path: Path) -> sqlite3.Connection:
+    con = sqlite3.connect(str(path), timeout=5.0, check_same_thread=False, isolation_level=None)
+    try:
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+    except Exception:
+        pass
+    return con
+
+class _SearchStore:
+    """
+    instruments(conId PK, row JSON, ts)   one row per instrument, upserted
+    terms(term PK, ts, hits)              hits == 0 is a negative-cache entry
+    postings(term, conId, rank)           term -> ordered conIds
+    A search writes only its own term and result rows: O(results) I/O.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self._con: sqlite3.Connection | None = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._con is not None:
+            return self._con
+        fresh = not self.path.exists()
+        con = _sqlite(self.path)
+        con.executescript("""
+            CREATE TABLE IF NOT EXISTS instruments(conId INTEGER PRIMARY KEY, row TEXT NOT NULL, ts REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS terms(term TEXT PRIMARY KEY, ts REAL NOT NULL, hits INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS postings(term TEXT NOT NULL, conId INTEGER NOT NULL, rank INTEGER NOT NULL,
+                                                PRIMARY KEY(term, conId));
+        """)
+        self._con = con
+        if fresh:
+            self._migrate_legacy()
+        return con
+
+    def _migrate_legacy(self) -> None:
+        """One-time import of instrument rows from the old search_cache.json."""
+        legacy = _cache_path("search_cache.json")
+        if not legacy.exists():
+            return
+        try:
+            cache = _cache_read(legacy.name, {})
+            rows = {}
+            for lst in (cache.values() if isinstance(cache, dict) else []):
+                for r in (lst if isinstance(lst, list) else []):
+                    if isinstance(r, dict) and r.get("conId"):
+                        rows[int(r["conId"])] = r
+            self._upsert_rows(list(rows.values()), 0.0)
+            legacy.replace(legacy.with_suffix(".json.migrated"))
+        except Exception:
+            log.exception("search store: legacy cache migration failed")
+
+    @staticmethod
+    def _norm(term: str) -> str:
+        return " ".join((term or "").lower().split())[:200]
+
+    def _upsert_rows(self, rows: list[dict], now: float) -> None:
+        self._db().executemany(
+            "INSERT INTO instruments(conId,row,ts) VALUES(?,?,?) "
+            "ON CONFLICT(conId) DO UPDATE SET row=excluded.row, ts=excluded.ts",
+            [(int(r["conId"]), json.dumps(r, separators=(",", ":")), now) for r in rows],
+        )
+
+    def lookup(self, term: str) -> tuple[str, list[dict]]:
+        """Return (state, rows); state is 'miss' | 'fresh' | 'stale' | 'negative'."""
+        try:
+            db = self._db()
+            t = self._norm(term)
+            hit = db.execute("SELECT ts, hits FROM terms WHERE term=?", (t,)).fetchone()
+            if not hit:
+                return "miss", []
+            ts, hits = hit
+            age = time.time() - float(ts)
+            if not hits:
+                return ("negative" if age < SEARCH_NEG_TTL else "miss"), []
+            rows = [json.loads(x) for (x,) in db.execute(
+                "SELECT i.row FROM postings p JOIN instruments i ON i.conId = p.conId "
+                "WHERE p.term=? ORDER BY p.rank", (t,))]
+            return ("fresh" if age < SEARCH_TTL else "stale"), rows
+        except Exception:
+            log.exception("search store lookup failed")
+            return "miss", []
+
+    def put(self, term: str, rows: list[dict]) -> None:
+        """Record IB results for a term; an empty list records a negative entry."""
+        try:
+            db = self._db()
+            t = self._norm(term)
+            now = time.time()
+            rows = [r for r in rows if r.get("conId")]
+            db.execute("BEGIN")
+            try:
+                self._upsert_rows(rows, now)
+                db.execute("DELETE FROM postings WHERE term=?", (t,))
+                db.executemany("INSERT OR IGNORE INTO postings(term,conId,rank) VALUES(?,?,?)",
+                               [(t, int(r["conId"]), i) for i, r in enumerate(rows)])
+                db.execute("INSERT INTO terms(term,ts,hits) VALUES(?,?,?) "
+                           "ON CONFLICT(term) DO UPDATE SET ts=excluded.ts, hits=excluded.hits",
+                           (t, now, len(rows)))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        except Exception:
+            log.exception("search store write failed")
+
+    def instruments(self) -> list[dict]:
+        try:
+            return [json.loads(x) for (x,) in self._db().execute("SELECT row FROM instruments")]
+        except Exception:
+            return []
+
+_SEARCH_STORE = _SearchStore(SEARCH_DB)
+
+def _local_match(term: str, limit: int = 50) -> list[dict]:
+    """Universe + previously seen IB rows + pretty names, via the in-memory index."""
+    return _search_index().query(term, limit=limit)
 
 # ---------- order streaming state ----------
 ORD_QUEUE: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=1000)
@@ -657,7 +1004,8 @@ async def _ensure_connected():
             pass
         try:
             # prime symbol matcher so first real call is faster
-            await asyncio.wait_for(ib.reqMatchingSymbolsAsync("AAPL"), timeout=1.2)
+            await asyncio.wait_for(
+                _IB_SCHED.run("match", lambda: ib.reqMatchingSymbolsAsync("AAPL"), prio=PRIO_BG), timeout=1.2)
         except Exception:
             pass
     except Exception as e:
@@ -843,30 +1191,43 @@ async def _bg_refresh_loop():
     """
     Periodically refresh essential caches so UI stays hot even if user never visits a page.
     """
+    _IB_PRIO.set(PRIO_BG)  # warmers queue behind UI requests and orders
     while True:
+        try: await _flex_refresh()   # local files; works offline too
+        except Exception: pass
         try:
             await _ensure_connected()
-            # Touch hot endpoints; each writes its own cache on success.
-            try: await accounts()
+            # Positions/accounts/orders are event driven (_MIRROR); just keep it seeded.
+            try: await _MIRROR.ensure()
             except Exception: pass
-            try: await positions()
-            except Exception: pass
-            try: await orders_open()
+            try: await _EXEC.ensure()
             except Exception: pass
             try: await pnl_summary()
             except Exception: pass
+            _PNL.sweep()
+            _MKT.sweep()
         except Exception:
             # if completely offline, just sleep and retry
             pass
         await asyncio.sleep(15)  # tune as needed
 
 async def start_background_refresh():
-    global _BG_TASK
+    global _BG_TASK, _NAV_TASK
     if _BG_TASK and not _BG_TASK.done():
         return
+    try:
+        _search_index()  # build the local search index before first /search
+    except Exception:
+        log.exception("search index build failed")
+    try:
+        _backfill_resume()
+    except Exception:
+        log.exception("backfill resume failed")
     try:
         loop = asyncio.get_running_loop()
         _BG_TASK = loop.create_task(_bg_refresh_loop())
+        if _NAV_TASK is None or _NAV_TASK.done():
+            _NAV_TASK = loop.create_task(_nav_loop())
     except RuntimeError:
         # No loop yet; let caller attach via FastAPI startup
         pass
@@ -881,22 +1242,244 @@ def _num_or_none(x):
     except Exception:
         return None
 
-@router.get("/accounts")
-async def accounts():
-    try:
+# ---------- account mirror ----------
+def _position_row(p) -> dict:
+    c = p.contract
+    return {
+        "account": p.account,
+        "symbol": getattr(c, "localSymbol", None) or getattr(c, "symbol", None) or str(getattr(c, "conId", "")),
+        "secType": getattr(c, "secType", None),
+        "currency": getattr(c, "currency", None),
+        "exchange": getattr(c, "primaryExchange", None) or getattr(c, "exchange", None),
+        "conId": _safe_get(c, "conId"),
+        "position": _num_or_none(p.position),
+        "avgCost": _num_or_none(p.avgCost),
+    }
+
+def _open_order_row(t) -> dict:
+    c = t.contract
+    o = t.order
+    st = t.orderStatus
+    return {
+        "orderId": o.orderId,
+        "permId": o.permId,
+        "symbol": getattr(c, "localSymbol", None) or c.symbol,
+        "conId": getattr(c, "conId", None),
+        "secType": c.secType,
+        "action": o.action,
+        "type": o.orderType,
+        "lmt": getattr(o, "lmtPrice", None),
+        "tif": o.tif,
+        "qty": o.totalQuantity,
+        "status": st.status,
+        "filled": st.filled,
+        "remaining": st.remaining,
+    }
+
+class _AccountMirror:
+    """
+    Live in-memory copy of positions, account summary/values and open orders,
+    seeded once per connection and then kept current by ib_insync events.
+    Every change bumps `version`. The JSON caches are written behind (debounced)
+    and are only read on a cold start while IB is unreachable.
+    """
+    DONE = {"Filled", "Cancelled", "ApiCancelled"}
+    CACHE_DELAY = 2.0
+    CACHE_FILES = {"positions": "positions.json", "accounts": "accounts.json", "orders": "orders_open.json"}
+
+    def __init__(self):
+        self.version = 0
+        self.versions = dict.fromkeys(self.CACHE_FILES, 0)
+        self.updated = 0.0
+        self.positions: dict[tuple[str, int], dict] = {}   # (account, conId) -> row
+        self.summary: dict[str, dict] = {}                  # account -> {tag: value}
+        self.values: dict[str, dict] = {}                   # account -> {tag: {currency: value}}
+        self.orders: dict[Any, dict] = {}                   # order key -> row
+        self.seeded = False        # state came from IB at least once in this process
+        self.live = False          # ... and the connection it came from is still up
+        self._seeding: asyncio.Task | None = None
+        self._dirty: set[str] = set()
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self.on_change: list[Callable[[str], None]] = []
+
+    # ---- bookkeeping ----
+    def _touch(self, section: str) -> None:
+        self.version += 1
+        self.versions[section] += 1
+        self.updated = time.time()
+        self._dirty.add(section)
+        for cb in list(self.on_change):
+            try: cb(section)
+            except Exception: pass
+        if self._flush_handle is None:
+            try:
+                self._flush_handle = asyncio.get_running_loop().call_later(self.CACHE_DELAY, self._flush)
+            except RuntimeError:
+                self._flush()
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        dirty, self._dirty = self._dirty, set()
+        for section in dirty:
+            _cache_write(self.CACHE_FILES[section], self.view(section))
+
+    def view(self, section: str):
+        if section == "positions":
+            return list(self.positions.values())
+        if section == "accounts":
+            return {a: dict(v) for a, v in self.summary.items()}
+        return list(self.orders.values())
+
+    @staticmethod
+    def _order_key(t):
+        o = t.order
+        oid = getattr(o, "orderId", 0) or 0
+        return (getattr(o, "clientId", 0), oid) if oid > 0 else getattr(o, "permId", 0)
+
+    # ---- event handlers ----
+    def on_position(self, p) -> None:
+        try:
+            key = (p.account, int(p.contract.conId))
+            if p.position:
+                self.positions[key] = _position_row(p)
+            elif self.positions.pop(key, None) is None:
+                return
+            self._touch("positions")
+        except Exception:
+            pass
+
+    def on_summary(self, v) -> None:
+        try:
+            acct = self.summary.setdefault(v.account, {})
+            if acct.get(v.tag) == v.value:
+                return
+            acct[v.tag] = v.value
+            self._touch("accounts")
+        except Exception:
+            pass
+
+    def on_value(self, v) -> None:
+        try:
+            self.values.setdefault(v.account, {}).setdefault(v.tag, {})[v.currency or ""] = v.value
+            self.version += 1
+            self.updated = time.time()
+        except Exception:
+            pass
+
+    def on_order(self, t) -> None:
+        try:
+            key = self._order_key(t)
+            if getattr(t.orderStatus, "status", None) in self.DONE:
+                if self.orders.pop(key, None) is None:
+                    return
+            else:
+                self.orders[key] = _open_order_row(t)
+            self._touch("orders")
+        except Exception:
+            pass
+
+    def on_connected(self) -> None:
+        if self._seeding is not None and not self._seeding.done():
+            return
+        try:
+            self._seeding = asyncio.get_running_loop().create_task(self.seed())
+        except RuntimeError:
+            pass
+
+    def on_disconnected(self) -> None:
+        self.live = False
+
+    # ---- seeding ----
+    async def seed(self) -> None:
+        """Replace state with a fresh snapshot; subscriptions stay open so events keep it current."""
         await _ensure_connected()
-        rows = await ib.accountSummaryAsync()
-        out = {}
-        for r in rows:
-            acct = r.account
-            out.setdefault(acct, {})[r.tag] = r.value
-        _cache_write("accounts.json", out)
-        return out
+        if hasattr(ib, "reqPositionsAsync"):
+            pos = await ib.reqPositionsAsync()     # no cancelPositions: positionEvent carries updates
+        else:
+            pos = list(ib.positions())
+        rows = await ib.accountSummaryAsync()     # subscribes once; accountSummaryEvent afterwards
+        self.positions = {}
+        for p in pos or []:
+            if p.position:
+                try: self.positions[(p.account, int(p.contract.conId))] = _position_row(p)
+                except Exception: pass
+        self.summary = {}
+        for r in rows or []:
+            self.summary.setdefault(r.account, {})[r.tag] = r.value
+        self.values = {}
+        for v in ib.accountValues():
+            self.on_value(v)
+        self.orders = {}
+        for t in ib.openTrades():
+            try: self.orders[self._order_key(t)] = _open_order_row(t)
+            except Exception: pass
+        self.seeded = self.live = True
+        for section in self.CACHE_FILES:
+            self._touch(section)
+
+    async def ensure(self) -> None:
+        """Make sure state is live; raise only if it has never been seeded."""
+        if self.live and ib.isConnected():
+            return
+        try:
+            await _ensure_connected()
+            if self._seeding is None or self._seeding.done():
+                self._seeding = asyncio.get_running_loop().create_task(self.seed())
+            await asyncio.shield(self._seeding)
+        except Exception:
+            if not self.seeded:
+                raise
+
+    def status(self) -> dict:
+        return {
+            "version": self.version,
+            "updated": self.updated or None,
+            "live": bool(self.live and ib.isConnected()),
+            "seeded": self.seeded,
+            "sections": {s: {"version": self.versions[s], "count": len(self.view(s))} for s in self.CACHE_FILES},
+        }
+
+_MIRROR = _AccountMirror()
+ib.positionEvent += _MIRROR.on_position
+ib.accountSummaryEvent += _MIRROR.on_summary
+ib.accountValueEvent += _MIRROR.on_value
+ib.openOrderEvent += _MIRROR.on_order
+ib.orderStatusEvent += _MIRROR.on_order
+ib.newOrderEvent += _MIRROR.on_order
+ib.connectedEvent += _MIRROR.on_connected
+ib.disconnectedEvent += _MIRROR.on_disconnected
+
+async def _mirror_read(section: str, response: Response | None, what: str):
+    """Serve a mirror section; fall back to the disk cache only if the mirror was never seeded."""
+    try:
+        await _MIRROR.ensure()
     except Exception as e:
-        cached = _cache_read("accounts.json", None)
+        cached = _cache_read(_AccountMirror.CACHE_FILES[section], None)
         if cached is not None:
+            if response is not None:
+                response.headers["X-State-Source"] = "cache"
             return cached
-        raise HTTPException(503, f"IBKR offline and no account cache: {e}")
+        raise HTTPException(503, f"IBKR offline and no {what} cache: {e}")
+    if response is not None:
+        response.headers["X-State-Version"] = str(_MIRROR.version)
+        if not _MIRROR.live:
+            response.headers["X-State-Source"] = "stale"
+    return _MIRROR.view(section)
+
+@router.get("/state")
+async def state_status():
+    """Account mirror version/freshness; clients can poll this and refetch only on change."""
+    return _MIRROR.status()
+
+@router.get("/accounts")
+async def accounts(response: Response = None):
+    return await _mirror_read("accounts", response, "account")
+
+@router.get("/accounts/values")
+async def accounts_values(response: Response = None):
+    """Per-account values from the account updates stream: {account: {tag: {currency: value}}}."""
+    await _mirror_read("accounts", response, "account")
+    return _MIRROR.values
     
 # ---------- NEWS: providers, subscribe, SSE ---------------------------------
 @router.get("/news/providers")
@@ -1122,154 +1705,1238 @@ async def news_stream():
     return StreamingResponse(_gen(), media_type="text/event-stream")
 
 @router.get("/positions")
-async def positions():
+async def positions(response: Response = None):
+    return await _mirror_read("positions", response, "positions")
+    
+# ---------- pacing-aware request scheduler ----------
+# Every outbound IB request takes a token from its class bucket (if any) and
+# from the global message bucket. Waiters are served by priority lane, so
+# orders/cancels always go ahead of UI reads, which go ahead of the warmers.
+PRIO_ORDER, PRIO_UI, PRIO_BG = 0, 1, 2
+_PRIO_NAMES = {PRIO_ORDER: "order", PRIO_UI: "ui", PRIO_BG: "bg"}
+# Background loops set this once; nested helpers inherit it via the task context.
+_IB_PRIO: contextvars.ContextVar[int] = contextvars.ContextVar("ib_prio", default=PRIO_UI)
+# Set inside a shared (singleflight) call: {"prio", "waits"}; a more urgent
+# caller joining the call raises "prio" and promotes the queued waits.
+_IB_BOOST: contextvars.ContextVar[dict | None] = contextvars.ContextVar("ib_boost", default=None)
+
+def _pace_env(name: str, rate: float, burst: int) -> tuple[float, int]:
+    """IB_PACE_<NAME>="rate/burst", e.g. IB_PACE_HIST="1/10"."""
+    raw = os.getenv(f"IB_PACE_{name.upper()}", "").strip()
     try:
-        await _ensure_connected()
+        if raw:
+            r, b = raw.split("/", 1)
+            return max(0.01, float(r)), max(1, int(b))
+    except Exception:
+        pass
+    return rate, burst
+
+class _Bucket:
+    """Token bucket with a priority wait queue and an adaptive backoff window."""
+    def __init__(self, name: str, rate: float, burst: int):
+        self.name = name
+        self.rate, self.burst = _pace_env(name, rate, burst)
+        self.tokens = float(self.burst)
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0
+        self.backoff = 0.0
+        self.granted = 0
+        self.violations = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._timer: asyncio.TimerHandle | None = None
+
+    def _try_take(self) -> bool:
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return False
+        self.tokens = min(float(self.burst), self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            self.granted += 1
+            return True
+        return False
+
+    async def acquire(self, prio: int, boost: dict | None = None) -> None:
+        if not self._waiters and self._try_take():
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (prio, self._seq, fut))
+        self._arm()
+        if boost is not None:
+            boost["waits"].add((self, fut))
         try:
-            if hasattr(ib, "reqPositionsAsync"):
-                pos = await ib.reqPositionsAsync()
-            else:
-                ib.reqPositions()
-                await asyncio.sleep(1.0)
-                pos = list(ib.positions())
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.tokens += 1.0  # granted right as the caller went away
+            raise
         finally:
-            try: ib.cancelPositions()
-            except Exception: pass
-        out = []
-        for p in (pos or []):
-            try:
-                c = p.contract
-                symbol   = getattr(c, "localSymbol", None) or getattr(c, "symbol", None) or str(getattr(c, "conId", ""))
-                secType  = getattr(c, "secType", None)
-                currency = getattr(c, "currency", None)
-                exchange = getattr(c, "primaryExchange", None) or getattr(c, "exchange", None)
-                out.append({
-                    "account": p.account,
-                    "symbol": symbol,
-                    "secType": secType,
-                    "currency": currency,
-                    "exchange": exchange,
-                    "conId": _safe_get(c, "conId"),
-                    "position": _num_or_none(p.position),
-                    "avgCost": _num_or_none(p.avgCost),
-                })
-            except Exception:
+            if boost is not None:
+                boost["waits"].discard((self, fut))
+
+    def promote(self, fut: asyncio.Future, prio: int) -> None:
+        """Queue a waiter again at a more urgent lane; the stale entry is skipped once fut is done."""
+        if not fut.done():
+            self._seq += 1
+            heapq.heappush(self._waiters, (prio, self._seq, fut))
+
+    def _arm(self) -> None:
+        if self._timer is not None or not self._waiters:
+            return
+        now = time.monotonic()
+        wait = max(self.blocked_until - now, (1.0 - self.tokens) / self.rate if self.tokens < 1.0 else 0.0, 0.0)
+        self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+
+    def _dispatch(self) -> None:
+        self._timer = None
+        while self._waiters:
+            fut = self._waiters[0][2]
+            if fut.done():  # caller cancelled/timed out while queued
+                heapq.heappop(self._waiters)
                 continue
-        _cache_write("positions.json", out)
+            if not self._try_take():
+                break
+            heapq.heappop(self._waiters)
+            fut.set_result(None)
+        self._arm()
+
+    def penalize(self) -> None:
+        """IB reported a pacing violation: drain and block with exponential backoff."""
+        self.violations += 1
+        self.backoff = min(max(self.backoff * 2.0, 2.0), 120.0)
+        self.blocked_until = time.monotonic() + self.backoff
+        self.tokens = 0.0
+        log.warning("IB pacing violation on '%s'; backing off %.0fs", self.name, self.backoff)
+
+    def relax(self) -> None:
+        if self.backoff and time.monotonic() > self.blocked_until + self.backoff:
+            self.backoff = self.backoff / 2.0 if self.backoff > 2.0 else 0.0
+
+    def metrics(self) -> dict:
+        queued = {v: 0 for v in _PRIO_NAMES.values()}
+        seen: set[int] = set()
+        for prio, _, fut in sorted(self._waiters):
+            if not fut.done() and id(fut) not in seen:
+                seen.add(id(fut))
+                queued[_PRIO_NAMES.get(prio, str(prio))] += 1
+        return {
+            "rate": self.rate, "burst": self.burst, "tokens": round(self.tokens, 2),
+            "queued": queued, "granted": self.granted, "violations": self.violations,
+            "backoff": self.backoff, "blockedFor": round(max(0.0, self.blocked_until - time.monotonic()), 2),
+        }
+
+class _IBScheduler:
+    def __init__(self):
+        # ~50 msgs/sec is the API-wide cap; historical pacing is hard for bars
+        # under 30 secs (60 / 10 min) and soft for larger bars.
+        self.msg = _Bucket("msg", 40.0, 40)
+        self.buckets: dict[str, _Bucket] = {
+            "hist": _Bucket("hist", 1.0, 10),
+            "hist_small": _Bucket("hist_small", 0.1, 6),
+            "details": _Bucket("details", 10.0, 20),
+            "match": _Bucket("match", 1.0, 2),
+            "fund": _Bucket("fund", 1.0, 3),
+        }
+        self.inflight: dict[str, int] = defaultdict(int)
+
+    async def run(self, cls: str, fn: Callable, prio: int | None = None):
+        prio = _IB_PRIO.get() if prio is None else prio
+        boost = _IB_BOOST.get()
+        if boost is not None:
+            prio = min(prio, boost["prio"])
+        b = self.buckets.get(cls)
+        if b is not None:
+            await b.acquire(prio, boost)
+            if boost is not None:
+                prio = min(prio, boost["prio"])  # a more urgent caller may have joined meanwhile
+        await self.msg.acquire(prio, boost)
+        self.inflight[cls] += 1
+        try:
+            res = fn()
+            if inspect.isawaitable(res):
+                res = await res
+            if b is not None:
+                b.relax()
+            return res
+        finally:
+            self.inflight[cls] -= 1
+
+    def metrics(self) -> dict:
+        out = {name: {**b.metrics(), "inflight": self.inflight.get(name, 0)} for name, b in self.buckets.items()}
+        out["msg"] = {**self.msg.metrics(), "inflight": sum(self.inflight.values())}
         return out
-    except Exception as e:
-        cached = _cache_read("positions.json", None)
-        if cached is not None:
-            return cached
-        raise HTTPException(503, f"IBKR offline and no positions cache: {e}")
-    
-# ---------- helpers ----------
-async def _resolve_contract(
-    symbol: str,
-    secType: str = "STK",
-    exchange: str = "SMART",
-    currency: str = "USD",
-    expiry: str | None = None,
-):
-    """Resolve to a unique Contract using reqContractDetails."""
-    await _ensure_connected()
-    base: Contract
-    st = secType.upper()
-    if st == "STK":
-        base = Stock(symbol, exchange, currency)
-    elif st == "FX" or st == "CASH":
-        base = Forex(symbol)  # e.g. "EURUSD"
-    elif st == "FUT":
-        base = Future(symbol, lastTradeDateOrContractMonth=expiry or "", exchange=exchange, currency=currency)
-    else:
-        base = Contract(secType=st, symbol=symbol, exchange=exchange, currency=currency)
-    cds = await ib.reqContractDetailsAsync(base)
-    if not cds:
-        raise HTTPException(404, detail=f"No contract for {symbol}/{secType}")
-    # Prefer SMART/primaryExchange when present
-    c = cds[0].contract
-    return c
 
-def _contract_json(c: Contract) -> dict:
-    return {
-        "conId": c.conId,
-        "symbol": c.symbol,
-        "localSymbol": getattr(c, "localSymbol", None),
-        "secType": c.secType,
-        "currency": c.currency,
-        "exchange": c.exchange,
-        "primaryExchange": getattr(c, "primaryExchange", None),
-        "lastTradeDateOrContractMonth": getattr(c, "lastTradeDateOrContractMonth", None),
-    }
+_IB_SCHED = _IBScheduler()
 
-async def _contract_from_conid(cid: int) -> Contract:
-    await _ensure_connected()
-    c = Contract(conId=int(cid))
-    try:
-        [qc] = await ib.qualifyContractsAsync(c)
-        return qc
-    except Exception:
-        return c
+def _hist_class(barSize: str) -> str:
+    """Bars of 30 secs or less fall under IB's hard historical pacing rules."""
+    return "hist_small" if "sec" in (barSize or "").lower() else "hist"
 
-# ---------- orders log ----------
-def _log_order(event: str, payload: dict):
+def _on_ib_error(reqId, errorCode, errorString, contract=None):
     try:
-        rec = {"ts": int(time.time()), "event": event, **payload}
-        with ORDERS_LOG.open("a", encoding="utf-8") as f:
-            f.write(json.dumps(rec, separators=(",", ":")) + "\n")
+        msg = (errorString or "").lower()
+        if errorCode == 162 and "pacing" in msg:
+            _IB_SCHED.buckets["hist"].penalize()
+            _IB_SCHED.buckets["hist_small"].penalize()
+        elif errorCode == 420 and "pacing" in msg:
+            _IB_SCHED.buckets["hist_small"].penalize()
+        elif errorCode == 100:  # max rate of messages per second exceeded
+            _IB_SCHED.msg.penalize()
+        elif errorCode == 101:  # max number of tickers reached
+            _MKT.on_limit(getattr(contract, "conId", 0) or 0)
     except Exception:
         pass
 
-# ---------- orders ----------
-@router.get("/orders/open")
-async def orders_open():
-    try:
-        await _ensure_connected()
-        openTrades = ib.openTrades()
-        out = []
-        for t in openTrades:
-            c = t.contract
-            o = t.order
-            st = t.orderStatus
-            out.append({
-                "orderId": o.orderId,
-                "permId": o.permId,
-                "symbol": getattr(c, "localSymbol", None) or c.symbol,
-                "conId": getattr(c, "conId", None),
-                "secType": c.secType,
-                "action": o.action,
-                "type": o.orderType,
-                "lmt": getattr(o, "lmtPrice", None),
-                "tif": o.tif,
-                "qty": o.totalQuantity,
-                "status": st.status,
-                "filled": st.filled,
-                "remaining": st.remaining,
-            })
-        _cache_write("orders_open.json", out)
-        return out
-    except Exception as e:
-        cached = _cache_read("orders_open.json", None)
-        if cached is not None:
-            return cached
-        raise HTTPException(503, f"IBKR offline and no open orders cache: {e}")
+ib.errorEvent += _on_ib_error
 
-@router.get("/orders/stream")
-async def orders_stream():
+@router.get("/scheduler")
+async def scheduler_metrics():
+    """Queue depth, tokens and backoff per request class, plus coalescing stats."""
+    return {"buckets": _IB_SCHED.metrics(), "singleflight": _IB_FLIGHT.stats(), "mktdata": _MKT.metrics()}
+
+# ---------- request coalescing (singleflight) ----------
+class _SingleFlight:
     """
-    Server-Sent Events for order/trade updates.
-    On connect: emits a snapshot of current open trades, then pushes live updates.
+    Concurrent callers with the same key await one in-flight IB call and
+    share its result (or exception). A cancelled caller never cancels the
+    shared call for the others. The call runs at the most urgent priority of
+    the callers waiting on it, so a UI read joining a warmer's request does
+    not wait in the background lane.
     """
-    await _ensure_connected()
-    # attach listeners to existing trades so further updates are pushed
-    for t in ib.openTrades():
-        _attach_trade_listener(t)
-    # also attach to any new trades created later
-    def _on_new_trade(trade):
-        _attach_trade_listener(trade)
-    ib.newOrderEvent += _on_new_trade
+    def __init__(self):
+        self._inflight: dict[Any, tuple[asyncio.Future, dict]] = {}
+        self.calls = 0    # IB calls actually issued
+        self.shared = 0   # callers that piggy-backed on an in-flight call
+
+    async def do(self, key, fn: Callable):
+        prio = _IB_PRIO.get()
+        ent = self._inflight.get(key)
+        if ent is None:
+            self.calls += 1
+            boost = {"prio": prio, "waits": set()}
+            async def _run():
+                _IB_BOOST.set(boost)
+                return await fn()
+            fut = asyncio.ensure_future(_run())
+            self._inflight[key] = (fut, boost)
+            def _done(f, k=key):
+                if self._inflight.get(k, (None,))[0] is f:
+                    self._inflight.pop(k, None)
+                if not f.cancelled():
+                    f.exception()  # mark retrieved; callers re-raise it themselves
+            fut.add_done_callback(_done)
+        else:
+            self.shared += 1
+            fut, boost = ent
+            if prio < boost["prio"]:
+                boost["prio"] = prio
+                for bucket, w in list(boost["waits"]):
+                    bucket.promote(w, prio)
+        return await asyncio.shield(fut)
+
+    def stats(self) -> dict:
+        return {"inflight": len(self._inflight), "calls": self.calls, "shared": self.shared}
+
+_IB_FLIGHT = _SingleFlight()
+
+def _ckey(c: Contract) -> tuple:
+    """Coalescing key for a contract: conId when known, else its defining fields."""
+    cid = getattr(c, "conId", 0)
+    if cid:
+        return (int(cid),)
+    return (getattr(c, "secType", ""), getattr(c, "symbol", ""), getattr(c, "exchange", ""),
+            getattr(c, "currency", ""), getattr(c, "lastTradeDateOrContractMonth", "") or "")
+
+async def _req_details(c: Contract) -> list:
+    return await _IB_FLIGHT.do(("details",) + _ckey(c),
+                               lambda: _IB_SCHED.run("details", lambda: ib.reqContractDetailsAsync(c)))
+
+async def _req_qualify(c: Contract) -> list:
+    return await _IB_FLIGHT.do(("qualify",) + _ckey(c),
+                               lambda: _IB_SCHED.run("details", lambda: ib.qualifyContractsAsync(c)))
+
+async def _req_tickers(c: Contract) -> list:
+    return await _IB_FLIGHT.do(("tickers",) + _ckey(c),
+                               lambda: _IB_SCHED.run("mktdata", lambda: ib.reqTickersAsync(c)))
+
+async def _req_fundamentals(c: Contract, report: str):
+    return await _IB_FLIGHT.do(("fund", report) + _ckey(c),
+                               lambda: _IB_SCHED.run("fund", lambda: ib.reqFundamentalDataAsync(c, reportType=report)))
+
+async def _req_history(c: Contract, duration: str, barSize: str, what: str, useRTH: bool, endDateTime: Any = "") -> list:
+    key = ("hist", str(endDateTime), duration, barSize, what, bool(useRTH)) + _ckey(c)
+    return await _IB_FLIGHT.do(key, lambda: _IB_SCHED.run(_hist_class(barSize), lambda: ib.reqHistoricalDataAsync(
+        c,
+        endDateTime=endDateTime,
+        durationStr=duration,
+        barSizeSetting=barSize,
+        whatToShow=what,
+        useRTH=useRTH,
+        formatDate=2,
+        keepUpToDate=False,
+    )))
+
+# ---------- streaming market-data lines (ref-counted, LRU) ----------
+MKT_LINES = int(os.getenv("IB_MKT_LINES", "90"))       # keep a few of the 100 default lines spare
+MKT_IDLE_S = float(os.getenv("IB_MKT_IDLE", "300"))    # drop unreferenced lines after this long
+MKT_LIMIT_RELAX_S = float(os.getenv("IB_MKT_LIMIT_RELAX", "600"))  # after an error 101, regrow the cap by one line this often
+
+class _MktDataManager:
+    """
+    Streaming reqMktData lines indexed by conId. Callers acquire()/release()
+    around use; a line carries the union of the generic tick lists asked of
+    it and is re-requested only when a caller needs a tick it lacks. Lines
+    with no references stay warm until evicted (LRU) to make room or idle out.
+    """
+    def __init__(self, limit: int):
+        self.max_limit = self.limit = max(1, limit)
+        self.limited_at = 0.0        # last error 101 (or cap regrowth step)
+        self._lines: "OrderedDict[int, dict]" = OrderedDict()  # conId -> {"tkr","ticks","refs","used"}
+        self.hits = 0
+        self.misses = 0
+
+    def ticker(self, conId: int):
+        ln = self._lines.get(int(conId or 0))
+        return ln["tkr"] if ln else None
+
+    @staticmethod
+    def _ticks(generic: str) -> set[str]:
+        return {t.strip() for t in str(generic or "").split(",") if t.strip()}
+
+    def _evict(self, need: int = 1) -> bool:
+        while len(self._lines) + need > self.limit:
+            victim = next((cid for cid, ln in self._lines.items() if ln["refs"] <= 0), None)
+            if victim is None:
+                return False
+            self._cancel(victim)
+        return True
+
+    def _cancel(self, cid: int) -> None:
+        ln = self._lines.pop(cid, None)
+        if ln:
+            try:
+                ib.cancelMktData(ln["tkr"].contract)
+            except Exception:
+                pass
 
-    async def _gen():
+    async def acquire(self, c: Contract, generic: str = ""):
+        """Ticker for c's line (created or widened as needed), or None when every line is in use."""
+        cid = int(getattr(c, "conId", 0) or 0)
+        if not cid:
+            return None
+        want = self._ticks(generic)
+        ln = self._lines.get(cid)
+        if ln and want <= ln["ticks"]:
+            self.hits += 1
+            ln["refs"] += 1
+            ln["used"] = time.time()
+            self._lines.move_to_end(cid)
+            return ln["tkr"]
+        self.misses += 1
+        if ln:
+            # widen: cancel and re-request with the union of tick lists
+            want |= ln["ticks"]
+            refs = ln["refs"]
+            self._cancel(cid)
+        else:
+            refs = 0
+            if not self._evict():
+                return None
+        def _open():
+            # runs once the scheduler lets us through: another acquire may have
+            # opened or widened this line meanwhile, so join it rather than duplicate it
+            nonlocal want, refs
+            cur = self._lines.get(cid)
+            if cur is not None:
+                if want <= cur["ticks"]:
+                    cur["refs"] += refs + 1
+                    cur["used"] = time.time()
+                    self._lines.move_to_end(cid)
+                    return cur["tkr"]
+                want |= cur["ticks"]
+                refs += cur["refs"]
+                self._cancel(cid)
+            elif not self._evict():
+                return None
+            tkr = ib.reqMktData(c, genericTickList=",".join(sorted(want)), snapshot=False)
+            self._lines[cid] = {"tkr": tkr, "ticks": want, "refs": refs + 1, "used": time.time()}
+            return tkr
+        return await _IB_SCHED.run("mktdata", _open)
+
+    def release(self, conId: int) -> None:
+        ln = self._lines.get(int(conId or 0))
+        if ln:
+            ln["refs"] = max(0, ln["refs"] - 1)
+            ln["used"] = time.time()
+
+    def sweep(self) -> None:
+        now = time.time()
+        cutoff = now - MKT_IDLE_S
+        for cid in [cid for cid, ln in self._lines.items() if ln["refs"] <= 0 and ln["used"] < cutoff]:
+            self._cancel(cid)
+        if self.limit < self.max_limit and now - self.limited_at >= MKT_LIMIT_RELAX_S:
+            # other clients on the account may have freed their lines since
+            self.limit += 1
+            self.limited_at = now
+
+    def on_limit(self, conId: int = 0) -> None:
+        """IB refused a line (error 101): drop it and treat what we still hold as the cap."""
+        ln = self._lines.pop(int(conId or 0), None)
+        if ln:
+            try: ib.cancelMktData(ln["tkr"].contract)
+            except Exception: pass
+        self.limit = max(1, len(self._lines) - (0 if ln else 1))
+        self.limited_at = time.time()
+        self._evict(0)
+
+    def reset(self) -> None:
+        """Disconnected: IB dropped every line, and the next session starts from the configured cap."""
+        self._lines.clear()
+        self.limit = self.max_limit
+
+    def metrics(self) -> dict:
+        return {"lines": len(self._lines), "limit": self.limit, "hits": self.hits, "misses": self.misses,
+                "inUse": sum(1 for ln in self._lines.values() if ln["refs"] > 0)}
+
+_MKT = _MktDataManager(MKT_LINES)
+ib.disconnectedEvent += _MKT.reset
+
+def _tick_has(t, f: str) -> bool:
+    v = getattr(t, f, None)
+    return v is not None and not (isinstance(v, float) and math.isnan(v))
+
+async def _await_ticker(tkr, fields: tuple, timeout: float) -> bool:
+    """
+    Wait on the ticker's updateEvent until any of `fields` is populated or
+    `timeout` expires. Returns immediately when the data is already there.
+    """
+    if not fields or any(_tick_has(tkr, f) for f in fields):
+        return True
+    fut = asyncio.get_running_loop().create_future()
+    def _on_update(*_):
+        if not fut.done() and any(_tick_has(tkr, f) for f in fields):
+            fut.set_result(True)
+    tkr.updateEvent += _on_update
+    try:
+        return await asyncio.wait_for(fut, timeout)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        tkr.updateEvent -= _on_update
+
+async def _mkt_ticker(c: Contract, generic: str = "", fields: tuple = (), wait: float = 1.5):
+    """
+    Live ticker for c from its streaming line; a freshly opened line gets up
+    to `wait` seconds to fill any of `fields`. None when no line is available.
+    """
+    tkr = await _MKT.acquire(c, generic)
+    if tkr is None:
+        return None
+    try:
+        await _await_ticker(tkr, fields, wait)
+        return tkr
+    finally:
+        _MKT.release(c.conId)
+
+# ---------- qualified contract + details store (conId keyed) ----------
+CONTRACTS_DB = CACHE_DIR / "contracts.db"
+CONTRACT_TTL = float(os.getenv("IB_CONTRACT_TTL", str(7 * 86400)))
+HOURS_TTL = float(os.getenv("IB_HOURS_TTL", "86400"))   # details carrying trading/liquid hours
+_CONTRACT_FIELDS = (
+    "conId", "symbol", "secType", "lastTradeDateOrContractMonth", "strike", "right", "multiplier",
+    "exchange", "primaryExchange", "currency", "localSymbol", "tradingClass",
+)
+_DETAIL_FIELDS = (
+    "longName", "minTick", "priceMagnifier", "timeZoneId", "tradingHours", "liquidHours",
+    "underConId", "evRule", "evMultiplier", "marketRuleIds", "validExchanges", "orderTypes",
+    "industry", "category", "subcategory", "stockType",
+)
+
+def _contract_to_dict(c) -> dict:
+    return {f: getattr(c, f) for f in _CONTRACT_FIELDS if getattr(c, f, None) not in (None, "")}
+
+def _contract_from_dict(d: dict) -> Contract:
+    return Contract(**{k: v for k, v in d.items() if k in _CONTRACT_FIELDS})
+
+class _ContractStore:
+    """
+    conId -> (Contract, ContractDetails fields, market rules) with an
+    in-memory front over contracts.db, plus a (secType, symbol, exchange,
+    currency, expiry) -> [conId] index so symbol lookups skip IB as well.
+    Entries older than CONTRACT_TTL (HOURS_TTL when they carry trading hours,
+    which IB only publishes about a week ahead) are served and refreshed in
+    the background.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self._con: sqlite3.Connection | None = None
+        self._mem: dict[int, dict] = {}          # conId -> {"c": dict, "d": dict|None, "ts": float}
+        self._keys: dict[str, list[int]] = {}    # lookup key -> conIds
+        self._rules: dict[str, list] = {}        # marketRuleId -> [[lowEdge, increment], ...]
+        self._refreshing: set[int] = set()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._con is None:
+            con = _sqlite(self.path)
+            con.executescript("""
+                CREATE TABLE IF NOT EXISTS contracts(conId INTEGER PRIMARY KEY, contract TEXT NOT NULL,
+                                                     details TEXT, ts REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS symkeys(key TEXT PRIMARY KEY, conIds TEXT NOT NULL, ts REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS market_rules(ruleId TEXT PRIMARY KEY, increments TEXT NOT NULL);
+            """)
+            self._con = con
+        return self._con
+
+    @staticmethod
+    def key_for(c: Contract) -> str:
+        return "|".join(str(getattr(c, f, "") or "").upper() for f in
+                        ("secType", "symbol", "exchange", "currency", "lastTradeDateOrContractMonth"))
+
+    def get(self, conId: int) -> dict | None:
+        cid = int(conId)
+        e = self._mem.get(cid)
+        if e is None:
+            try:
+                row = self._db().execute("SELECT contract, details, ts FROM contracts WHERE conId=?", (cid,)).fetchone()
+            except Exception:
+                row = None
+            if not row:
+                return None
+            e = {"c": json.loads(row[0]), "d": json.loads(row[1]) if row[1] else None, "ts": float(row[2])}
+            self._mem[cid] = e
+        return e
+
+    def lookup(self, key: str) -> list[int]:
+        cids = self._keys.get(key)
+        if cids is None:
+            try:
+                row = self._db().execute("SELECT conIds FROM symkeys WHERE key=?", (key,)).fetchone()
+            except Exception:
+                row = None
+            cids = json.loads(row[0]) if row else []
+            if cids:
+                self._keys[key] = cids
+        return cids
+
+    def _save(self, cid: int, e: dict) -> None:
+        try:
+            self._db().execute(
+                "INSERT INTO contracts(conId,contract,details,ts) VALUES(?,?,?,?) "
+                "ON CONFLICT(conId) DO UPDATE SET contract=excluded.contract, "
+                "details=COALESCE(excluded.details, contracts.details), ts=excluded.ts",
+                (cid, json.dumps(e["c"], separators=(",", ":")),
+                 json.dumps(e["d"], separators=(",", ":")) if e.get("d") is not None else None, e["ts"]))
+        except Exception:
+            log.exception("contract store write failed")
+
+    def put_contract(self, c: Contract) -> dict | None:
+        cid = int(getattr(c, "conId", 0) or 0)
+        if not cid:
+            return None
+        prev = self.get(cid)
+        e = {"c": _contract_to_dict(c), "d": prev.get("d") if prev else None,
+             "ts": prev["ts"] if prev and prev.get("d") is not None else time.time()}
+        self._mem[cid] = e
+        self._save(cid, e)
+        return e
+
+    def put_details(self, cd) -> dict | None:
+        c = getattr(cd, "contract", None)
+        cid = int(getattr(c, "conId", 0) or 0)
+        if not cid:
+            return None
+        d = {f: getattr(cd, f, None) for f in _DETAIL_FIELDS}
+        d["secIdList"] = [[getattr(t, "tag", None), getattr(t, "value", None)] for t in (getattr(cd, "secIdList", None) or [])]
+        e = {"c": _contract_to_dict(c), "d": d, "ts": time.time()}
+        self._mem[cid] = e
+        self._save(cid, e)
+        return e
+
+    def index(self, key: str, conIds: list[int]) -> None:
+        cids = [int(x) for x in conIds if x]
+        if not key or not cids:
+            return
+        self._keys[key] = cids
+        try:
+            self._db().execute(
+                "INSERT INTO symkeys(key,conIds,ts) VALUES(?,?,?) "
+                "ON CONFLICT(key) DO UPDATE SET conIds=excluded.conIds, ts=excluded.ts",
+                (key, json.dumps(cids), time.time()))
+        except Exception:
+            log.exception("contract store index write failed")
+
+    @staticmethod
+    def view(e: dict) -> SimpleNamespace:
+        """ContractDetails-shaped view: .contract plus the detail attributes."""
+        return SimpleNamespace(contract=_contract_from_dict(e["c"]), **(e.get("d") or {}))
+
+    @staticmethod
+    def hours_spent(d: dict | None) -> bool:
+        """True when the stored trading hours end before today (exchange time)."""
+        sess = _parse_ib_hours((d or {}).get("tradingHours"))
+        if not sess:
+            return False
+        try:
+            zone = ZoneInfo(d["timeZoneId"]) if d.get("timeZoneId") else timezone.utc
+        except Exception:
+            zone = timezone.utc
+        last = sess[-1].get("closeDate") or sess[-1]["date"]
+        return last < datetime.now(zone).strftime("%Y%m%d")
+
+    def refresh_if_stale(self, cid: int, e: dict) -> None:
+        d = e.get("d") or {}
+        ttl = HOURS_TTL if d.get("tradingHours") or d.get("liquidHours") else CONTRACT_TTL
+        if time.time() - e.get("ts", 0.0) < ttl or cid in self._refreshing:
+            return
+        self._refreshing.add(cid)
+        async def _refresh():
+            _IB_PRIO.set(PRIO_BG)
+            try:
+                await _ensure_connected()
+                for cd in (await _req_details(Contract(conId=cid))) or []:
+                    self.put_details(cd)
+            except Exception:
+                pass
+            finally:
+                self._refreshing.discard(cid)
+        try:
+            asyncio.get_running_loop().create_task(_refresh())
+        except RuntimeError:
+            self._refreshing.discard(cid)
+
+    def rule(self, ruleId: str) -> list | None:
+        r = self._rules.get(ruleId)
+        if r is None:
+            try:
+                row = self._db().execute("SELECT increments FROM market_rules WHERE ruleId=?", (ruleId,)).fetchone()
+            except Exception:
+                row = None
+            if row:
+                r = self._rules[ruleId] = json.loads(row[0])
+        return r
+
+    def put_rule(self, ruleId: str, increments: list) -> None:
+        self._rules[ruleId] = increments
+        try:
+            self._db().execute("INSERT OR REPLACE INTO market_rules(ruleId,increments) VALUES(?,?)",
+                               (ruleId, json.dumps(increments)))
+        except Exception:
+            pass
+
+_CONTRACTS = _ContractStore(CONTRACTS_DB)
+
+async def _details_for(c: Contract) -> list[SimpleNamespace]:
+    """
+    ContractDetails for `c` from the store, else from IB (and stored).
+    Returns views exposing the attributes the endpoints read from ContractDetails.
+    """
+    cid = int(getattr(c, "conId", 0) or 0)
+    key = "" if cid else _ContractStore.key_for(c)
+    es = [_CONTRACTS.get(cid)] if cid else [_CONTRACTS.get(x) for x in _CONTRACTS.lookup(key)]
+    cached = bool(es) and all(e and e.get("d") is not None for e in es)
+    if cached:
+        # hours that ran out are refetched inline while connected; otherwise serve the store
+        if not (ib.isConnected() and any(_ContractStore.hours_spent(e["d"]) for e in es)):
+            if cid:
+                _CONTRACTS.refresh_if_stale(cid, es[0])
+            return [_CONTRACTS.view(e) for e in es]
+    try:
+        await _ensure_connected()
+        views = []
+        for cd in (await _req_details(c)) or []:
+            e = _CONTRACTS.put_details(cd)
+            if e:
+                views.append(_CONTRACTS.view(e))
+    except Exception:
+        if cached:
+            return [_CONTRACTS.view(e) for e in es]
+        raise
+    if cached and not views:
+        return [_CONTRACTS.view(e) for e in es]
+    if key and views:
+        _CONTRACTS.index(key, [v.contract.conId for v in views])
+    return views
+
+async def _market_rules(view: SimpleNamespace, maxn: int = 4) -> dict[str, list]:
+    """Price increment ladders for the view's marketRuleIds (cached forever once fetched)."""
+    out: dict[str, list] = {}
+    ids = [x.strip() for x in str(getattr(view, "marketRuleIds", "") or "").split(",") if x.strip()]
+    for rid in list(dict.fromkeys(ids))[:maxn]:
+        r = _CONTRACTS.rule(rid)
+        if r is None:
+            try:
+                incs = await _IB_SCHED.run("details", lambda rid=rid: ib.reqMarketRuleAsync(int(rid)))
+                r = [[_num_or_none(getattr(x, "lowEdge", None)), _num_or_none(getattr(x, "increment", None))]
+                     for x in (incs or [])]
+                _CONTRACTS.put_rule(rid, r)
+            except Exception:
+                continue
+        out[rid] = r
+    return out
+
+# ---------- historical bar store (columnar, gap-filled) ----------
+BARS_DIR = CACHE_DIR / "bars"
+HIST_MAX_CHUNKS = int(os.getenv("IB_HIST_MAX_CHUNKS", "24"))   # IB requests per fill pass
+_BARS_MAGIC = b"TBB1"
+_BAR_COLS = ("t", "o", "h", "l", "c", "v")
+_BAR_UNITS = {"sec": 1, "min": 60, "hour": 3600, "day": 86400, "week": 7 * 86400, "month": 30 * 86400}
+_DUR_UNITS = {"S": 1, "D": 86400, "W": 7 * 86400, "M": 30 * 86400, "Y": 365 * 86400}
+# Longest duration (seconds) worth asking for in one request, by bar size (seconds).
+_HIST_MAX_CHUNK = (
+    (1, 1800), (5, 7200), (10, 14400), (30, 28800), (60, 7 * 86400),
+    (600, 30 * 86400), (3600, 365 * 86400), (86400, 20 * 365 * 86400),
+)
+
+def _bar_seconds(barSize: str) -> int:
+    parts = str(barSize or "").lower().split()
+    n = int(parts[0]) if parts and parts[0].isdigit() else 1
+    for unit, secs in _BAR_UNITS.items():
+        if parts and parts[-1].startswith(unit):
+            return n * secs
+    raise HTTPException(400, f"unsupported barSize {barSize!r}")
+
+def _duration_parts(duration: str) -> tuple[int, str]:
+    parts = str(duration or "").upper().split()
+    try:
+        n, unit = int(parts[0]), parts[1][:1]
+    except Exception:
+        raise HTTPException(400, f"bad duration {duration!r}")
+    if unit not in _DUR_UNITS or n <= 0:
+        raise HTTPException(400, f"bad duration {duration!r}")
+    return n, unit
+
+def _ib_duration(seconds: float) -> str:
+    """Smallest IB duration string covering `seconds`."""
+    s = max(60, int(math.ceil(seconds)))
+    if s <= 86400:
+        return f"{s} S"
+    d = math.ceil(s / 86400)
+    return f"{d} D" if d <= 365 else f"{math.ceil(d / 365)} Y"
+
+def _hist_max_chunk(bar_s: int) -> int:
+    out = _HIST_MAX_CHUNK[0][1]
+    for size, span in _HIST_MAX_CHUNK:
+        if bar_s >= size:
+            out = span
+    return out
+
+def _bar_epoch(d) -> float:
+    if isinstance(d, datetime):
+        return (d if d.tzinfo else d.replace(tzinfo=timezone.utc)).timestamp()
+    if hasattr(d, "toordinal"):  # date (daily and larger bars)
+        return float(calendar.timegm(d.timetuple()))
+    return float(d)
+
+def _bars_rows(bars) -> list[tuple]:
+    rows = [(_bar_epoch(b.date), float(b.open), float(b.high), float(b.low), float(b.close), float(b.volume or 0))
+            for b in (bars or [])]
+    rows.sort(key=lambda r: r[0])
+    return rows
+
+class _BarSeries:
+    """
+    One (conId, barSize, whatToShow, useRTH) series as parallel float64
+    columns sorted by time. File layout: magic, u32 meta length, JSON meta,
+    u32 count, then each column's doubles back to back. Saves are debounced
+    and the file is written on the disk-writer thread from a snapshot.
+    """
+    SAVE_DELAY = 1.0
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.cols: dict[str, array] = {k: array("d") for k in _BAR_COLS}
+        self.meta: dict[str, Any] = {"head": False, "tailTo": 0.0}
+        self.lock = asyncio.Lock()
+        self.pending = 0      # snapshots scheduled or queued but not yet on disk
+        self._save_handle: asyncio.TimerHandle | None = None
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.cols["t"])
+
+    def _load(self) -> None:
+        try:
+            raw = self.path.read_bytes()
+        except Exception:
+            return
+        try:
+            if raw[:4] != _BARS_MAGIC:
+                raise ValueError("bad magic")
+            (ml,) = struct.unpack_from("<I", raw, 4)
+            meta = json.loads(raw[8:8 + ml])
+            off = 8 + ml
+            (n,) = struct.unpack_from("<I", raw, off)
+            off += 4
+            cols = {}
+            for k in _BAR_COLS:
+                a = array("d")
+                a.frombytes(raw[off:off + 8 * n])
+                if meta.get("bo", sys.byteorder) != sys.byteorder:
+                    a.byteswap()
+                cols[k] = a
+                off += 8 * n
+            self.cols = cols
+            self.meta.update(meta)
+        except Exception:
+            log.warning("discarding unreadable bar file %s", self.path)
+
+    def save(self) -> None:
+        """Schedule a write; calls within SAVE_DELAY share one snapshot."""
+        if self._save_handle is not None:
+            return
+        self.pending += 1
+        try:
+            self._save_handle = asyncio.get_running_loop().call_later(self.SAVE_DELAY, self._snapshot)
+        except RuntimeError:
+            self._snapshot()
+
+    def _snapshot(self) -> None:
+        self._save_handle = None
+        mb = json.dumps({**self.meta, "bo": sys.byteorder}).encode()
+        parts = [_BARS_MAGIC + struct.pack("<I", len(mb)) + mb + struct.pack("<I", len(self))]
+        parts += [self.cols[k].tobytes() for k in _BAR_COLS]
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        _DISK.call(lambda: self._write(parts, loop))
+
+    def _done(self) -> None:
+        self.pending -= 1
+
+    def _write(self, parts: list[bytes], loop: asyncio.AbstractEventLoop | None) -> None:
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            with open(tmp, "wb") as f:
+                f.writelines(parts)
+            os.replace(tmp, self.path)
+        except Exception:
+            log.exception("bar file write failed")
+        finally:
+            # `pending` belongs to the event loop thread
+            try:
+                loop.call_soon_threadsafe(self._done) if loop else self._done()
+            except RuntimeError:
+                self._done()  # loop already closed
+
+    def merge(self, rows: list[tuple]) -> None:
+        """Sorted rows replace whatever the store holds over their time span."""
+        if not rows:
+            return
+        t = self.cols["t"]
+        i = bisect.bisect_left(t, rows[0][0])
+        j = bisect.bisect_right(t, rows[-1][0])
+        for k, name in enumerate(_BAR_COLS):
+            self.cols[name][i:j] = array("d", (r[k] for r in rows))
+
+    def span(self, start: float, end: float) -> tuple[int, int]:
+        t = self.cols["t"]
+        return bisect.bisect_left(t, start), bisect.bisect_right(t, end)
+
+class _BarStore:
+    """Loaded series by key, LRU-bounded; files live under runtime/cache/bars."""
+    MAX_LOADED = 64
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._series: "OrderedDict[tuple, _BarSeries]" = OrderedDict()
+
+    def series(self, conId: int, barSize: str, what: str, useRTH: bool) -> _BarSeries:
+        key = (int(conId), barSize, what.upper(), bool(useRTH))
+        s = self._series.get(key)
+        if s is None:
+            self.root.mkdir(parents=True, exist_ok=True)
+            name = _safe_name(f"{int(conId)}-{barSize}-{what.upper()}-{int(bool(useRTH))}") + ".bars"
+            s = self._series[key] = _BarSeries(self.root / name)
+            # a series with a save in flight stays loaded so a reload cannot read the older file
+            for k in [k for k, v in self._series.items() if not v.lock.locked() and not v.pending][:max(0, len(self._series) - self.MAX_LOADED)]:
+                self._series.pop(k, None)
+        self._series.move_to_end(key)
+        return s
+
+_BARS = _BarStore(BARS_DIR)
+
+async def _bars_fetch_back(c: Contract, s: _BarSeries, barSize: str, what: str, useRTH: bool,
+                           end: float | None, stop: float, head: bool = False) -> float:
+    """
+    Walk backwards from `end` (None = now) to `stop` in pacing-sized chunks,
+    merging each chunk. Returns how far back the walk got; at or below
+    `stop` means the range was covered.
+    """
+    bar_s = _bar_seconds(barSize)
+    chunk = _hist_max_chunk(bar_s)
+    hi = end if end is not None else time.time()
+    for n in range(HIST_MAX_CHUNKS):
+        if hi <= stop:
+            break
+        span = min(chunk, hi - stop + bar_s)
+        edt = "" if (end is None and n == 0) else datetime.fromtimestamp(hi, timezone.utc)
+        rows = _bars_rows(await _req_history(c, _ib_duration(span), barSize, what, useRTH, endDateTime=edt))
+        if edt != "":
+            rows = [r for r in rows if r[0] < hi]  # the bar at `hi` is already stored
+        if not rows:
+            if head and span >= 7 * 86400:
+                s.meta["head"] = True  # a full week with nothing before: IB has no older data
+                return stop
+            hi -= span  # weekend/holiday gap at small bar sizes
+            continue
+        s.merge(rows)
+        hi = rows[0][0]
+    if head:  # everything from here up was asked for, even where IB had no bars
+        s.meta["coveredFrom"] = min(hi, s.meta.get("coveredFrom") or hi)
+    return hi
+
+async def _bars_ensure(c: Contract, barSize: str, what: str, useRTH: bool, start: float) -> _BarSeries:
+    """Bring the series up to date at the tail and back to `start` at the head."""
+    s = _BARS.series(c.conId, barSize, what, useRTH)
+    bar_s = _bar_seconds(barSize)
+    async with s.lock:
+        now = time.time()
+        t = s.cols["t"]
+        changed = False
+        if not t:
+            await _bars_fetch_back(c, s, barSize, what, useRTH, None, start, head=True)
+            s.meta["tailTo"] = now
+            changed = True
+        else:
+            # the last stored bar may be partial, so the tail pass always re-reads it
+            stop = max(t[-1], s.meta.get("tailTo", 0.0) - bar_s)
+            # a live keepUpToDate series on this key writes the tail itself, once
+            # the store reaches back to where the subscription's bars start
+            live = _LIVE.covers((int(c.conId), barSize, what.upper(), bool(useRTH)), t[-1])
+            if not live and now - s.meta.get("tailTo", 0.0) >= min(bar_s, 60):
+                hi = await _bars_fetch_back(c, s, barSize, what, useRTH, None, stop)
+                if hi > stop:  # ran out of chunks: the hole below the new tail is filled by later passes
+                    s.meta.setdefault("gaps", []).append([stop, hi])
+                s.meta["tailTo"] = now
+                changed = True
+            gaps = s.meta.get("gaps")
+            if gaps:
+                lo, hi = gaps[-1]
+                hi = await _bars_fetch_back(c, s, barSize, what, useRTH, hi, lo)
+                if hi <= lo:
+                    gaps.pop()
+                else:
+                    gaps[-1][1] = hi
+                changed = True
+            # resume below what earlier head passes already checked, so a start
+            # inside a gap (weekend, halt, pre-listing) is not re-requested each call
+            first = min(t[0], s.meta.get("coveredFrom") or t[0])
+            if start < first and not s.meta.get("head"):
+                await _bars_fetch_back(c, s, barSize, what, useRTH, first, start, head=True)
+                changed = True
+        if changed:
+            s.save()
+    return s
+
+def _bars_window(duration: str, bar_s: int, now: float) -> float:
+    """Calendar start to fetch back to; "N D" counts trading days, so pad for weekends."""
+    n, unit = _duration_parts(duration)
+    if unit == "D":
+        return now - (n * 7 / 5 + 3) * 86400
+    return now - n * _DUR_UNITS[unit]
+
+def _bars_slice(s: _BarSeries, duration: str, bar_s: int, now: float, tz: str | None = None) -> tuple[int, int]:
+    """Index range for `duration` ending now; "N D" means the last N trading sessions like IB."""
+    n, unit = _duration_parts(duration)
+    t = s.cols["t"]
+    i, j = s.span(_bars_window(duration, bar_s, now), now + bar_s)
+    if unit != "D" or i >= j:
+        return i, j
+    if bar_s >= 86400:
+        return max(i, j - n), j
+    try:
+        zone = ZoneInfo(tz) if tz else timezone.utc
+    except Exception:
+        zone = timezone.utc
+    days = 0
+    last_day = None
+    k = j
+    while k > i:
+        day = datetime.fromtimestamp(t[k - 1], zone).date()
+        if day != last_day:
+            days += 1
+            if days > n:
+                break
+            last_day = day
+        k -= 1
+    return k, j
+
+def _bars_json(cols: dict[str, array], bar_s: int) -> list[dict]:
+    if bar_s >= 86400:
+        ts = [datetime.fromtimestamp(x, timezone.utc).date().isoformat() for x in cols["t"]]
+    else:
+        ts = [datetime.fromtimestamp(x, timezone.utc).isoformat() for x in cols["t"]]
+    return [{"t": tt, "o": o, "h": h, "l": l, "c": cc, "v": v}
+            for tt, o, h, l, cc, v in zip(ts, cols["o"], cols["h"], cols["l"], cols["c"], cols["v"])]
+
+# ---------- local resampling (session aware) ----------
+RESAMPLE_BASE = os.getenv("IB_RESAMPLE_BASE", "1 min")
+RESAMPLE_MAX_DAYS = float(os.getenv("IB_RESAMPLE_MAX_DAYS", "31"))
+
+def _resample_base(barSize: str, duration: str) -> str | None:
+    """
+    Bar size to fetch and resample from, or None to ask IB for `barSize`
+    directly. Intraday and daily bars derive from RESAMPLE_BASE while the
+    window stays small enough to hold at that resolution; weeks and months
+    always derive from daily bars.
+    """
+    bar_s = _bar_seconds(barSize)
+    if bar_s >= 7 * 86400:
+        return "1 day"
+    base_s = _bar_seconds(RESAMPLE_BASE)
+    if bar_s <= base_s or bar_s % base_s:
+        return None
+    now = time.time()
+    if now - _bars_window(duration, base_s, now) > RESAMPLE_MAX_DAYS * 86400:
+        return None
+    return RESAMPLE_BASE
+
+class _Sessions:
+    """
+    Trading sessions from IB's tradingHours/liquidHours. IB only publishes
+    about a week of hours, so older days reuse the weekday's open/length.
+    """
+    def __init__(self, hours: str | None, tz: str | None):
+        try:
+            self.zone = ZoneInfo(tz) if tz else timezone.utc
+        except Exception:
+            self.zone = timezone.utc
+        spans = []
+        seen: dict[int, list[tuple[int, int, float]]] = defaultdict(list)
+        for e in _parse_ib_hours(hours):
+            if e.get("closed"):
+                continue
+            try:
+                d0 = datetime.strptime(e["date"] + e["open"], "%Y%m%d%H%M").replace(tzinfo=self.zone)
+                d1 = datetime.strptime((e.get("closeDate") or e["date"]) + e["close"], "%Y%m%d%H%M").replace(tzinfo=self.zone)
+            except Exception:
+                continue
+            s0, s1 = d0.timestamp(), d1.timestamp()
+            if s1 <= s0:  # old single-date format for sessions crossing midnight
+                s1 += 86400
+            spans.append((s0, s1))
+            seen[d1.weekday()].append((d1.hour, d1.minute, s1 - s0))
+        spans.sort()
+        self.starts = [a for a, _ in spans]
+        self.ends = [b for _, b in spans]
+        vals = [v for vs in seen.values() for v in vs]
+        self.default = max(vals, key=lambda v: (vals.count(v), v[2])) if vals else None
+        # template keyed by the weekday the session closes on; shortened sessions
+        # (half days before holidays) are left out so that weekday's older
+        # sessions fall back to the usual full-length one
+        full = self.default[2] if self.default else 0.0
+        self.tpl: dict[int, tuple[int, int, float]] = {}
+        for wd, vs in seen.items():
+            vs = [v for v in vs if v[2] >= full]
+            if vs:
+                self.tpl[wd] = max(vs, key=lambda v: (vs.count(v), v[2]))
+
+    def _day_start(self, ts: float) -> float:
+        d = datetime.fromtimestamp(ts, self.zone)
+        return d.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+    def find(self, ts: float) -> tuple[float, float, bool]:
+        """(start, end, in_session) of the session holding ts, else of the gap before the next one."""
+        k = bisect.bisect_right(self.starts, ts) - 1
+        if k >= 0 and ts < self.ends[k]:
+            return self.starts[k], self.ends[k], True
+        if k >= 0 and k + 1 < len(self.starts):
+            return self.ends[k], self.starts[k + 1], False
+        d0 = self._day_start(ts)
+        nxt = d0 + 86400
+        if self.default is not None:
+            today = datetime.fromtimestamp(ts, self.zone).date()
+            # a session may open the evening before the day it closes on
+            for day in (today, today.fromordinal(today.toordinal() + 1)):
+                wd = day.weekday()
+                if wd not in self.tpl and wd >= 5:
+                    continue
+                hh, mm, ln = self.tpl.get(wd, self.default)
+                s1 = datetime(day.year, day.month, day.day, hh, mm, tzinfo=self.zone).timestamp()
+                s0 = s1 - ln
+                if s0 <= ts < s1:
+                    return s0, s1, True
+                if ts < s0:
+                    nxt = min(nxt, s0)
+        return d0, nxt, False
+
+def _resample(cols: dict[str, array], bar_s: int, sess: _Sessions | None) -> dict[str, array]:
+    """
+    OHLCV resample of sorted bars to `bar_s`. Intraday buckets are clock
+    aligned in exchange time and clipped to session bounds (so a 1h bar on a
+    09:30 open is 09:30-10:00); daily buckets are whole sessions labelled by
+    their trade date; weekly/monthly buckets group daily bars. Each bucket is
+    located with one bisect and reduced with builtin min/max/sum over slices.
+    """
+    t, o, h, l, c, v = (cols[k] for k in _BAR_COLS)
+    out = {k: array("d") for k in _BAR_COLS}
+    n = len(t)
+    sess = sess or _Sessions(None, None)
+    i = 0
+    while i < n:
+        ts = t[i]
+        if bar_s >= 28 * 86400:  # month: label first trading day, end at next month start
+            d = datetime.fromtimestamp(ts, timezone.utc)
+            y, m = (d.year + 1, 1) if d.month == 12 else (d.year, d.month + 1)
+            key, end = ts, float(calendar.timegm((y, m, 1, 0, 0, 0)))
+        elif bar_s >= 7 * 86400:  # week: label first trading day, end next Monday
+            d = datetime.fromtimestamp(ts, timezone.utc).date()
+            key, end = ts, float(calendar.timegm(d.timetuple())) + (7 - d.weekday()) * 86400
+        else:
+            s0, s1, live = sess.find(ts)
+            if bar_s >= 86400:
+                label = datetime.fromtimestamp(s1 - 1, sess.zone).date()
+                key, end = float(calendar.timegm(label.timetuple())), s1
+            else:
+                anchor = sess._day_start(s0)
+                k = anchor + ((ts - anchor) // bar_s) * bar_s
+                key, end = max(k, s0), min(k + bar_s, s1)
+        j = bisect.bisect_left(t, end, i + 1)
+        vol = sum(v[i:j]) if v[i] >= 0 else v[i]
+        if out["t"] and out["t"][-1] == key:
+            # same label as the previous bucket (bars outside the session bounds
+            # of that trade date): fold them into one bar
+            out["h"][-1] = max(out["h"][-1], max(h[i:j]))
+            out["l"][-1] = min(out["l"][-1], min(l[i:j]))
+            out["c"][-1] = c[j - 1]
+            if vol >= 0 and out["v"][-1] >= 0:
+                out["v"][-1] += vol
+        else:
+            out["t"].append(key)
+            out["o"].append(o[i])
+            out["h"].append(max(h[i:j]))
+            out["l"].append(min(l[i:j]))
+            out["c"].append(c[j - 1])
+            out["v"].append(vol)
+        i = j
+    return out
+
+async def _bars_get(c: Contract, duration: str, barSize: str, what: str, useRTH: bool, online: bool) -> dict[str, array] | None:
+    """
+    Columns for `duration` of `barSize` bars ending now, from the bar store
+    (filled from IB when online), resampled locally from a finer stored
+    series where _resample_base() says so. None when offline with nothing stored.
+    """
+    cid = int(c.conId)
+    bar_s = _bar_seconds(barSize)
+    base = _resample_base(barSize, duration)
+    src = base or barSize
+    src_s = _bar_seconds(src)
+    now = time.time()
+    s = _BARS.series(cid, src, what, useRTH)
+    if online:
+        try:
+            s = await _bars_ensure(c, src, what, useRTH, _bars_window(duration, src_s, now))
+        except HTTPException:
+            raise
+        except Exception as e:
+            if not len(s):
+                raise HTTPException(502, detail=f"history failed: {e!s}")
+            log.warning("history fill failed for %s, serving stored bars: %s", cid, e)
+    if not len(s):
+        return None
+    if not online:
+        now = s.cols["t"][-1]
+    e = _CONTRACTS.get(cid)
+    if online and base and bar_s < 7 * 86400 and not (e and e.get("d")):
+        try:
+            await _details_for(Contract(conId=cid))
+            e = _CONTRACTS.get(cid)
+        except Exception:
+            pass
+    d = (e.get("d") or {}) if e else {}
+    i, j = _bars_slice(s, duration, src_s, now, d.get("timeZoneId"))
+    cols = {k: s.cols[k][i:j] for k in _BAR_COLS}
+    if base:
+        hours = d.get("liquidHours") if useRTH else d.get("tradingHours")
+        cols = _resample(cols, bar_s, _Sessions(hours, d.get("timeZoneId")))
+    return cols
+
+# ---------- helpers ----------
+async def _resolve_contract(
+    symbol: str,
+    secType: str = "STK",
+    exchange: str = "SMART",
+    currency: str = "USD",
+    expiry: str | None = None,
+):
+    """Resolve to a unique Contract (contract store first, then reqContractDetails)."""
+    base: Contract
+    st = secType.upper()
+    if st == "STK":
+        base = Stock(symbol, exchange, currency)
+    elif st == "FX" or st == "CASH":
+        base = Forex(symbol)  # e.g. "EURUSD"
+    elif st == "FUT":
+        base = Future(symbol, lastTradeDateOrContractMonth=expiry or "", exchange=exchange, currency=currency)
+    else:
+        base = Contract(secType=st, symbol=symbol, exchange=exchange, currency=currency)
+    cds = await _details_for(base)
+    if not cds:
+        raise HTTPException(404, detail=f"No contract for {symbol}/{secType}")
+    # Prefer SMART/primaryExchange when present
+    c = cds[0].contract
+    return c
+
+def _contract_json(c: Contract) -> dict:
+    return {
+        "conId": c.conId,
+        "symbol": c.symbol,
+        "localSymbol": getattr(c, "localSymbol", None),
+        "secType": c.secType,
+        "currency": c.currency,
+        "exchange": c.exchange,
+        "primaryExchange": getattr(c, "primaryExchange", None),
+        "lastTradeDateOrContractMonth": getattr(c, "lastTradeDateOrContractMonth", None),
+    }
+
+async def _contract_from_conid(cid: int) -> Contract:
+    e = _CONTRACTS.get(int(cid))
+    if e:
+        return _contract_from_dict(e["c"])
+    await _ensure_connected()
+    c = Contract(conId=int(cid))
+    try:
+        [qc] = await _req_qualify(c)
+        _CONTRACTS.put_contract(qc)
+        return qc
+    except Exception:
+        return c
+
+# ---------- orders log ----------
+def _log_order(event: str, payload: dict):
+    try:
+        rec = {"ts": int(time.time()), "event": event, **payload}
+        with ORDERS_LOG.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, separators=(",", ":")) + "\n")
+    except Exception:
+        pass
+
+# ---------- orders ----------
+@router.get("/orders/open")
+async def orders_open(response: Response = None):
+    return await _mirror_read("orders", response, "open orders")
+
+@router.get("/orders/stream")
+async def orders_stream():
+    """
+    Server-Sent Events for order/trade updates.
+    On connect: emits a snapshot of current open trades, then pushes live updates.
+    """
+    await _ensure_connected()
+    # attach listeners to existing trades so further updates are pushed
+    for t in ib.openTrades():
+        _attach_trade_listener(t)
+    # also attach to any new trades created later
+    def _on_new_trade(trade):
+        _attach_trade_listener(trade)
+    ib.newOrderEvent += _on_new_trade
+
+    async def _gen():
         # initial snapshot (open)
         for t in ib.openTrades():
             yield f"event: trade\ndata: {json.dumps(_order_trade_to_dict(t), separators=(',',':'))}\n\n"
@@ -1298,9 +2965,8 @@ async def _account_code() -> str:
     await _ensure_connected()
     accts = ib.managedAccounts()
     if not accts:
-        # fallback: infer from accountSummary
-        rows = await ib.accountSummaryAsync()
-        accts = sorted({r.account for r in rows})
+        # fallback: infer from the mirrored account summary
+        accts = sorted(_MIRROR.summary) or sorted({r.account for r in await ib.accountSummaryAsync()})
     if not accts:
         raise HTTPException(502, "No IBKR account code available")
     return accts[0]
@@ -1323,10 +2989,19 @@ def _mk_contract(symbol: str | None = None, conId: int | None = None, exchange:
     return Stock(sym, exchange or 'SMART', currency or 'USD')
 
 async def _qualify(c: Contract) -> Contract:
-    """Best-effort qualification so exchange/currency are present."""
+    """Best-effort qualification so exchange/currency are present (contract store first)."""
+    cid = int(getattr(c, "conId", 0) or 0)
+    key = "" if cid else _ContractStore.key_for(c)
+    cids = [cid] if cid else _CONTRACTS.lookup(key)
+    e = _CONTRACTS.get(cids[0]) if cids else None
+    if e:
+        return _contract_from_dict(e["c"])
     try:
-        qc = await ib.qualifyContractsAsync(c)
+        qc = await _req_qualify(c)
         if qc:
+            _CONTRACTS.put_contract(qc[0])
+            if key:
+                _CONTRACTS.index(key, [qc[0].conId])
             return qc[0]
     except Exception:
         pass
@@ -1344,11 +3019,72 @@ async def _await_status(trade, beats: int = 12, delay: float = 0.10):
     return getattr(trade, "orderStatus", None)
 
 # --- search/contracts (find tradables by text) -----------------------------
-@router.get("/search")
-async def search(q: str | None = Query(None), query: str | None = Query(None)):
-    term = (q or query or "").strip()
-    if not term:
-        return []
+def _search_merge(term: str, out: list[dict]) -> list[dict]:
+    """De-dup and rank the union of seed + local + online rows."""
+    # De-dup by (conId) then (symbol, exchange)
+    seen: set[int] = set()
+    uniq: list[dict] = []
+    seen_sym_ex = set()
+    for d in out:
+        cid = d.get("conId")
+        if cid:
+            if cid in seen:
+                continue
+            seen.add(cid)
+            uniq.append(d)
+        else:
+            k = (str(d.get("symbol","")).upper(), str(d.get("exchange","SMART")).upper())
+            if k in seen_sym_ex:
+                continue
+            seen_sym_ex.add(k)
+            uniq.append(d)
+
+    # If we have any IBKR-backed row (with conId) for a symbol, drop local
+    # rows for the same symbol that don't have a conId (prevents SMART+NASDAQ dupes).
+    sym_with_conid = { (r.get("symbol") or "").upper()
+                       for r in uniq if r.get("conId") }
+    if sym_with_conid:
+        uniq = [r for r in uniq
+                if r.get("conId") or (r.get("symbol") or "").upper() not in sym_with_conid]
+
+    # Soft-rank: prefer name **starts with** term, then contains term
+    tl = term.lower()
+    def _rank(r: dict) -> tuple[int,int]:
+        nm = (r.get("name","") or "").lower()
+        if nm.startswith(tl):  # e.g., "Manhattan Associates"
+            return (0, len(nm))
+        if tl in nm:
+            return (1, len(nm))
+        return (2, len(nm))
+    uniq.sort(key=_rank)
+
+    # If we have any *real* IB rows at all, drop every heuristic row (conId == None).
+    # This removes fake USD/SMART placeholders like the FUGRO row when a real FUR exists.
+    if any(r.get("conId") for r in uniq):
+        uniq = [r for r in uniq if r.get("conId")]
+    return uniq
+
+async def _search_run(term: str, emit: Callable | None = None, min_results: int = 6) -> list[dict]:
+    """
+    The /search pipeline. When `emit(phase, rows)` is given it is awaited with
+    the merged rows after the local phase and after every IB batch, which is
+    what /search/stream pushes to the client.
+    """
+    # Buckets so we can union later.
+    out_online: list[dict] = []
+    out_seed:   list[dict] = _heuristic_seed(term)
+    # Local universe/aliases + previously seen IB rows (works offline too).
+    out_local:  list[dict] = _local_match(term, limit=50)
+
+    async def _push(phase: str):
+        if emit is not None:
+            await emit(phase, _search_merge(term, out_seed + out_local + out_online)[:50])
+
+    # Stored results for this exact term: a fresh (or negative) entry skips IB,
+    # and any stored rows stand in for IB when we're offline.
+    stored_state, stored_rows = _SEARCH_STORE.lookup(term)
+    if emit is not None:
+        await emit("local", _search_merge(term, out_seed + out_local + stored_rows)[:50])
 
     # Try to connect, but don't block: if it fails we use local fallbacks.
     online = True
@@ -1356,22 +3092,28 @@ async def search(q: str | None = Query(None), query: str | None = Query(None)):
         await _ensure_connected()
     except Exception:
         online = False
-    # Buckets so we can union later.
-    out_online: list[dict] = []
-    out_local:  list[dict] = []
-    out_seed:   list[dict] = _heuristic_seed(term)
+    ask_ib = online and stored_state not in ("fresh", "negative")
+    if not ask_ib:
+        out_online.extend(stored_rows)
+
+    async def _on_batch(batch: list[dict]):
+        out_online.extend(batch)
+        await _push("match")
+    ib_status = {"answered": 0}   # IB name searches that got a reply (not timed out)
 
     # Fast path for obvious tickers (AAPL, BRK.B, EURUSD, etc.) and alias-variants
-    if online:
+    if ask_ib:
         variants_quick: list[str] = [term]
         variants_quick += _alias_variants(term)
         # keep small and unique
         seen_fast = set()
         variants_quick = [v for v in variants_quick if not (v in seen_fast or seen_fast.add(v))][:6]
         out_online.extend(await _try_resolve_many(variants_quick, secType="STK"))
+        if out_online:
+            await _push("resolve")
 
     # Online name matching with aliases + *prefix* variants (freer matching)
-    if online and len(out_online) < 10:
+    if ask_ib and len(out_online) < 10:
         # Build variants with **short prefixes first** so we get early hits.
         prefixes = _name_prefix_variants(term, min_len=3, max_per_word=6)
         prefixes.sort(key=len)  # shortest first: 'man', 'manh', 'manha', ...
@@ -1386,7 +3128,10 @@ async def search(q: str | None = Query(None), query: str | None = Query(None)):
             if _is_ticker_like(u):   # e.g., MANH
                 probable_tickers.append(u)
         if probable_tickers:
-            out_online.extend(await _try_resolve_many(probable_tickers[:6], secType="STK"))
+            got = await _try_resolve_many(probable_tickers[:6], secType="STK")
+            if got:
+                out_online.extend(got)
+                await _push("resolve")
         variants: list[str] = []
         variants += prefixes[:8]                  # prioritize short prefixes
         variants += [term, term.lower(), term.title()]
@@ -1395,87 +3140,40 @@ async def search(q: str | None = Query(None), query: str | None = Query(None)):
         seen_v = set()
         variants = [v for v in variants if not (v in seen_v or seen_v.add(v))][:14]
         # Run the batch; **return early** as soon as we have a few rows
-        out_online.extend(
-            await _match_batch(
-                variants,
-                per_timeout=3.5,
-                overall_timeout=7.0,
-                max_conc=4,
-                min_results=6
-            )
+        await _match_batch(
+            variants,
+            per_timeout=3.5,
+            overall_timeout=7.0,
+            max_conc=4,
+            min_results=min_results,
+            on_batch=_on_batch,
+            status=ib_status,
         )
 
     # If still nothing from IB name search, try a very short prefix once.
-    if online and not out_online and len(term) >= 4:
+    if ask_ib and not out_online and len(term) >= 4:
         short = re.split(r"[^A-Za-z0-9]+", term)[0][:4].lower()
         if len(short) >= 3:
-            out_online.extend(
-                await _match_batch([short], per_timeout=3.0, overall_timeout=3.0, max_conc=1, min_results=2)
-            )
- 
-    # Add local universe/aliases (works offline too).
-    out_local = _local_match(term, limit=50)
-    # Also, use cache substring fallback to catch prior lookups containing this name
-    out_cached = _cache_scan_by_name_substring(term, limit=30)
-
-    # Union: seed (heuristics) + local + cached + online
-    out = out_seed + out_local + out_cached + out_online
-
-    # De-dup by (conId) then (symbol, exchange)
-    seen: set[int] = set()
-    uniq: list[dict] = []
-    seen_sym_ex = set()
-    for d in out:
-        cid = d.get("conId")
-        if cid:
-            if cid in seen:
-                continue
-            seen.add(cid)
-            uniq.append(d)
-        else:
-            k = (str(d.get("symbol","")).upper(), str(d.get("exchange","SMART")).upper())
-            if k in seen_sym_ex:
-                continue
-            seen_sym_ex.add(k)
-            uniq.append(d)
+            await _match_batch([short], per_timeout=3.0, overall_timeout=3.0, max_conc=1, min_results=2,
+                               on_batch=_on_batch, status=ib_status)
 
-    # If we have any IBKR-backed row (with conId) for a symbol, drop local
-    # rows for the same symbol that don't have a conId (prevents SMART+NASDAQ dupes).
-    sym_with_conid = { (r.get("symbol") or "").upper()
-                       for r in uniq if r.get("conId") }
-    if sym_with_conid:
-        uniq = [r for r in uniq
-                if r.get("conId") or (r.get("symbol") or "").upper() not in sym_with_conid]
-
-    # Soft-rank: prefer name **starts with** term, then contains term
-    tl = term.lower()
-    def _rank(r: dict) -> tuple[int,int]:
-        nm = (r.get("name","") or "").lower()
-        if nm.startswith(tl):  # e.g., "Manhattan Associates"
-            return (0, len(nm))
-        if tl in nm:
-            return (1, len(nm))
-        return (2, len(nm))
-    uniq.sort(key=_rank)
-
-    # If we have any *real* IB rows at all, drop every heuristic row (conId == None).
-    # This removes fake USD/SMART placeholders like the FUGRO row when a real FUR exists.
-    if any(r.get("conId") for r in uniq):
-        uniq = [r for r in uniq if r.get("conId")]
+    # Union: seed (heuristics) + local + online
+    uniq = _search_merge(term, out_seed + out_local + out_online)
 
     # Enrich a few names (e.g., turn "FUR" -> "Fugro N.V.", "GOOGL" -> "Alphabet Inc. Class A")
-    if online and uniq:
+    if ask_ib and uniq:
         try:
             await _enrich_names_with_details(uniq, maxn=6)
         except Exception:
             pass
 
     # Fallback: try direct resolve if nothing matched online (AAPL/EURUSD)
-    if online and not uniq:
+    fallback: list[dict] = []
+    if ask_ib and not uniq:
         # Try stock
         try:
             c = await _resolve_contract(term, "STK", "SMART", "USD")
-            uniq.append({
+            fallback.append({
                 "symbol": getattr(c, "localSymbol", None) or getattr(c, "symbol", None) or term.upper(),
                 "name": getattr(c, "symbol", None) or term.upper(),
                 "secType": getattr(c, "secType", None) or "STK",
@@ -1487,7 +3185,7 @@ async def search(q: str | None = Query(None), query: str | None = Query(None)):
             # Try FX (EURUSD style)
             try:
                 cfx = await _resolve_contract(term, "FX", "IDEALPRO", "USD")
-                uniq.append({
+                fallback.append({
                     "symbol": getattr(cfx, "localSymbol", None) or getattr(cfx, "symbol", None) or term.upper(),
                     "name": getattr(cfx, "symbol", None) or term.upper(),
                     "secType": getattr(cfx, "secType", None) or "FX",
@@ -1497,31 +3195,93 @@ async def search(q: str | None = Query(None), query: str | None = Query(None)):
                 })
             except Exception:
                 pass
+        uniq.extend(fallback)
         if not uniq:
             log.warning("search: no online hits for '%s' (likely timeout/slow gateway); returned heuristics/local", term)
 
-    # cache results under multiple keys (term, alias variants, and result tokens)
-    try:
-        cache = _cache_read("search_cache.json", {})
-        if not isinstance(cache, dict): cache = {}
-        keys = set()
-        keys.add(term.strip())
-        for v in _alias_variants(term):
-            keys.add(v)
-        # index by symbol and name tokens to make offline contains() hit later
-        for r in uniq[:50]:
-            sym = (r.get("symbol") or "")
-            if sym: keys.add(sym)
-            name = (r.get("name") or r.get("description") or "")
-            for t in re.split(r"[^A-Za-z0-9]+", str(name)):
-                if len(t) >= 3:
-                    keys.add(t)
-        for k in keys:
-            cache[str(k)] = uniq[:50]
-        _cache_write("search_cache.json", cache)
-    except Exception:
-        pass
-    return uniq[:50]
+    # feed IB-backed rows into the local index so the next lookup is instant
+    _search_index().add_many(r for r in uniq if r.get("conId"))
+
+    # one term entry + the rows IB itself returned, in result order; a negative
+    # entry only when IB answered the name search and had nothing
+    if ask_ib:
+        from_ib = {r["conId"]: r for r in out_online + fallback if r.get("conId")}
+        ib_rows = [from_ib[r["conId"]] for r in uniq[:50] if r.get("conId") in from_ib]
+        if ib_rows or ib_status["answered"]:
+            _SEARCH_STORE.put(term, ib_rows)
+    return uniq[:50]
+
+@router.get("/search")
+async def search(q: str | None = Query(None), query: str | None = Query(None)):
+    term = (q or query or "").strip()
+    if not term:
+        return []
+    return await _search_run(term)
+
+# typeahead session id -> running search task (a newer query cancels the older one)
+SEARCH_SESSIONS: dict[str, asyncio.Task] = {}
+
+@router.get("/search/stream")
+async def search_stream(
+    request: Request,
+    q: str | None = Query(None),
+    query: str | None = Query(None),
+    session: str | None = Query(None),
+):
+    """
+    Server-Sent Events typeahead search. Emits:
+      event: results
+      data: { term, phase: 'local'|'resolve'|'match'|'final', rows: [...] }
+    'local' (universe/index/stored rows) arrives immediately; IB batches follow
+    as they complete, then one 'final' and an 'event: done'.
+    Pass the same `session` for every keystroke: a newer query cancels the
+    in-flight IB work of the previous one. Disconnecting cancels it as well.
+    """
+    term = (q or query or "").strip()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def _emit(phase: str, rows: list[dict]):
+        await queue.put(("results", {"term": term, "phase": phase, "rows": rows}))
+
+    async def _produce():
+        try:
+            rows = await _search_run(term, emit=_emit, min_results=25) if term else []
+            await _emit("final", rows)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("search stream failed for '%s': %s", term, e)
+        finally:
+            queue.put_nowait(("done", {"term": term}))
+
+    if session:
+        prev = SEARCH_SESSIONS.get(session)
+        if prev is not None and not prev.done():
+            prev.cancel()
+    task = asyncio.get_running_loop().create_task(_produce())
+    if session:
+        SEARCH_SESSIONS[session] = task
+
+    async def _gen():
+        try:
+            while True:
+                try:
+                    ev, item = await asyncio.wait_for(queue.get(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    continue
+                yield f"event: {ev}\ndata: {json.dumps(item, separators=(',',':'))}\n\n"
+                if ev == "done":
+                    return
+        except asyncio.CancelledError:
+            return
+        finally:
+            if not task.done():
+                task.cancel()
+            if session and SEARCH_SESSIONS.get(session) is task:
+                SEARCH_SESSIONS.pop(session, None)
+    return StreamingResponse(_gen(), media_type="text/event-stream")
 
 # --- quotes (last/bid/ask/high/low/close) ----------------------------------
 @router.get("/quote")
@@ -1540,76 +3300,40 @@ async def quote(
         if cached is not None:
             return cached
         # return an empty skeleton
-        return {"conId": conId, "symbol": symbol, "last": None, "close": None, "bid": None, "ask": None,
-                "high": None, "low": None, "time": None}
+        return _quote_empty(conId, symbol)
 
     c = _mk_contract(symbol, conId, exchange, secType, currency)
-    # Always attempt qualification when conId path is used to ensure exch/ccy
-    if conId and (not getattr(c, "exchange", None) or not getattr(c, "currency", None)):
-        try:
-            [c] = await ib.qualifyContractsAsync(c)
-        except Exception:
-            pass
+    # Qualify (contract store first) so we have a conId and exch/ccy
+    if not getattr(c, "conId", None) or not getattr(c, "exchange", None) or not getattr(c, "currency", None):
+        c = await _qualify(c)
 
-    # 1) Try fast snapshot tickers
+    # 1) Live streaming line (warm lines answer immediately; covers delayed data too)
     try:
-        tkrs = await ib.reqTickersAsync(c)
-        t = tkrs[0] if tkrs else None
+        t = await _mkt_ticker(c, "", ("last", "close", "bid", "ask", "delayedLast", "delayedBid", "delayedAsk", "delayedClose"))
     except Exception:
         t = None
 
-    # 2) Snapshot path with short polling (covers delayed data)
-    if not t or all(getattr(t, f, None) is None for f in ("last", "close", "bid", "ask", "high", "low")):
-        tkr = ib.reqMktData(c, snapshot=True)
-        # short poll up to ~1.5s
-        for _ in range(6):
-            await asyncio.sleep(0.25)
-            t = next((x for x in ib.tickers() if getattr(x.contract, "conId", None) == getattr(c, "conId", None)), None)
-            if t and any(getattr(t, f, None) is not None for f in ("last", "close", "bid", "ask", "delayedLast", "delayedBid", "delayedAsk", "delayedClose")):
-                break
+    # 2) No line available (all in use): one-off snapshot tickers
+    if t is None:
         try:
-            ib.cancelMktData(c)
+            tkrs = await _req_tickers(c)
+            t = tkrs[0] if tkrs else None
         except Exception:
-            pass
-
-    def pick_live_or_delayed(obj, live, delayed):
-        v = getattr(obj, live, None)
-        if v is None:
-            v = getattr(obj, delayed, None)
-        return _num_or_none(v)
+            t = None
 
     if not t:
-        out = {
-            "conId": getattr(c, "conId", None),
-            "symbol": getattr(c, "localSymbol", None) or getattr(c, "symbol", None),
-            "last": None, "close": None, "bid": None, "ask": None,
-            "high": None, "low": None, "time": None,
-        }
+        out = _quote_empty(getattr(c, "conId", None), getattr(c, "localSymbol", None) or getattr(c, "symbol", None))
         _cache_write(cache_key, out)
         return out
 
-    out = {
-        "conId": getattr(t.contract, "conId", None),
-        "symbol": getattr(t.contract, "localSymbol", None) or t.contract.symbol,
-        "last": pick_live_or_delayed(t, "last", "delayedLast"),
-        "close": pick_live_or_delayed(t, "close", "delayedClose"),
-        "bid": pick_live_or_delayed(t, "bid", "delayedBid"),
-        "ask": pick_live_or_delayed(t, "ask", "delayedAsk"),
-        "high": _num_or_none(getattr(t, "high", None)),
-        "low": _num_or_none(getattr(t, "low", None)),
-        "time": util.formatIBDatetime(getattr(t, "time", None)) if getattr(t, "time", None) else None,
-    }
+    out = _quote_from_ticker(t)
         # Historical fallback if L1 is entirely empty (protects against null bid/ask/last/close)
     if not any([out["last"], out["bid"], out["ask"], out["close"], out["high"], out["low"]]):
         try:
-            bars = await ib.reqHistoricalDataAsync(
-                c,
-                endDateTime="",
-                durationStr="1 D",
-                barSizeSetting="5 mins",
-                whatToShow=("MIDPOINT" if (getattr(c, "secType", "STK").upper() in ("CASH","FX","IND")) else "TRADES"),
-                useRTH=False,
-                formatDate=2,
+            bars = await _req_history(
+                c, "1 D", "5 mins",
+                ("MIDPOINT" if (getattr(c, "secType", "STK").upper() in ("CASH","FX","IND")) else "TRADES"),
+                False,
             )
             if bars:
                 tail = bars[-1]
@@ -1619,7 +3343,115 @@ async def quote(
         except Exception:
             pass
 
-    # --- Sticky cache merge: never let a spurious null overwrite good values ---
+    return _quote_sticky(cache_key, out)
+
+QUOTES_MAX = 200
+
+@router.get("/quotes")
+async def quotes(conIds: str = Query(..., description="comma-separated conIds")):
+    """
+    Batch L1 quotes for a watchlist: warm streaming lines answer directly, the
+    rest are qualified in one qualifyContractsAsync and snapshotted in one
+    reqTickersAsync. Same row shape and sticky cache as /quote.
+    """
+    return {"quotes": await _quotes_batch(_parse_conids(conIds))}
+
+@router.post("/quotes")
+async def quotes_post(payload: dict | list = Body(...)):
+    """Body: { "conIds": [265598, 8314, ...] } or a bare list of conIds."""
+    raw = payload.get("conIds") if isinstance(payload, dict) else payload
+    return {"quotes": await _quotes_batch(_parse_conids(raw))}
+
+def _parse_conids(raw) -> list[int]:
+    items = str(raw or "").split(",") if not isinstance(raw, (list, tuple)) else raw
+    out: list[int] = []
+    for x in items:
+        try:
+            cid = int(str(x).strip())
+        except Exception:
+            continue
+        if cid > 0 and cid not in out:
+            out.append(cid)
+    if not out:
+        raise HTTPException(400, "conIds required")
+    if len(out) > QUOTES_MAX:
+        raise HTTPException(400, f"at most {QUOTES_MAX} conIds per request")
+    return out
+
+async def _quotes_batch(cids: list[int]) -> list[dict]:
+    keys = {cid: f"quote-{_safe_name(str(cid))}.json" for cid in cids}
+    try:
+        await _ensure_connected()
+    except Exception:
+        return [_cache_read(keys[cid], None) or _quote_empty(cid, None) for cid in cids]
+
+    # contracts: store hits are free; the unknowns go to IB in one qualify call
+    contracts: dict[int, Contract] = {}
+    unknown: list[Contract] = []
+    for cid in cids:
+        e = _CONTRACTS.get(cid)
+        if e:
+            contracts[cid] = _contract_from_dict(e["c"])
+        else:
+            unknown.append(Contract(conId=cid))
+    if unknown:
+        try:
+            for qc in await _IB_SCHED.run("details", lambda: ib.qualifyContractsAsync(*unknown)) or []:
+                if getattr(qc, "conId", 0):
+                    _CONTRACTS.put_contract(qc)
+                    contracts[int(qc.conId)] = qc
+        except Exception:
+            pass
+
+    # tickers: warm streaming lines first, one reqTickersAsync for the rest
+    fields = ("last", "close", "bid", "ask", "delayedLast", "delayedClose")
+    tickers: dict[int, Any] = {}
+    cold: list[Contract] = []
+    for cid, c in contracts.items():
+        t = _MKT.ticker(cid)
+        if t is not None and any(_tick_has(t, f) for f in fields):
+            tickers[cid] = t
+        else:
+            cold.append(c)
+    if cold:
+        try:
+            for t in await _IB_SCHED.run("mktdata", lambda: ib.reqTickersAsync(*cold)) or []:
+                cid = int(getattr(getattr(t, "contract", None), "conId", 0) or 0)
+                if cid:
+                    tickers[cid] = t
+        except Exception:
+            pass
+
+    rows = []
+    for cid in cids:
+        t = tickers.get(cid)
+        c = contracts.get(cid)
+        out = _quote_from_ticker(t) if t is not None else \
+            _quote_empty(cid, (getattr(c, "localSymbol", None) or getattr(c, "symbol", None)) if c else None)
+        rows.append(_quote_sticky(keys[cid], out))
+    return rows
+
+def _quote_empty(conId, symbol) -> dict:
+    return {"conId": conId, "symbol": symbol, "last": None, "close": None, "bid": None, "ask": None,
+            "high": None, "low": None, "time": None}
+
+def _quote_from_ticker(t) -> dict:
+    def pick_live_or_delayed(obj, live, delayed):
+        return _num_or_none(getattr(obj, live, None) if _tick_has(obj, live) else getattr(obj, delayed, None))
+    return {
+        "conId": getattr(t.contract, "conId", None),
+        "symbol": getattr(t.contract, "localSymbol", None) or t.contract.symbol,
+        "last": pick_live_or_delayed(t, "last", "delayedLast"),
+        "close": pick_live_or_delayed(t, "close", "delayedClose"),
+        "bid": pick_live_or_delayed(t, "bid", "delayedBid"),
+        "ask": pick_live_or_delayed(t, "ask", "delayedAsk"),
+        "high": _num_or_none(getattr(t, "high", None)),
+        "low": _num_or_none(getattr(t, "low", None)),
+        "time": util.formatIBDatetime(getattr(t, "time", None)) if getattr(t, "time", None) else None,
+    }
+
+def _quote_sticky(cache_key: str, out: dict) -> dict:
+    """Sticky cache merge: never let a spurious null overwrite good values."""
     try:
         prev = _cache_read(cache_key, None)
         if isinstance(prev, dict):
@@ -1631,7 +3463,6 @@ async def quote(
                 out["symbol"] = prev["symbol"]
     except Exception:
         pass
-    
     _cache_write(cache_key, out)
     return out
 
@@ -1651,7 +3482,7 @@ async def contract_base(
     await _ensure_connected()
     c = _mk_contract(symbol, conId, exchange, secType, currency)
     try:
-        cds = await ib.reqContractDetailsAsync(c)
+        cds = await _details_for(c)
         if not cds:
             raise HTTPException(404, "No contract details found")
         cd = cds[0]
@@ -1681,97 +3512,486 @@ async def contract_base(
         raise HTTPException(502, f"contract lookup failed: {e!s}")
 
 # ==========================
-# Level 2 (DOM) ring buffers
+# Level 2 (DOM) order books
 # ==========================
-# State per conId
-DEPTH_STATE: dict[int, dict] = {}               # conId -> {"bids":[...], "asks":[...], "ts": int}
-DEPTH_TICKER: dict[int, Any] = {}               # conId -> Ticker
-DEPTH_LASTLEN: dict[int, tuple[int,int]] = {}   # conId -> (lenBids, lenAsks) to detect changes
-DEPTH_SUBS: dict[int, set[asyncio.Queue]] = defaultdict(set)  # conId -> set of subscriber queues
-
-def _depth_snapshot_from_tkr(tkr, depth: int) -> dict:
-    bids, asks = [], []
-    for lvl in (getattr(tkr, "domBids", None) or [])[:depth]:
-        bids.append({"price": _num_or_none(getattr(lvl, "price", None)),
-                     "size": _num_or_none(getattr(lvl, "size", None)),
-                     "mm": getattr(lvl, "marketMaker", None)})
-    for lvl in (getattr(tkr, "domAsks", None) or [])[:depth]:
-        asks.append({"price": _num_or_none(getattr(lvl, "price", None)),
-                     "size": _num_or_none(getattr(lvl, "size", None)),
-                     "mm": getattr(lvl, "marketMaker", None)})
-    return {"bids": bids, "asks": asks, "ts": int(time.time())}
-
-async def _ensure_depth_subscribed(conId: int, depth: int, smart: bool):
-    await _ensure_connected()
-    if conId in DEPTH_TICKER:
-        return
-    c = await _contract_from_conid(conId)
-    tkr = ib.reqMktDepth(c, numRows=max(1, min(20, depth)), isSmartDepth=bool(smart))
-    DEPTH_TICKER[conId] = tkr
-    DEPTH_LASTLEN[conId] = (-1, -1)
-    # prime a snapshot quickly
-    await asyncio.sleep(0.25)
-    DEPTH_STATE[conId] = _depth_snapshot_from_tkr(tkr, depth)
-    def _on_update(_):
-        try:
-            b = getattr(tkr, "domBids", None) or []
-            a = getattr(tkr, "domAsks", None) or []
-            lastB, lastA = DEPTH_LASTLEN.get(conId, (-1,-1))
-            if len(b) == lastB and len(a) == lastA:
-                # still may have price/size changes; always rebuild small snapshot
+# Books are maintained incrementally from IB's updateMktDepth operations
+# (ticker.domTicks: insert/update/delete by position) instead of re-reading
+# domBids/domAsks on every update. A per-book publisher coalesces changes
+# and fans out level diffs (with a sequence number) or full snapshots.
+DEPTH_COALESCE_MS = float(os.getenv("IB_DEPTH_COALESCE_MS", "100"))   # publish interval
+DEPTH_SNAPSHOT_S = float(os.getenv("IB_DEPTH_SNAPSHOT_S", "5"))       # full snapshot cadence for diff subscribers
+DEPTH_MAX_ROWS = 20
+
+class _OrderBook:
+    """
+    One side = list of [price, size, mm]. Running size sums per side back the
+    imbalance stat; best levels back spread/microprice. Positions touched since
+    the last publish are tracked per side (insert/delete dirty the tail).
+    """
+    __slots__ = ("conId", "depth", "smart", "tkr", "bids", "asks", "sums", "dirty",
+                 "seq", "ts", "stats", "subs", "resync", "task", "last_snap", "rec")
+
+    def __init__(self, conId: int, depth: int, smart: bool):
+        self.conId = int(conId)
+        self.depth = max(1, min(DEPTH_MAX_ROWS, int(depth)))
+        self.smart = bool(smart)
+        self.tkr = None
+        self.bids: list[list] = []
+        self.asks: list[list] = []
+        self.sums = [0.0, 0.0]                 # bid, ask
+        self.dirty: tuple[set, set] = (set(), set())
+        self.seq = 0
+        self.ts = 0.0
+        self.stats: dict = {}
+        self.subs: dict[asyncio.Queue, str] = {}   # queue -> "diff" | "snapshot"
+        self.resync: set[asyncio.Queue] = set()
+        self.task: asyncio.Task | None = None
+        self.last_snap = 0.0
+        self.rec: "_DepthRecorder | None" = None
+
+    # ---- maintenance ----
+    def reset_from(self, tkr) -> None:
+        """Full rebuild from the ticker's DOM lists (seed / resync)."""
+        for i, (src, side) in enumerate(((getattr(tkr, "domBids", None), self.bids),
+                                         (getattr(tkr, "domAsks", None), self.asks))):
+            side[:] = [[_num_or_none(getattr(l, "price", None)),
+                        _num_or_none(getattr(l, "size", None)) or 0.0,
+                        getattr(l, "marketMaker", None)] for l in (src or [])]
+            self.sums[i] = float(sum(l[1] for l in side))
+            self.dirty[i].update(range(len(side) + 1))
+        self.ts = time.time()
+        self._stats()
+
+    def apply(self, pos: int, op: int, isBid: bool, price, size, mm=None) -> None:
+        i = 0 if isBid else 1
+        side = self.bids if isBid else self.asks
+        size = float(size or 0.0)
+        if op == 0:                                   # insert
+            pos = min(pos, len(side))
+            side.insert(pos, [price, size, mm])
+            self.sums[i] += size
+            self.dirty[i].update(range(pos, len(side)))
+        elif op == 1 and pos < len(side):             # update
+            self.sums[i] += size - side[pos][1]
+            side[pos] = [price, size, mm]
+            self.dirty[i].add(pos)
+        elif op == 1:                                 # update past the end == append
+            self.apply(len(side), 0, isBid, price, size, mm)
+            return
+        elif op == 2 and pos < len(side):             # delete
+            self.sums[i] -= side.pop(pos)[1]
+            self.dirty[i].update(range(pos, len(side) + 1))
+        else:
+            return
+        self.ts = time.time()
+        if pos == 0:
+            self._stats()
+        else:
+            self._imbalance()
+
+    def on_update(self, tkr) -> None:
+        ticks = getattr(tkr, "domTicks", None)
+        if ticks is None:
+            # no op log on this ticker (older/newer ib_insync): rebuild
+            self.reset_from(tkr)
+            return
+        for t in ticks:
+            try:
+                self.apply(int(t.position), int(t.operation), int(t.side) == 1,
+                           _num_or_none(t.price), _num_or_none(t.size), getattr(t, "marketMaker", None))
+            except Exception:
                 pass
-            DEPTH_LASTLEN[conId] = (len(b), len(a))
-            snap = _depth_snapshot_from_tkr(tkr, depth)
-            DEPTH_STATE[conId] = snap
-            # fan out to subscribers (non-blocking)
-            for q in list(DEPTH_SUBS.get(conId, set())):
-                try: q.put_nowait({"conId": conId, **snap})
-                except asyncio.QueueFull: pass
-        except Exception:
+        # cheap consistency check: the op stream must reproduce IB's own lists
+        b, a = getattr(tkr, "domBids", None), getattr(tkr, "domAsks", None)
+        if b is not None and a is not None and (len(b) != len(self.bids) or len(a) != len(self.asks)):
+            self.reset_from(tkr)
+
+    # ---- derived stats ----
+    def _imbalance(self) -> None:
+        tot = self.sums[0] + self.sums[1]
+        self.stats["imbalance"] = round((self.sums[0] - self.sums[1]) / tot, 6) if tot > 0 else None
+
+    def _stats(self) -> None:
+        bb = self.bids[0] if self.bids else None
+        ba = self.asks[0] if self.asks else None
+        spread = mid = micro = None
+        if bb and ba and bb[0] is not None and ba[0] is not None:
+            spread = ba[0] - bb[0]
+            mid = (ba[0] + bb[0]) / 2.0
+            qs = bb[1] + ba[1]
+            micro = (bb[0] * ba[1] + ba[0] * bb[1]) / qs if qs > 0 else mid
+        self.stats = {"spread": spread, "mid": mid, "microprice": micro}
+        self._imbalance()
+
+    # ---- views ----
+    def _levels(self, side: list) -> list[dict]:
+        return [{"price": p, "size": s, "mm": mm} for p, s, mm in side[:self.depth]]
+
+    def snapshot(self) -> dict:
+        return {"conId": self.conId, "seq": self.seq, "bids": self._levels(self.bids),
+                "asks": self._levels(self.asks), "stats": dict(self.stats), "ts": int(self.ts or time.time())}
+
+    def _side_diff(self, i: int) -> dict | None:
+        d = self.dirty[i]
+        if not d:
+            return None
+        side = self.bids if i == 0 else self.asks
+        n = min(len(side), self.depth)
+        lv = [[p] + side[p] for p in sorted(d) if p < n]
+        d.clear()
+        return {"len": n, "levels": lv}
+
+    # ---- publishing ----
+    def _push(self, q: asyncio.Queue, item: dict) -> bool:
+        try:
+            q.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def publish(self, now: float) -> None:
+        if not (self.dirty[0] or self.dirty[1]) and not self.resync and now - self.last_snap < DEPTH_SNAPSHOT_S:
+            return
+        changed = bool(self.dirty[0] or self.dirty[1])
+        diff = None
+        if changed:
+            self.seq += 1
+            diff = {"conId": self.conId, "seq": self.seq, "bids": self._side_diff(0),
+                    "asks": self._side_diff(1), "stats": dict(self.stats), "ts": int(self.ts)}
+        periodic = now - self.last_snap >= DEPTH_SNAPSHOT_S
+        want = periodic or self.resync or (changed and any(m == "snapshot" for m in self.subs.values()))
+        snap = self.snapshot() if want else None
+        if periodic:
+            self.last_snap = now
+        if self.rec is not None:
+            self.rec.on_publish(self, diff, now)
+        for q, mode in list(self.subs.items()):
+            if mode == "snapshot":
+                if changed and not self._push(q, {"event": "depth", **snap}):
+                    self.resync.add(q)
+                continue
+            if q in self.resync or periodic:
+                # a full book supersedes anything the subscriber may have missed
+                if self._push(q, {"event": "snapshot", **snap}):
+                    self.resync.discard(q)
+                else:
+                    self.resync.add(q)
+            elif diff is not None and not self._push(q, {"event": "diff", **diff}):
+                self.resync.add(q)
+
+    async def run(self) -> None:
+        try:
+            while self.subs or self.rec is not None:
+                self.publish(time.time())
+                await asyncio.sleep(max(0.01, DEPTH_COALESCE_MS / 1000.0))
+        except asyncio.CancelledError:
             pass
+
+DEPTH_BOOKS: dict[int, _OrderBook] = {}          # conId -> live book
+
+async def _ensure_depth_subscribed(conId: int, depth: int, smart: bool) -> _OrderBook:
+    await _ensure_connected()
+    book = DEPTH_BOOKS.get(conId)
+    if book is not None:
+        return book
+    book = DEPTH_BOOKS[conId] = _OrderBook(conId, depth, smart)
+    try:
+        c = await _contract_from_conid(conId)
+        tkr = ib.reqMktDepth(c, numRows=book.depth, isSmartDepth=bool(smart))
+    except Exception:
+        DEPTH_BOOKS.pop(conId, None)
+        raise
+    book.tkr = tkr
+    book.reset_from(tkr)
+    def _on_update(t):
+        try: book.on_update(t)
+        except Exception: pass
     tkr.updateEvent += _on_update
+    # first levels usually arrive within a few hundred ms; give the initial snapshot a chance
+    deadline = time.time() + 0.25
+    while not (book.bids or book.asks) and time.time() < deadline:
+        await asyncio.sleep(0.05)
+    return book
 
 def _maybe_unsubscribe_depth(conId: int):
-    if DEPTH_SUBS.get(conId):
+    book = DEPTH_BOOKS.get(conId)
+    if book is None or book.subs or book.rec is not None:
         return
-    tkr = DEPTH_TICKER.pop(conId, None)
-    DEPTH_LASTLEN.pop(conId, None)
-    if tkr:
-        try: ib.cancelMktDepth(tkr.contract)
+    DEPTH_BOOKS.pop(conId, None)
+    if book.task and not book.task.done():
+        book.task.cancel()
+    if book.tkr is not None:
+        try: ib.cancelMktDepth(book.tkr.contract, isSmartDepth=book.smart)
         except Exception: pass
 
 @router.get("/marketdepth/stream")
-async def market_depth_stream(conId: int, depth: int = 10, smart: bool = True, poll_keepalive: float = 20.0):
+async def market_depth_stream(conId: int, depth: int = 10, smart: bool = True, mode: str = "diff",
+                              poll_keepalive: float = 20.0):
     """
-    SSE of DOM snapshots. Emits:
-      event: depth
-      data: { conId, bids:[{price,size,mm}], asks:[...], ts }
-    Sends an initial snapshot, then live updates.
+    SSE of the DOM. Updates are coalesced every IB_DEPTH_COALESCE_MS.
+      mode=diff (default):
+        event: snapshot  data: { conId, seq, bids:[{price,size,mm}], asks:[...], stats, ts }
+        event: diff      data: { conId, seq, bids:{len, levels:[[pos,price,size,mm],...]}|null, asks:..., stats, ts }
+        Apply a diff by writing each level at `pos` and truncating the side to `len`.
+        A snapshot is resent every IB_DEPTH_SNAPSHOT_S and whenever the client fell behind.
+      mode=snapshot:
+        event: depth     data: full book (as snapshot) on every coalesced change.
+    stats = { spread, mid, microprice, imbalance } (imbalance over all subscribed levels).
     """
-    await _ensure_depth_subscribed(conId, depth, smart)
+    mode = (mode or "diff").lower()
+    if mode not in ("diff", "snapshot"):
+        raise HTTPException(400, "mode must be diff or snapshot")
+    book = await _ensure_depth_subscribed(conId, depth, smart)
     q: asyncio.Queue = asyncio.Queue(maxsize=200)
-    DEPTH_SUBS[conId].add(q)
+    book.subs[q] = mode
+    if book.task is None or book.task.done():
+        book.task = asyncio.get_running_loop().create_task(book.run())
     async def _gen():
-        # initial
-        snap = DEPTH_STATE.get(conId) or {"bids": [], "asks": [], "ts": int(time.time())}
-        yield f"event: depth\ndata: {json.dumps({'conId': conId, **snap}, separators=(',',':'))}\n\n"
-        last_keep = time.time()
+        snap = book.snapshot()
+        yield f"event: {'snapshot' if mode == 'diff' else 'depth'}\ndata: {json.dumps(snap, separators=(',',':'))}\n\n"
+        last_seq = snap["seq"]
         try:
             while True:
                 try:
                     item = await asyncio.wait_for(q.get(), timeout=max(5.0, float(poll_keepalive)))
-                    yield f"event: depth\ndata: {json.dumps(item, separators=(',',':'))}\n\n"
-                    last_keep = time.time()
+                    ev = item.pop("event", "depth")
+                    if ev == "diff" and item["seq"] <= last_seq:
+                        continue   # already covered by the initial snapshot
+                    last_seq = item["seq"]
+                    yield f"event: {ev}\ndata: {json.dumps(item, separators=(',',':'))}\n\n"
                 except asyncio.TimeoutError:
                     # periodic keepalive to keep proxies happy
                     yield f": keepalive {int(time.time())}\n\n"
         except asyncio.CancelledError:
             return
         finally:
-            DEPTH_SUBS[conId].discard(q)
+            book.subs.pop(q, None)
+            book.resync.discard(q)
             _maybe_unsubscribe_depth(conId)
     return StreamingResponse(_gen(), media_type="text/event-stream")
 
+# --- DOM recorder ------------------------------------------------------------
+# Optional per-conId recording of the coalesced book stream. Records are packed
+# into blocks that always open with a keyframe (full book) followed by level
+# diffs; each block is zlib-compressed and appended to a per-day .dbk file,
+# with its time range and offset appended to a sibling .idx so replay can seek
+# straight to the nearest keyframe. Compression and file I/O run on the disk
+# writer thread; the oldest day files are pruned to stay within the budget.
+DEPTH_REC_DIR = RUNTIME / "depth"
+DEPTH_REC_BUDGET = int(float(os.getenv("IB_DEPTH_REC_BUDGET_MB", "512")) * 1024 * 1024)
+DEPTH_REC_KEYFRAME_S = float(os.getenv("IB_DEPTH_REC_KEYFRAME_S", "30"))   # max block span
+DEPTH_REC_BLOCK = 256 * 1024                                               # max raw block size
+_DBK_MAGIC = b"DBK1"
+_DBK_HDR = struct.Struct("<4sddIII")     # magic, t_first, t_last, records, raw_len, comp_len
+_DBK_IDX = struct.Struct("<ddQ")         # t_first, t_last, offset of block header in .dbk
+_DBK_KEY = struct.Struct("<BdIHH")       # 0, ts, seq, nBids, nAsks        + levels <dd>
+_DBK_DIFF = struct.Struct("<BdIHHHH")    # 1, ts, seq, lenB, cntB, lenA, cntA + levels <Hdd>
+_DBK_LVL = struct.Struct("<dd")
+_DBK_DLVL = struct.Struct("<Hdd")
+_DBK_SAME = 0xFFFF                       # side length marker: side unchanged in this diff
+_DEPTH_REC_USED: list[int | None] = [None]   # bytes on disk; owned by the writer thread
+
+def _dbk_f(v) -> float:
+    return math.nan if v is None else float(v)
+
+def _dbk_path(conId: int, ts: float, ext: str) -> Path:
+    return DEPTH_REC_DIR / str(int(conId)) / f"{time.strftime('%Y%m%d', time.gmtime(ts))}.{ext}"
+
+def _depth_rec_prune(keep: Path, need: int) -> None:
+    """Writer thread: delete the oldest day files until `need` more bytes fit the budget."""
+    if _DEPTH_REC_USED[0] is None:
+        _DEPTH_REC_USED[0] = sum(p.stat().st_size for p in DEPTH_REC_DIR.rglob("*.*") if p.is_file())
+    if _DEPTH_REC_USED[0] + need <= DEPTH_REC_BUDGET:
+        return
+    days = sorted((p for p in DEPTH_REC_DIR.rglob("*.dbk") if p != keep), key=lambda p: p.name)
+    for p in days:
+        if _DEPTH_REC_USED[0] + need <= DEPTH_REC_BUDGET:
+            break
+        for f in (p, p.with_suffix(".idx")):
+            h = _DISK._files.pop(f, None)
+            try:
+                if h is not None:
+                    h.close()
+                _DEPTH_REC_USED[0] -= f.stat().st_size
+                f.unlink()
+            except Exception:
+                pass
+
+class _DepthRecorder:
+    __slots__ = ("conId", "buf", "n", "t_first", "t_last", "started", "blocks", "raw", "dropped")
+
+    def __init__(self, conId: int):
+        self.conId = int(conId)
+        self.buf = bytearray()
+        self.n = 0
+        self.t_first = self.t_last = 0.0
+        self.started = time.time()
+        self.blocks = 0
+        self.raw = 0
+        self.dropped = 0
+
+    def on_publish(self, book: "_OrderBook", diff: dict | None, now: float) -> None:
+        if self.buf and (now - self.t_first >= DEPTH_REC_KEYFRAME_S or len(self.buf) >= DEPTH_REC_BLOCK):
+            self.flush()
+        if not self.buf:
+            if not (book.bids or book.asks):
+                return
+            # keyframe: already reflects `diff`, so the diff itself is not stored
+            bids, asks = book.bids[:book.depth], book.asks[:book.depth]
+            self.buf += _DBK_KEY.pack(0, now, book.seq, len(bids), len(asks))
+            for p, sz, _ in bids + asks:
+                self.buf += _DBK_LVL.pack(_dbk_f(p), _dbk_f(sz))
+            self.t_first = now
+        elif diff is not None:
+            b, a = diff["bids"] or {}, diff["asks"] or {}
+            bl, al = b.get("levels", ()), a.get("levels", ())
+            self.buf += _DBK_DIFF.pack(1, now, diff["seq"], b.get("len", _DBK_SAME), len(bl),
+                                       a.get("len", _DBK_SAME), len(al))
+            for pos, p, sz, _ in list(bl) + list(al):
+                self.buf += _DBK_DLVL.pack(pos, _dbk_f(p), _dbk_f(sz))
+        else:
+            return
+        self.n += 1
+        self.t_last = now
+
+    def flush(self) -> None:
+        if not self.buf:
+            return
+        raw, n, t0, t1 = bytes(self.buf), self.n, self.t_first, self.t_last
+        self.buf = bytearray()
+        self.n = 0
+        self.blocks += 1
+        self.raw += len(raw)
+        conId = self.conId
+        def _write() -> None:
+            dbk, idx = _dbk_path(conId, t0, "dbk"), _dbk_path(conId, t0, "idx")
+            comp = zlib.compress(raw, 6)
+            need = _DBK_HDR.size + len(comp) + _DBK_IDX.size
+            _depth_rec_prune(dbk, need)
+            if _DEPTH_REC_USED[0] + need > DEPTH_REC_BUDGET:
+                self.dropped += 1
+                return
+            f = _DISK._handle(dbk)
+            off = f.tell()
+            f.write(_DBK_HDR.pack(_DBK_MAGIC, t0, t1, n, len(raw), len(comp)) + comp)
+            f.flush()
+            g = _DISK._handle(idx)
+            g.write(_DBK_IDX.pack(t0, t1, off))
+            g.flush()
+            _DEPTH_REC_USED[0] += need
+        _DISK.call(_write)
+
+    def status(self) -> dict:
+        return {"conId": self.conId, "since": int(self.started), "blocks": self.blocks,
+                "rawBytes": self.raw + len(self.buf), "pending": self.n, "dropped": self.dropped}
+
+def _dbk_apply(data: bytes, at: float, state: dict) -> None:
+    """Replay one decompressed block into state={bids,asks,seq,ts} up to `at`."""
+    off, end = 0, len(data)
+    while off < end:
+        kind = data[off]
+        if kind == 0:
+            _, ts, seq, nb, na = _DBK_KEY.unpack_from(data, off)
+            if ts > at:
+                return
+            off += _DBK_KEY.size
+            lv = [list(x) for x in _DBK_LVL.iter_unpack(data[off:off + (nb + na) * _DBK_LVL.size])]
+            off += (nb + na) * _DBK_LVL.size
+            state["bids"], state["asks"] = lv[:nb], lv[nb:]
+        else:
+            _, ts, seq, lb, cb, la, ca = _DBK_DIFF.unpack_from(data, off)
+            if ts > at:
+                return
+            off += _DBK_DIFF.size
+            for side, ln, cnt in (("bids", lb, cb), ("asks", la, ca)):
+                levels = state[side]
+                for pos, p, sz in _DBK_DLVL.iter_unpack(data[off:off + cnt * _DBK_DLVL.size]):
+                    while len(levels) <= pos:
+                        levels.append([math.nan, 0.0])
+                    levels[pos] = [p, sz]
+                off += cnt * _DBK_DLVL.size
+                if ln != _DBK_SAME:
+                    del levels[ln:]
+        state["seq"], state["ts"] = seq, ts
+
+def _dbk_replay(conId: int, at: float, lookback_days: int = 7) -> dict | None:
+    """Find the last block starting at or before `at` (via the .idx files) and replay it."""
+    day = int(at // 86400) * 86400
+    for _ in range(max(1, lookback_days)):
+        idx, dbk = _dbk_path(conId, day, "idx"), _dbk_path(conId, day, "dbk")
+        day -= 86400
+        if not (idx.exists() and dbk.exists()):
+            continue
+        ents = list(_DBK_IDX.iter_unpack(idx.read_bytes()[:idx.stat().st_size // _DBK_IDX.size * _DBK_IDX.size]))
+        i = bisect.bisect_right([e[0] for e in ents], at) - 1
+        if i < 0:
+            continue
+        with open(dbk, "rb") as f:
+            f.seek(ents[i][2])
+            magic, t0, t1, n, raw_len, comp_len = _DBK_HDR.unpack(f.read(_DBK_HDR.size))
+            if magic != _DBK_MAGIC:
+                return None
+            data = zlib.decompress(f.read(comp_len))
+        state = {"bids": [], "asks": [], "seq": None, "ts": None, "blockStart": t0, "blockEnd": t1}
+        _dbk_apply(data, at, state)
+        return state
+    return None
+
+@router.post("/marketdepth/record")
+async def market_depth_record(conId: int, on: bool = True, depth: int = DEPTH_MAX_ROWS, smart: bool = True):
+    """
+    Start/stop recording the DOM for conId to runtime/depth (bounded by
+    IB_DEPTH_REC_BUDGET_MB). Recording keeps the depth subscription open.
+    """
+    book = DEPTH_BOOKS.get(conId)
+    if on:
+        if book is None:
+            book = await _ensure_depth_subscribed(conId, depth, smart)
+        if book.rec is None:
+            book.rec = _DepthRecorder(conId)
+        if book.task is None or book.task.done():
+            book.task = asyncio.get_running_loop().create_task(book.run())
+        return {"ok": True, "recording": True, **book.rec.status()}
+    if book is None or book.rec is None:
+        return {"ok": True, "recording": False, "conId": conId}
+    rec, book.rec = book.rec, None
+    rec.flush()
+    _maybe_unsubscribe_depth(conId)
+    return {"ok": True, "recording": False, **rec.status()}
+
+@router.get("/marketdepth/record")
+async def market_depth_record_status():
+    recs = [b.rec.status() for b in DEPTH_BOOKS.values() if b.rec is not None]
+    return {"recording": recs, "budgetBytes": DEPTH_REC_BUDGET, "usedBytes": _DEPTH_REC_USED[0],
+            "keyframeSec": DEPTH_REC_KEYFRAME_S}
+
+@router.get("/marketdepth/replay")
+async def market_depth_replay(conId: int, at: str, depth: int = 10):
+    """
+    Reconstruct the recorded book for conId as of `at` (epoch seconds or ISO):
+    seeks to the last keyframe at or before `at` and applies the diffs after it.
+    """
+    t = _parse_when(at, time.time())
+    rec = (DEPTH_BOOKS.get(conId).rec if conId in DEPTH_BOOKS else None)
+    if rec is not None and rec.buf and rec.t_first <= t:
+        rec.flush()          # the requested moment may still be in the open block
+        done = asyncio.get_running_loop().create_future()
+        _DISK.call(lambda: done.get_loop().call_soon_threadsafe(done.set_result, None))
+        await done
+    state = await asyncio.to_thread(_dbk_replay, int(conId), t)
+    if not state or state["ts"] is None:
+        raise HTTPException(404, "no recorded depth at or before that time")
+    book = _OrderBook(conId, depth, True)
+    book.bids = [[None if math.isnan(p) else p, sz, None] for p, sz in state["bids"]]
+    book.asks = [[None if math.isnan(p) else p, sz, None] for p, sz in state["asks"]]
+    book.sums = [float(sum(l[1] for l in book.bids)), float(sum(l[1] for l in book.asks))]
+    book._stats()
+    n = book.depth
+    return {"conId": conId, "at": t, "ts": state["ts"], "seq": state["seq"],
+            "bids": [{"price": p, "size": sz} for p, sz, _ in book.bids[:n]],
+            "asks": [{"price": p, "size": sz} for p, sz, _ in book.asks[:n]],
+            "stats": book.stats, "keyframeAt": state["blockStart"]}
+
 # ==========================
 # Real-time bars ring buffer
 # ==========================
@@ -1783,7 +4003,7 @@ RTBARS_SUBS: dict[int, set[asyncio.Queue]] = defaultdict(set)            # conId
 def _bar_to_dict(b) -> dict:
     return {
         "t": util.formatIBDatetime(getattr(b, "time", None)) if getattr(b, "time", None) else None,
-        "o": _num_or_none(getattr(b, "open", None)),
+        "o": _num_or_none(getattr(b, "open_", None) if hasattr(b, "open_") else getattr(b, "open", None)),
         "h": _num_or_none(getattr(b, "high", None)),
         "l": _num_or_none(getattr(b, "low", None)),
         "c": _num_or_none(getattr(b, "close", None)),
@@ -1812,6 +4032,7 @@ async def _ensure_rtbars_subscribed(conId: int):
                 for b in bars[last:]:
                     d = _bar_to_dict(b)
                     RTBARS_STATE[conId].append(d)
+                    _bars_on_rtbar(conId, b)
                     for q in list(RTBARS_SUBS.get(conId, set())):
                         try: q.put_nowait({"conId": conId, "bar": d})
                         except asyncio.QueueFull: pass
@@ -1869,10 +4090,76 @@ async def live_bars_stream(conId: int, poll_keepalive: float = 20.0):
 TICKS_SUBS: dict[tuple[int, str], set[asyncio.Queue]] = defaultdict(set)
 # Active subscriptions we requested from IB: (conId, type)
 TICKS_ACTIVE: set[tuple[int, str]] = set()
-# Small last-value cache for replay on connect
-TICKS_LAST: dict[tuple[int, str], dict] = {}
-# NEW: small *history* buffer per (conId,type) so we can serve last-N via HTTP
-TICKS_BUF: dict[tuple[int, str], Deque[dict]] = defaultdict(lambda: deque(maxlen=1000))
+# Fixed-capacity ring per (conId,type): serves last-N via HTTP and the last value for replay
+TICKS_CAP = int(os.getenv("IB_TICKS_CAP", "1000"))
+# type -> (numeric fields, string fields); numerics live in array('d') columns
+_TICK_FIELDS: dict[str, tuple[tuple[str, ...], tuple[str, ...]]] = {
+    "last": (("price", "size"), ("exchange", "specialConditions")),
+    "bidask": (("bid", "bidSize", "ask", "askSize"), ()),
+    "midpoint": (("mid",), ()),
+}
+
+class _TickRing:
+    """
+    Ring buffer of ticks as columns: timestamps and numeric fields in
+    preallocated float64 arrays, string fields in fixed lists. Appending
+    allocates nothing; dicts and ISO strings are built only when a row is
+    serialised.
+    """
+    __slots__ = ("conId", "typ", "cap", "nums", "strs", "ts", "cols", "scols", "pos", "n")
+
+    def __init__(self, conId: int, typ: str, cap: int = TICKS_CAP):
+        self.conId, self.typ, self.cap = conId, typ, max(1, cap)
+        self.nums, self.strs = _TICK_FIELDS[typ]
+        self.ts = array("d", bytes(8 * self.cap))
+        self.cols = [array("d", bytes(8 * self.cap)) for _ in self.nums]
+        self.scols = [[None] * self.cap for _ in self.strs]
+        self.pos = 0   # next write slot
+        self.n = 0
+
+    def __len__(self) -> int:
+        return self.n
+
+    def append(self, ts: float, nums: tuple, strs: tuple = ()) -> int:
+        k = self.pos
+        self.ts[k] = ts
+        for col, v in zip(self.cols, nums):
+            col[k] = math.nan if v is None else v
+        for col, v in zip(self.scols, strs):
+            col[k] = v
+        self.pos = (k + 1) % self.cap
+        if self.n < self.cap:
+            self.n += 1
+        return k
+
+    def segments(self, limit: int) -> list[tuple[int, int]]:
+        """Slot ranges (oldest first) holding the newest `limit` ticks; at most two because of wrap-around."""
+        m = min(max(0, limit), self.n)
+        start = (self.pos - m) % self.cap
+        if m == 0:
+            return []
+        if start + m <= self.cap:
+            return [(start, start + m)]
+        return [(start, self.cap), (0, self.pos)]
+
+    def row(self, k: int) -> dict:
+        ts = self.ts[k]
+        ts_i, dt = _tick_time_to_iso(ts)
+        d: dict[str, Any] = {"conId": self.conId, "type": self.typ}
+        for name, col in zip(self.nums, self.cols):
+            d[name] = _num_or_none(col[k])
+        for name, col in zip(self.strs, self.scols):
+            d[name] = col[k]
+        d["ts"], d["time"] = ts_i, dt
+        return d
+
+    def rows(self, limit: int) -> list[dict]:
+        return [self.row(k) for a, b in self.segments(limit) for k in range(a, b)]
+
+    def last(self) -> dict | None:
+        return self.row((self.pos - 1) % self.cap) if self.n else None
+
+TICKS_BUF: dict[tuple[int, str], _TickRing] = {}
 
 def _tick_time_to_iso(ts: int | float | None) -> tuple[int | None, str | None]:
     try:
@@ -1884,19 +4171,232 @@ def _tick_time_to_iso(ts: int | float | None) -> tuple[int | None, str | None]:
     except Exception:
         return None, None
 
-def _emit_tick(conId: int, typ: str, payload: dict):
-    key = (int(conId), typ)
-    TICKS_LAST[key] = payload
+def _tick_epoch(when) -> float:
     try:
-        TICKS_BUF[key].append(payload)
-    except Exception:  # extremely defensive
-        pass
-    for q in list(TICKS_SUBS.get(key, set())):
+        return _bar_epoch(when) if when is not None else time.time()
+    except Exception:
+        return time.time()
+
+def _emit_tick(conId: int, typ: str, ts: float, nums: tuple, strs: tuple = ()):
+    key = (int(conId), typ)
+    ring = TICKS_BUF.get(key)
+    if ring is None:
+        ring = TICKS_BUF[key] = _TickRing(int(conId), typ)
+    k = ring.append(ts, nums, strs)
+    if TICK_LOG:
+        _tick_log_append(int(conId), typ, ts, nums, strs)
+    qs = TICKS_SUBS.get(key)
+    if not qs:
+        return
+    payload = ring.row(k)
+    for q in list(qs):
         try:
             q.put_nowait(payload)
         except asyncio.QueueFull:
             pass
 
+# --- persistent tick log (per conId, per UTC day, fixed-size records) ------
+TICKS_DIR = RUNTIME / "ticks"
+TICK_LOG = os.getenv("IB_TICK_LOG", "1").lower() not in ("0", "false", "no", "off")
+# record layout per type: float64 ts, float64 numeric fields, then fixed-width strings
+_TICK_REC: dict[str, struct.Struct] = {
+    "last": struct.Struct("<ddd8s8s"),
+    "bidask": struct.Struct("<ddddd"),
+    "midpoint": struct.Struct("<dd"),
+}
+
+class _DiskWriter:
+    """
+    Background thread that appends byte records to files so the event loop
+    never blocks on disk. Writes are batched per file and flushed each pass;
+    a small LRU of open handles avoids reopening hot files.
+    """
+    MAX_OPEN = 64
+
+    def __init__(self):
+        self._q: "queue.SimpleQueue[tuple[Path | None, Any]]" = queue.SimpleQueue()
+        self._files: "OrderedDict[Path, Any]" = OrderedDict()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.errors = 0
+
+    def _start(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="tb-disk-writer", daemon=True)
+                    self._thread.start()
+
+    def write(self, path: Path, data: bytes) -> None:
+        self._start()
+        self._q.put((path, data))
+
+    def call(self, fn: Callable[[], None]) -> None:
+        """Run fn on the writer thread, in order with queued writes (for writers that need offsets)."""
+        self._start()
+        self._q.put((None, fn))
+
+    def _handle(self, path: Path):
+        f = self._files.get(path)
+        if f is None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            f = self._files[path] = open(path, "ab")
+            while len(self._files) > self.MAX_OPEN:
+                _, old = self._files.popitem(last=False)
+                try:
+                    old.close()
+                except Exception:
+                    pass
+        self._files.move_to_end(path)
+        return f
+
+    def _flush(self, batch: dict[Path, list[bytes]]) -> None:
+        for path, chunks in batch.items():
+            try:
+                f = self._handle(path)
+                f.write(b"".join(chunks))
+                f.flush()
+                self.written += len(chunks)
+            except Exception:
+                self.errors += 1
+                self._files.pop(path, None)
+        batch.clear()
+
+    def _run(self) -> None:
+        while True:
+            item = self._q.get()
+            batch: dict[Path, list[bytes]] = defaultdict(list)
+            n = 0
+            while item is not None:
+                if item[0] is None:
+                    # writes queued before the callable must be on disk when it runs
+                    self._flush(batch)
+                    n = 0
+                    try:
+                        item[1]()
+                    except Exception:
+                        self.errors += 1
+                else:
+                    batch[item[0]].append(item[1])
+                    n += 1
+                if n >= 4096:
+                    break
+                try:
+                    item = self._q.get_nowait()
+                except queue.Empty:
+                    item = None
+            self._flush(batch)
+
+_DISK = _DiskWriter()
+
+def _tick_log_path(conId: int, typ: str, ts: float) -> Path:
+    day = time.strftime("%Y%m%d", time.gmtime(ts))
+    return TICKS_DIR / str(int(conId)) / f"{day}-{typ}.tks"
+
+def _tick_log_append(conId: int, typ: str, ts: float, nums: tuple, strs: tuple) -> None:
+    try:
+        vals = [math.nan if v is None else float(v) for v in nums]
+        vals += [str(v or "").encode("ascii", "replace")[:8] for v in strs]
+        _DISK.write(_tick_log_path(conId, typ, ts), _TICK_REC[typ].pack(ts, *vals))
+    except Exception:
+        pass
+
+class _TickLogView:
+    """Read-only mmap over one tick log; indexable by record for bisect on timestamps."""
+    def __init__(self, path: Path, typ: str):
+        self.rec = _TICK_REC[typ]
+        self.typ = typ
+        self._f = open(path, "rb")
+        size = os.fstat(self._f.fileno()).st_size
+        self.n = size // self.rec.size   # ignore a torn trailing record
+        self.mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if self.n else None
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, i: int) -> float:
+        return struct.unpack_from("<d", self.mm, i * self.rec.size)[0]
+
+    def rows(self, conId: int, lo: int, hi: int) -> list[dict]:
+        nums, strs = _TICK_FIELDS[self.typ]
+        out = []
+        for rec in self.rec.iter_unpack(self.mm[lo * self.rec.size:hi * self.rec.size]):
+            ts_i, dt = _tick_time_to_iso(rec[0])
+            d: dict[str, Any] = {"conId": conId, "type": self.typ}
+            for k, name in enumerate(nums, 1):
+                d[name] = _num_or_none(rec[k])
+            for k, name in enumerate(strs, 1 + len(nums)):
+                d[name] = rec[k].rstrip(b"\0").decode("ascii", "replace") or None
+            d["ts"], d["time"] = ts_i, dt
+            out.append(d)
+        return out
+
+    def close(self) -> None:
+        try:
+            if self.mm is not None:
+                self.mm.close()
+        finally:
+            self._f.close()
+
+def _parse_when(v: str | None, default: float) -> float:
+    if v is None or str(v).strip() == "":
+        return default
+    v = str(v).strip()
+    try:
+        x = float(v)
+        return x / 1000.0 if x > 1e11 else x   # accept epoch ms
+    except ValueError:
+        pass
+    try:
+        d = datetime.fromisoformat(v.replace("Z", "+00:00"))
+        return (d if d.tzinfo else d.replace(tzinfo=timezone.utc)).timestamp()
+    except Exception:
+        raise HTTPException(400, f"bad time {v!r} (epoch seconds or ISO-8601)")
+
+@router.get("/ticks/range")
+async def ticks_range(conId: int, start: str | None = None, end: str | None = None,
+                      types: str = "last", limit: int = 10000):
+    """
+    Recorded tick-by-tick data between start and end (epoch seconds or ISO,
+    default: the last hour), read from the on-disk tick log. Each day file is
+    memory-mapped and the range located by binary search on timestamps.
+    """
+    now = time.time()
+    t1 = _parse_when(end, now)
+    t0 = _parse_when(start, t1 - 3600)
+    if t1 < t0:
+        raise HTTPException(400, "end before start")
+    wanted = [t.strip().lower() for t in (types or "").split(",") if t.strip().lower() in _TICK_REC]
+    if not wanted:
+        raise HTTPException(400, "types must include at least one of bidask,last,midpoint")
+    lim = max(1, min(100000, int(limit)))
+    out: dict[str, Any] = {"conId": int(conId), "start": t0, "end": t1}
+    def _read(typ: str) -> tuple[list[dict], bool]:
+        rows: list[dict] = []
+        day = int(t0 // 86400) * 86400
+        while day <= t1 and len(rows) < lim:
+            p = _tick_log_path(conId, typ, day)
+            day += 86400
+            if not p.exists():
+                continue
+            v = _TickLogView(p, typ)
+            try:
+                if not len(v):
+                    continue
+                lo = bisect.bisect_left(v, t0)
+                hi = bisect.bisect_right(v, t1)
+                rows.extend(v.rows(int(conId), lo, min(hi, lo + lim - len(rows))))
+            finally:
+                v.close()
+        return rows, len(rows) >= lim
+    for typ in wanted:
+        rows, truncated = await asyncio.to_thread(_read, typ)
+        out[typ] = rows
+        if truncated:
+            out.setdefault("truncated", []).append(typ)
+    return out
+
 async def _ensure_ticks_handlers_attached():
     """
     Attach global ib_insync event handlers once (idempotent).
@@ -1911,17 +4411,12 @@ async def _ensure_ticks_handlers_attached():
             conId = getattr(c, "conId", None)
             if not conId:
                 return
-            ts_i, dt = _tick_time_to_iso(getattr(tick, "time", None))
-            d = {
-                "conId": int(conId),
-                "type": "last",
-                "price": _num_or_none(getattr(tick, "price", None)),
-                "size": _num_or_none(getattr(tick, "size", None)),
-                "exchange": getattr(tick, "exchange", None),
-                "specialConditions": getattr(tick, "specialConditions", None),
-                "ts": ts_i, "time": dt,
-            }
-            _emit_tick(int(conId), "last", d)
+            ts = _tick_epoch(getattr(tick, "time", None))
+            price = _num_or_none(getattr(tick, "price", None))
+            size = _num_or_none(getattr(tick, "size", None))
+            _emit_tick(int(conId), "last", ts, (price, size),
+                       (getattr(tick, "exchange", None), getattr(tick, "specialConditions", None)))
+            _bars_on_trade(int(conId), ts, price, size)
         except Exception:
             pass
 
@@ -1931,17 +4426,12 @@ async def _ensure_ticks_handlers_attached():
             conId = getattr(c, "conId", None)
             if not conId:
                 return
-            ts_i, dt = _tick_time_to_iso(getattr(tick, "time", None))
-            d = {
-                "conId": int(conId),
-                "type": "bidask",
-                "bid": _num_or_none(getattr(tick, "bidPrice", None)),
-                "bidSize": _num_or_none(getattr(tick, "bidSize", None)),
-                "ask": _num_or_none(getattr(tick, "askPrice", None)),
-                "askSize": _num_or_none(getattr(tick, "askSize", None)),
-                "ts": ts_i, "time": dt,
-            }
-            _emit_tick(int(conId), "bidask", d)
+            _emit_tick(int(conId), "bidask", _tick_epoch(getattr(tick, "time", None)), (
+                _num_or_none(getattr(tick, "bidPrice", None)),
+                _num_or_none(getattr(tick, "bidSize", None)),
+                _num_or_none(getattr(tick, "askPrice", None)),
+                _num_or_none(getattr(tick, "askSize", None)),
+            ))
         except Exception:
             pass
 
@@ -1951,14 +4441,8 @@ async def _ensure_ticks_handlers_attached():
             conId = getattr(c, "conId", None)
             if not conId:
                 return
-            ts_i, dt = _tick_time_to_iso(getattr(tick, "time", None))
-            d = {
-                "conId": int(conId),
-                "type": "midpoint",
-                "mid": _num_or_none(getattr(tick, "midPoint", None)),
-                "ts": ts_i, "time": dt,
-            }
-            _emit_tick(int(conId), "midpoint", d)
+            _emit_tick(int(conId), "midpoint", _tick_epoch(getattr(tick, "time", None)),
+                       (_num_or_none(getattr(tick, "midPoint", None)),))
         except Exception:
             pass
 
@@ -2008,6 +4492,220 @@ def _maybe_unsubscribe_tick(conId: int, typ: str):
         pass
     finally:
         TICKS_ACTIVE.discard(key)
+# ==========================
+# Server-side bar aggregation
+# ==========================
+# Incremental OHLCV+VWAP bars per conId at fixed resolutions, fed by
+# tick-by-tick trades or (when no trade ticks are flowing) 5-sec rtBars.
+BAR_RES: dict[str, int] = {"1s": 1, "5s": 5, "1m": 60, "5m": 300}
+BARS_KEEP = int(os.getenv("IB_BARS_KEEP", "500"))                  # closed bars kept per (conId, res)
+BARS_UPDATE_MS = float(os.getenv("IB_BARS_UPDATE_MS", "250"))      # min gap between forming-bar updates
+BARS_SUBS: dict[tuple[int, str], set[asyncio.Queue]] = defaultdict(set)   # (conId, res) -> queues
+BAR_BUILDERS: dict[int, "_BarBuilder"] = {}
+_BARS_SWEEPER: asyncio.Task | None = None
+
+class _BarBuilder:
+    """
+    Current bar per resolution as [t, o, h, l, c, v, pv, n]; each trade or
+    rtBar touches one list per resolution. A bar closes when data for a
+    later bucket arrives or, for quiet instruments, when the sweeper sees
+    its bucket has ended (plus one rtBar period while rtBars feed it, since
+    the bucket's last 5-sec bar is only delivered once that bar is over).
+    """
+    def __init__(self, conId: int):
+        self.conId = conId
+        self.cur: dict[str, list | None] = {r: None for r in BAR_RES}
+        self.closed_t: dict[str, float] = {r: 0.0 for r in BAR_RES}
+        self.hist: dict[str, Deque[dict]] = {r: deque(maxlen=BARS_KEEP) for r in BAR_RES}
+        self.last_trade = 0.0        # arrival time of the last tick-by-tick trade
+        self.last_rtbar = 0.0        # arrival time of the last rtBar that was used
+        self.last_push: dict[str, float] = {r: 0.0 for r in BAR_RES}
+
+    def _add(self, res: str, start: float, o: float, h: float, l: float, c: float, v: float, pv: float, n: int) -> None:
+        b = self.cur[res]
+        if b is not None and start > b[0]:
+            self._close(res)
+            b = None
+        if start <= self.closed_t[res] or (b is not None and start < b[0]):
+            return  # late data for a bucket already published
+        if b is None:
+            self.cur[res] = [start, o, h, l, c, v, pv, n]
+            _bars_publish(self, res, closed=False)
+            return
+        if h > b[2]: b[2] = h
+        if l < b[3]: b[3] = l
+        b[4] = c
+        b[5] += v
+        b[6] += pv
+        b[7] += n
+        _bars_publish(self, res, closed=False)
+
+    def trade(self, ts: float, price: float, size: float) -> None:
+        self.last_trade = time.time()
+        for res, secs in BAR_RES.items():
+            self._add(res, ts - ts % secs, price, price, price, price, size, price * size, 1)
+
+    def rtbar(self, ts: float, o: float, h: float, l: float, c: float, v: float, wap: float, n: int) -> None:
+        if time.time() - self.last_trade < 10:
+            return  # trade ticks are flowing and already cover this interval
+        self.last_rtbar = time.time()
+        for res, secs in BAR_RES.items():
+            if secs >= 5:
+                self._add(res, ts - ts % secs, o, h, l, c, v, (wap or c) * v, n)
+
+    def _close(self, res: str) -> None:
+        b = self.cur[res]
+        if b is None:
+            return
+        self.cur[res] = None
+        self.closed_t[res] = b[0]
+        self.hist[res].append(_bar_row_json(b))
+        _bars_publish(self, res, closed=True, bar=b)
+
+    def sweep(self, now: float, grace: float = 2.0) -> None:
+        if now - self.last_rtbar < 30:
+            grace += 5.0  # rtBar period
+        for res, secs in BAR_RES.items():
+            b = self.cur[res]
+            if b is not None and now >= b[0] + secs + grace:
+                self._close(res)
+
+def _bar_row_json(b: list) -> dict:
+    return {
+        "t": datetime.fromtimestamp(b[0], timezone.utc).isoformat(),
+        "o": b[1], "h": b[2], "l": b[3], "c": b[4], "v": b[5],
+        "vwap": (b[6] / b[5]) if b[5] else b[4],
+        "n": b[7],
+    }
+
+def _bars_publish(bb: _BarBuilder, res: str, closed: bool, bar: list | None = None) -> None:
+    qs = BARS_SUBS.get((bb.conId, res))
+    if not qs:
+        return
+    now = time.time()
+    if not closed and (now - bb.last_push[res]) * 1000.0 < BARS_UPDATE_MS:
+        return
+    bb.last_push[res] = now
+    b = bar if bar is not None else bb.cur[res]
+    if b is None:
+        return
+    item = {"conId": bb.conId, "res": res, "closed": closed, "bar": _bar_row_json(b)}
+    for q in list(qs):
+        try:
+            q.put_nowait(item)
+        except asyncio.QueueFull:
+            pass
+
+def _bars_on_trade(conId: int, when, price, size) -> None:
+    bb = BAR_BUILDERS.get(int(conId))
+    if bb is None or price is None:
+        return
+    ts = _bar_epoch(when) if when is not None else time.time()
+    bb.trade(ts, float(price), float(size or 0.0))
+
+def _bars_on_rtbar(conId: int, b) -> None:
+    bb = BAR_BUILDERS.get(int(conId))
+    if bb is None:
+        return
+    try:
+        o = getattr(b, "open_", None)
+        o = getattr(b, "open", None) if o is None else o
+        bb.rtbar(_bar_epoch(b.time), float(o), float(b.high), float(b.low), float(b.close),
+                 float(b.volume or 0), float(getattr(b, "wap", 0) or 0), int(getattr(b, "count", 0) or 0))
+    except Exception:
+        pass
+
+async def _bars_sweeper() -> None:
+    while BAR_BUILDERS:
+        now = time.time()
+        for bb in list(BAR_BUILDERS.values()):
+            bb.sweep(now)
+        await asyncio.sleep(1.0)
+
+def _bars_builder(conId: int) -> _BarBuilder:
+    global _BARS_SWEEPER
+    bb = BAR_BUILDERS.get(int(conId))
+    if bb is None:
+        bb = BAR_BUILDERS[int(conId)] = _BarBuilder(int(conId))
+    if _BARS_SWEEPER is None or _BARS_SWEEPER.done():
+        _BARS_SWEEPER = asyncio.get_running_loop().create_task(_bars_sweeper())
+    return bb
+
+def _bars_res_list(res: str) -> list[str]:
+    out = [r.strip() for r in (res or "").split(",") if r.strip() in BAR_RES]
+    if not out:
+        raise HTTPException(400, f"res must include at least one of {','.join(BAR_RES)}")
+    return out
+
+@router.get("/bars/stream")
+async def bars_stream(conId: int, res: str = "1m", source: str = "auto", poll_keepalive: float = 20.0):
+    """
+    SSE of server-built candles. `res` is CSV of 1s,5s,1m,5m.
+      event: bar
+      data: { conId, res, closed, bar: {t,o,h,l,c,v,vwap,n} }
+    closed=false events are the forming bar (throttled to IB_BARS_UPDATE_MS);
+    closed=true is final. `source`: ticks (tick-by-tick trades), rtbars
+    (5-sec bars), or auto (ticks when 1s is requested, else rtbars).
+    Starts with the recently closed bars so a chart can draw immediately.
+    """
+    wanted = _bars_res_list(res)
+    src = (source or "auto").lower()
+    if src == "auto":
+        src = "ticks" if "1s" in wanted else "rtbars"
+    if src not in ("ticks", "rtbars"):
+        raise HTTPException(400, "source must be ticks, rtbars or auto")
+    cid = int(conId)
+    # hold token: keeps the upstream feed referenced while this stream is open
+    hold: asyncio.Queue = asyncio.Queue(maxsize=1)
+    if src == "ticks":
+        await _ensure_tick_subscription(cid, "last")
+        TICKS_SUBS[(cid, "last")].add(hold)
+    else:
+        await _ensure_rtbars_subscribed(cid)
+        RTBARS_SUBS[cid].add(hold)
+    bb = _bars_builder(cid)
+    q: asyncio.Queue = asyncio.Queue(maxsize=2000)
+    for r in wanted:
+        BARS_SUBS[(cid, r)].add(q)
+
+    async def _gen():
+        try:
+            for r in wanted:
+                for b in list(bb.hist[r])[-200:]:
+                    yield f"event: bar\ndata: {json.dumps({'conId': cid, 'res': r, 'closed': True, 'bar': b}, separators=(',',':'))}\n\n"
+            while True:
+                try:
+                    item = await asyncio.wait_for(q.get(), timeout=max(5.0, float(poll_keepalive)))
+                    yield f"event: bar\ndata: {json.dumps(item, separators=(',',':'))}\n\n"
+                except asyncio.TimeoutError:
+                    yield f": keepalive {int(time.time())}\n\n"
+        except asyncio.CancelledError:
+            return
+        finally:
+            for r in wanted:
+                BARS_SUBS[(cid, r)].discard(q)
+            if src == "ticks":
+                TICKS_SUBS[(cid, "last")].discard(hold)
+                _maybe_unsubscribe_tick(cid, "last")
+            else:
+                RTBARS_SUBS[cid].discard(hold)
+                _maybe_unsubscribe_rtbars(cid)
+            if not any(BARS_SUBS.get((cid, r)) for r in BAR_RES):
+                BAR_BUILDERS.pop(cid, None)
+
+    return StreamingResponse(_gen(), media_type="text/event-stream")
+
+@router.get("/bars/live")
+async def bars_live(conId: int, res: str = "1m", limit: int = 200):
+    """Recently closed server-built bars plus the forming one, per resolution (empty if no stream is open)."""
+    bb = BAR_BUILDERS.get(int(conId))
+    lim = max(1, min(BARS_KEEP, int(limit)))
+    out: dict[str, Any] = {"conId": int(conId)}
+    for r in _bars_res_list(res):
+        cur = bb.cur[r] if bb else None
+        out[r] = {"bars": list(bb.hist[r])[-lim:] if bb else [], "forming": _bar_row_json(cur) if cur else None}
+    return out
+
 # === Compatibility aliases + light feature endpoints for frontend ===
 
 @router.get("/ticks/history")
@@ -2042,43 +4740,191 @@ async def ticks_history_alias(conId: int, types: str = "trades", limit: int = 50
     return await ticks_recent(conId=conId, types=",".join(want), limit=limit)  # reuse existing impl
 
 
+# --- execution store -----------------------------------------------------------
+# IB only hands back a few days of executions, so fills are kept locally:
+# execDetailsEvent/commissionReportEvent write them as they happen, and
+# reqExecutions is only asked for the gap since the newest stored fill
+# (on connect and every IB_EXEC_CATCHUP_S). Reads are indexed local queries.
+EXEC_DB = RUNTIME / "executions.db"
+EXEC_CATCHUP_S = float(os.getenv("IB_EXEC_CATCHUP_S", "900"))
+
+def _ib_num(x):
+    """_num_or_none that also drops IB's unset sentinel (Double.MAX_VALUE)."""
+    v = _num_or_none(x)
+    return None if v is not None and abs(v) > 1e300 else v
+
+class _ExecStore:
+    """
+    executions(execId PK, time, account, conId, symbol, secType, currency, exchange,
+               side, shares, price, cumQty, avgPrice, orderId, permId, orderRef, contract JSON)
+    commissions(execId PK, commission, currency, realizedPNL, ts)
+    Indexed on (conId, time), (symbol, time) and time. `rowid` order on
+    executions is arrival order; consumers can follow it via `listeners`.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self._con: sqlite3.Connection | None = None
+        self.version = 0
+        self.caught_up = 0.0
+        self._catchup: asyncio.Task | None = None
+        self.listeners: list[Callable[[], None]] = []
+
+    def _db(self) -> sqlite3.Connection:
+        if self._con is None:
+            con = _sqlite(self.path)
+            con.executescript("""
+                CREATE TABLE IF NOT EXISTS executions(execId TEXT PRIMARY KEY, time REAL NOT NULL, account TEXT,
+                    conId INTEGER, symbol TEXT COLLATE NOCASE, secType TEXT, currency TEXT, exchange TEXT,
+                    side TEXT, shares REAL, price REAL, cumQty REAL, avgPrice REAL, orderId INTEGER,
+                    permId INTEGER, orderRef TEXT, contract TEXT);
+                CREATE INDEX IF NOT EXISTS executions_conid_time ON executions(conId, time);
+                CREATE INDEX IF NOT EXISTS executions_symbol_time ON executions(symbol, time);
+                CREATE INDEX IF NOT EXISTS executions_time ON executions(time);
+                CREATE TABLE IF NOT EXISTS commissions(execId TEXT PRIMARY KEY, commission REAL, currency TEXT,
+                    realizedPNL REAL, ts REAL NOT NULL);
+            """)
+            self._con = con
+        return self._con
+
+    def _changed(self) -> None:
+        self.version += 1
+        for cb in list(self.listeners):
+            try: cb()
+            except Exception: pass
+
+    # ---- writes ----
+    def _fill_row(self, fill) -> tuple | None:
+        ex = getattr(fill, "execution", None)
+        c = getattr(fill, "contract", None)
+        if ex is None or c is None or not getattr(ex, "execId", None):
+            return None
+        t = getattr(ex, "time", None) or getattr(fill, "time", None)
+        ts = t.timestamp() if hasattr(t, "timestamp") else time.time()
+        return (ex.execId, ts, getattr(ex, "acctNumber", None), int(getattr(c, "conId", 0) or 0) or None,
+                getattr(c, "localSymbol", None) or getattr(c, "symbol", None), getattr(c, "secType", None),
+                getattr(c, "currency", None), getattr(ex, "exchange", None), getattr(ex, "side", None),
+                _ib_num(getattr(ex, "shares", None)), _ib_num(getattr(ex, "price", None)),
+                _ib_num(getattr(ex, "cumQty", None)), _ib_num(getattr(ex, "avgPrice", None)),
+                getattr(ex, "orderId", None), getattr(ex, "permId", None), getattr(ex, "orderRef", None) or None,
+                json.dumps(_contract_to_dict(c), separators=(",", ":")))
+
+    def put_fills(self, fills) -> int:
+        rows = [r for r in (self._fill_row(f) for f in fills or []) if r]
+        if not rows:
+            return 0
+        con = self._db()
+        before = con.total_changes
+        con.executemany("INSERT OR IGNORE INTO executions VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+        added = con.total_changes - before
+        for f in fills or []:
+            self.put_commission(getattr(f, "commissionReport", None), notify=False)
+        if con.total_changes != before:
+            self._changed()
+        return added
+
+    def put_commission(self, cr, notify: bool = True) -> None:
+        if cr is None or not getattr(cr, "execId", None):
+            return
+        self._db().execute(
+            "INSERT INTO commissions VALUES(?,?,?,?,?) ON CONFLICT(execId) DO UPDATE SET "
+            "commission=excluded.commission, currency=excluded.currency, realizedPNL=excluded.realizedPNL, ts=excluded.ts",
+            (cr.execId, _ib_num(getattr(cr, "commission", None)), getattr(cr, "currency", None),
+             _ib_num(getattr(cr, "realizedPNL", None)), time.time()))
+        if notify:
+            self._changed()
+
+    # ---- IB feeds ----
+    def on_exec(self, trade, fill) -> None:
+        try: self.put_fills([fill])
+        except Exception as e: log.warning("execution store write failed: %s", e)
+
+    def on_commission(self, trade, fill, report) -> None:
+        try: self.put_commission(report)
+        except Exception as e: log.warning("commission store write failed: %s", e)
+
+    def last_time(self) -> float | None:
+        row = self._db().execute("SELECT max(time) FROM executions").fetchone()
+        return row[0] if row else None
+
+    async def catchup(self) -> int:
+        """Ask IB for executions since the newest stored one (minus a small overlap)."""
+        await _ensure_connected()
+        last = self.last_time()
+        flt = ExecutionFilter()
+        if last:
+            flt.time = time.strftime("%Y%m%d-%H:%M:%S", time.gmtime(last - 300))
+        fills = await ib.reqExecutionsAsync(flt)
+        n = self.put_fills(fills)
+        self.caught_up = time.time()
+        return n
+
+    async def ensure(self) -> None:
+        """Catch up if stale and IB is reachable; otherwise serve what is stored."""
+        if time.time() - self.caught_up < EXEC_CATCHUP_S and ib.isConnected():
+            return
+        try:
+            if self._catchup is None or self._catchup.done():
+                self._catchup = asyncio.get_running_loop().create_task(self.catchup())
+            await asyncio.shield(self._catchup)
+        except Exception as e:
+            log.info("execution catch-up skipped: %s", e)
+
+    def on_connected(self) -> None:
+        self.caught_up = 0.0
+        try:
+            self._catchup = asyncio.get_running_loop().create_task(self.catchup())
+        except RuntimeError:
+            pass
+
+    # ---- reads ----
+    def commissions(self, conId: int) -> float:
+        row = self._db().execute("SELECT sum(c.commission) FROM executions e JOIN commissions c "
+                                 "ON c.execId = e.execId WHERE e.conId = ?", (int(conId),)).fetchone()
+        return float(row[0] or 0.0)
+
+    def query(self, conId: int | None = None, symbol: str | None = None, since: float | None = None,
+              until: float | None = None, limit: int | None = None, after_rowid: int = 0) -> list[dict]:
+        sql = ("SELECT e.rowid, e.execId, e.time, e.account, e.conId, e.symbol, e.side, e.shares, e.price, "
+               "e.orderId, e.permId, c.commission, c.realizedPNL, e.currency, e.secType "
+               "FROM executions e LEFT JOIN commissions c ON c.execId = e.execId WHERE 1=1")
+        args: list = []
+        if conId is not None:
+            sql += " AND e.conId = ?"; args.append(int(conId))
+        if symbol:
+            sql += " AND e.symbol = ?"; args.append(symbol.strip())
+        if since is not None:
+            sql += " AND e.time >= ?"; args.append(since)
+        if until is not None:
+            sql += " AND e.time <= ?"; args.append(until)
+        if after_rowid:
+            sql += " AND e.rowid > ?"; args.append(int(after_rowid))
+        sql += " ORDER BY e.time, e.execId"
+        if limit:
+            sql += " LIMIT ?"; args.append(int(limit))
+        out = []
+        for (rid, eid, ts, acct, cid, sym, side, shares, price, oid, pid, comm, rpnl, ccy, st) in self._db().execute(sql, args):
+            out.append({
+                "time": util.formatIBDatetime(datetime.fromtimestamp(ts, timezone.utc)),
+                "ts": ts, "account": acct, "conId": cid, "symbol": sym, "secType": st, "currency": ccy,
+                "side": side, "price": price, "shares": shares, "commission": comm, "realizedPNL": rpnl,
+                "orderId": oid, "permId": pid, "execId": eid, "seq": rid,
+            })
+        return out
+
+_EXEC = _ExecStore(EXEC_DB)
+ib.execDetailsEvent += _EXEC.on_exec
+ib.commissionReportEvent += _EXEC.on_commission
+ib.connectedEvent += _EXEC.on_connected
+
 @router.get("/executions")
 async def executions(days: int = 7, conId: int | None = None, symbol: str | None = None):
     """
-    Recent executions across the account (optionally filtered by conId or symbol).
-    Mirrors data shape used in realized_pnl, but returns all matches.
+    Executions across the account from the local execution store (optionally
+    filtered by conId or symbol); older fills survive IB's own retention window.
     """
-    await _ensure_connected()
-    since = datetime.utcnow().timestamp() - max(1, int(days)) * 86400
-    exe_filter = util.ExecutionFilter(time=datetime.utcfromtimestamp(since))
-    exes = await ib.reqExecutionsAsync(exe_filter)
-    out = []
-    symU = (symbol or "").strip().upper()
-    for r in exes or []:
-        try:
-            c = getattr(r, "contract", None)
-            if not c:
-                continue
-            if conId is not None and int(getattr(c, "conId", -1)) != int(conId):
-                continue
-            if symU and ((getattr(c, "localSymbol", "") or getattr(c, "symbol", "") or "").upper() != symU):
-                continue
-            cr = getattr(r, "commissionReport", None)
-            out.append({
-                "time": util.formatIBDatetime(getattr(r, "time", None)) if getattr(r, "time", None) else None,
-                "conId": getattr(c, "conId", None),
-                "symbol": getattr(c, "localSymbol", None) or getattr(c, "symbol", None),
-                "side": getattr(r, "side", None),
-                "price": _num_or_none(getattr(r, "price", None)),
-                "shares": _num_or_none(getattr(r, "shares", None)),
-                "commission": _num_or_none(getattr(cr, "commission", None)) if cr else None,
-                "realizedPNL": _num_or_none(getattr(cr, "realizedPNL", None)) if cr else None,
-                "orderId": getattr(r, "orderId", None),
-                "execId": getattr(r, "execId", None),
-            })
-        except Exception:
-            continue
-    return out
+    await _EXEC.ensure()
+    since = time.time() - max(1, int(days)) * 86400
+    return _EXEC.query(conId=conId, symbol=symbol, since=since)
 
 
 @router.get("/fills")
@@ -2109,7 +4955,7 @@ async def fundamentals(conId: int | None = None, symbol: str | None = None, repo
     }
     rpt = rpt_map.get((report or "").lower(), report or "ReportSnapshot")
     try:
-        xml = await ib.reqFundamentalDataAsync(c, reportType=rpt)
+        xml = await _req_fundamentals(c, rpt)
     except Exception as e:
         raise HTTPException(502, f"fundamentals fetch failed: {e!s}")
     # Return both raw XML (string) and a naive HTML mirror for convenience
@@ -2124,11 +4970,8 @@ async def greeks(conId: int):
     """
     await _ensure_connected()
     c = await _contract_from_conid(int(conId))
-    # request snapshot market data; modelGreeks usually appears here
-    tkr = ib.reqMktData(c, snapshot=True)
-    await asyncio.sleep(0.4)
-    ib.cancelMktData(c)
-    t = next((x for x in ib.tickers() if getattr(x.contract, "conId", None) == int(conId)), None)
+    # modelGreeks arrives on the streaming line for options
+    t = await _mkt_ticker(c, "", ("modelGreeks",), wait=0.4)
     mg = getattr(t, "modelGreeks", None) if t else None
     out = {
         "conId": int(conId),
@@ -2146,7 +4989,7 @@ async def greeks(conId: int):
 # --- fast label lookup by conId (fill longName and cache) -------------------
 async def _long_name_for_conid(cid: int) -> str | None:
     try:
-        cds = await ib.reqContractDetailsAsync(Contract(conId=int(cid)))
+        cds = await _details_for(Contract(conId=int(cid)))
         if cds:
             nm = getattr(cds[0], "longName", None) or getattr(cds[0], "description", None)
             return nm
@@ -2191,32 +5034,525 @@ async def contract_label(conId: int | None = None, symbol: str | None = None):
     }
 
 
+# --- Flex statement ledger -------------------------------------------------------
+# Flex Query XML files dropped into runtime/flex/ are streamed with iterparse
+# (every element is handled on its end tag and then detached from its parent,
+# so memory stays flat whatever the file size) and upserted into flex.db. Rows are keyed
+# by IB's transactionID (or a digest of the record when the query omits it), so
+# re-importing a file or overlapping statements never duplicates anything. A
+# registry of (name, size, mtime) skips files that were already imported.
+FLEX_DIR = RUNTIME / "flex"
+FLEX_DB = RUNTIME / "flex.db"
+_FLEX_DIV_TYPES = ("Dividends", "Payment In Lieu Of Dividends", "Withholding Tax")
+_FLEX_TRADE_COLS = ("id", "accountId", "conid", "symbol", "assetCategory", "currency", "ts", "tradeDate",
+                    "buySell", "quantity", "tradePrice", "proceeds", "ibCommission", "fifoPnlRealized",
+                    "ibExecID", "description")
+_FLEX_CASH_COLS = ("id", "accountId", "type", "conid", "symbol", "currency", "ts", "reportDate",
+                   "amount", "description")
+_FLEX_DIV_COLS = ("id", "accountId", "conid", "symbol", "currency", "ts", "exDate", "payDate",
+                  "type", "amount", "description")
+
+_FLEX_TS_CACHE: dict[str, float | None] = {}
+
+def _flex_ts(v: str | None) -> float | None:
+    """Flex dates come as 20240115, 2024-01-15, 20240115;093000 or '2024-01-15, 09:30:00'."""
+    if not v:
+        return None
+    ts = _FLEX_TS_CACHE.get(v, False)
+    if ts is not False:
+        return ts
+    d = (re.sub(r"\D", "", v) + "000000")[:14]
+    try:
+        ts = float(calendar.timegm((int(d[:4]), int(d[4:6]), int(d[6:8]), int(d[8:10]), int(d[10:12]), int(d[12:14]))))
+    except ValueError:
+        ts = None
+    if len(_FLEX_TS_CACHE) > 50000:
+        _FLEX_TS_CACHE.clear()
+    _FLEX_TS_CACHE[v] = ts
+    return ts
+
+def _flex_num(v: str | None) -> float | None:
+    try:
+        return float(v) if v not in (None, "") else None
+    except ValueError:
+        return None
+
+def _flex_id(tag: str, a: dict) -> str:
+    tid = a.get("transactionID") or a.get("tradeID")
+    if tid:
+        return tid
+    return tag + ":" + hashlib.sha1(json.dumps(sorted(a.items()), separators=(",", ":")).encode()).hexdigest()
+
+class _FlexStore:
+    """
+    flex_trades(id PK, ...)     Trade records            idx (conid, ts), (symbol, ts), ts
+    flex_cash(id PK, ...)       CashTransaction records  idx (ts), (type, ts), (conid, ts)
+    flex_dividends(id PK, ...)  dividend / PIL / withholding cash records  idx (ts), (conid, ts), (symbol, ts)
+    flex_files(name PK, size, mtime, imported, rows)  import registry
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self._con: sqlite3.Connection | None = None
+        self._lock = threading.Lock()      # one import at a time
+        self.last_error: str | None = None
+
+    def _open(self) -> sqlite3.Connection:
+        con = _sqlite(self.path)
+        con.executescript("""
+            CREATE TABLE IF NOT EXISTS flex_trades(id TEXT PRIMARY KEY, accountId TEXT, conid INTEGER,
+                symbol TEXT COLLATE NOCASE, assetCategory TEXT, currency TEXT, ts REAL, tradeDate TEXT,
+                buySell TEXT, quantity REAL, tradePrice REAL, proceeds REAL, ibCommission REAL,
+                fifoPnlRealized REAL, ibExecID TEXT, description TEXT);
+            CREATE INDEX IF NOT EXISTS flex_trades_conid_ts ON flex_trades(conid, ts);
+            CREATE INDEX IF NOT EXISTS flex_trades_symbol_ts ON flex_trades(symbol, ts);
+            CREATE INDEX IF NOT EXISTS flex_trades_ts ON flex_trades(ts);
+            CREATE TABLE IF NOT EXISTS flex_cash(id TEXT PRIMARY KEY, accountId TEXT, type TEXT, conid INTEGER,
+                symbol TEXT COLLATE NOCASE, currency TEXT, ts REAL, reportDate TEXT, amount REAL, description TEXT);
+            CREATE INDEX IF NOT EXISTS flex_cash_ts ON flex_cash(ts);
+            CREATE INDEX IF NOT EXISTS flex_cash_type_ts ON flex_cash(type, ts);
+            CREATE INDEX IF NOT EXISTS flex_cash_conid_ts ON flex_cash(conid, ts);
+            CREATE TABLE IF NOT EXISTS flex_dividends(id TEXT PRIMARY KEY, accountId TEXT, conid INTEGER,
+                symbol TEXT COLLATE NOCASE, currency TEXT, ts REAL, exDate TEXT, payDate TEXT, type TEXT,
+                amount REAL, description TEXT);
+            CREATE INDEX IF NOT EXISTS flex_dividends_ts ON flex_dividends(ts);
+            CREATE INDEX IF NOT EXISTS flex_dividends_conid_ts ON flex_dividends(conid, ts);
+            CREATE INDEX IF NOT EXISTS flex_dividends_symbol_ts ON flex_dividends(symbol, ts);
+            CREATE TABLE IF NOT EXISTS flex_files(name TEXT PRIMARY KEY, size INTEGER, mtime REAL,
+                imported REAL, rows INTEGER);
+        """)
+        return con
+
+    def _db(self) -> sqlite3.Connection:
+        if self._con is None:
+            self._con = self._open()
+        return self._con
+
+    # ---- import (worker thread) ----
+    @staticmethod
+    def _upsert_sql(table: str, cols: tuple) -> str:
+        sets = ", ".join(f"{c}=excluded.{c}" for c in cols[1:])
+        return f"INSERT INTO {table}({','.join(cols)}) VALUES({','.join('?' * len(cols))}) ON CONFLICT(id) DO UPDATE SET {sets}"
+
+    def import_file(self, path: Path, con: sqlite3.Connection) -> int:
+        sql = {"t": self._upsert_sql("flex_trades", _FLEX_TRADE_COLS),
+               "c": self._upsert_sql("flex_cash", _FLEX_CASH_COLS),
+               "d": self._upsert_sql("flex_dividends", _FLEX_DIV_COLS)}
+        batch: dict[str, list] = {"t": [], "c": [], "d": []}
+        n = 0
+        def _flush():
+            for k, rows in batch.items():
+                if rows:
+                    con.executemany(sql[k], rows)
+                    rows.clear()
+        account = None
+        stack: list = []
+        con.execute("BEGIN")
+        try:
+            for ev, el in ET.iterparse(str(path), events=("start", "end")):
+                if ev == "start":
+                    stack.append(el)
+                    if el.tag == "FlexStatement":
+                        account = el.get("accountId")
+                    continue
+                stack.pop()
+                tag = el.tag
+                a = dict(el.attrib) if tag in ("Trade", "CashTransaction") else None
+                # every finished element is dropped from its parent, whatever the
+                # section, so the tree never holds more than the open path
+                el.clear()
+                if stack:
+                    stack[-1].remove(el)
+                if a is None:
+                    continue
+                if tag == "CashTransaction" and (a.get("levelOfDetail") or "").upper() == "SUMMARY":
+                    continue  # per-currency totals of the DETAIL rows
+
+                acct = a.get("accountId") or account
+                conid = int(a["conid"]) if (a.get("conid") or "").isdigit() else None
+                if tag == "Trade":
+                    batch["t"].append((
+                        _flex_id(tag, a), acct, conid, a.get("symbol"), a.get("assetCategory"), a.get("currency"),
+                        _flex_ts(a.get("dateTime") or a.get("tradeDate")), a.get("tradeDate"), a.get("buySell"),
+                        _flex_num(a.get("quantity")), _flex_num(a.get("tradePrice")), _flex_num(a.get("proceeds")),
+                        _flex_num(a.get("ibCommission")), _flex_num(a.get("fifoPnlRealized")), a.get("ibExecID"),
+                        a.get("description")))
+                else:
+                    rid = _flex_id(tag, a)
+                    ts = _flex_ts(a.get("dateTime") or a.get("settleDate") or a.get("reportDate"))
+                    typ = a.get("type")
+                    batch["c"].append((rid, acct, typ, conid, a.get("symbol"), a.get("currency"), ts,
+                                       a.get("reportDate"), _flex_num(a.get("amount")), a.get("description")))
+                    if typ in _FLEX_DIV_TYPES:
+                        batch["d"].append((rid, acct, conid, a.get("symbol"), a.get("currency"), ts,
+                                           a.get("exDate"), a.get("payDate") or a.get("settleDate"), typ,
+                                           _flex_num(a.get("amount")), a.get("description")))
+                n += 1
+                if n % 1000 == 0:
+                    _flush()
+            _flush()
+            st = path.stat()
+            con.execute("INSERT OR REPLACE INTO flex_files VALUES(?,?,?,?,?)",
+                        (path.name, st.st_size, st.st_mtime, time.time(), n))
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return n
+
+    def scan(self) -> dict:
+        """Import new/changed *.xml files in FLEX_DIR (worker thread)."""
+        if not self._lock.acquire(blocking=False):
+            return {"busy": True}
+        try:
+            FLEX_DIR.mkdir(parents=True, exist_ok=True)
+            con = self._open()
+            try:
+                done = {r[0]: (r[1], r[2]) for r in con.execute("SELECT name, size, mtime FROM flex_files")}
+                out = {"imported": [], "errors": []}
+                for p in sorted(FLEX_DIR.glob("*.xml")):
+                    st = p.stat()
+                    if done.get(p.name) == (st.st_size, st.st_mtime):
+                        continue
+                    try:
+                        out["imported"].append({"file": p.name, "rows": self.import_file(p, con)})
+                    except Exception as e:
+                        self.last_error = f"{p.name}: {e!s}"
+                        out["errors"].append(self.last_error)
+                        log.warning("flex import failed for %s: %s", p.name, e)
+                return out
+            finally:
+                con.close()
+        finally:
+            self._lock.release()
+
+    def pending(self) -> bool:
+        try:
+            files = {p.name: p.stat() for p in FLEX_DIR.glob("*.xml")}
+        except Exception:
+            return False
+        if not files:
+            return False
+        done = {r[0]: (r[1], r[2]) for r in self._db().execute("SELECT name, size, mtime FROM flex_files")}
+        return any(done.get(n) != (st.st_size, st.st_mtime) for n, st in files.items())
+
+    # ---- reads ----
+    def cash_types(self, like: str) -> list[str]:
+        """Exact cash types containing `like` (case-insensitive), so the (type, ts) index applies."""
+        q = like.strip().lower()
+        return [r[0] for r in self._db().execute("SELECT DISTINCT type FROM flex_cash") if r[0] and q in r[0].lower()]
+
+    def query(self, table: str, cols: tuple, where: list[tuple[str, Any]], limit: int, offset: int) -> tuple[list[dict], int]:
+        cond = " AND ".join(w for w, _ in where) or "1=1"
+        args = [x for _, v in where for x in (v if isinstance(v, list) else [v])]
+        con = self._db()
+        total = con.execute(f"SELECT count(*) FROM {table} WHERE {cond}", args).fetchone()[0]
+        rows = con.execute(f"SELECT {','.join(cols)} FROM {table} WHERE {cond} ORDER BY ts DESC, id LIMIT ? OFFSET ?",
+                           args + [limit, offset]).fetchall()
+        out = []
+        for r in rows:
+            d = dict(zip(cols, r))
+            d["date"] = datetime.fromtimestamp(d["ts"], timezone.utc).isoformat() if d.get("ts") is not None else None
+            out.append(d)
+        return out, total
+
+_FLEX = _FlexStore(FLEX_DB)
+
+async def _flex_refresh() -> None:
+    if await asyncio.to_thread(_FLEX.pending):
+        await asyncio.to_thread(_FLEX.scan)
+
+def _flex_where(days: float | None, start: str | None, end: str | None, conId: int | None,
+                symbol: str | None, currency: str | None, account: str | None) -> list[tuple[str, Any]]:
+    where: list[tuple[str, Any]] = []
+    if start or end:
+        t1 = _parse_when(end, time.time())
+        where.append(("ts >= ?", _parse_when(start, 0.0)))
+        where.append(("ts <= ?", t1))
+    elif days:
+        where.append(("ts >= ?", time.time() - float(days) * 86400))
+    if conId is not None:
+        where.append(("conid = ?", int(conId)))
+    if symbol:
+        where.append(("symbol = ?", symbol.strip()))
+    if currency:
+        where.append(("currency = ?", currency.strip().upper()))
+    if account:
+        where.append(("accountId = ?", account.strip()))
+    return where
+
+def _flex_page(response: Response | None, rows: list[dict], total: int) -> list[dict]:
+    if response is not None:
+        response.headers["X-Total-Count"] = str(total)
+    return rows
+
 @router.get("/transactions")
-async def transactions(days: int = 90):
+async def transactions(days: int = 90, type: str | None = None, conId: int | None = None,
+                       symbol: str | None = None, currency: str | None = None, account: str | None = None,
+                       start: str | None = None, end: str | None = None,
+                       limit: int = 500, offset: int = 0, response: Response = None):
     """
-    Placeholder: IB API doesn’t expose a simple REST for cash transactions here.
-    Returns an empty array so the UI can render gracefully.
-    (Consider Flex queries or account downloads for real data.)
+    Cash transactions imported from Flex statements in runtime/flex/ (newest
+    first). `type` matches case-insensitively within IB's type, e.g. DIVIDEND,
+    FEE, INTEREST, DEPOSIT. Total row count is in X-Total-Count.
     """
-    return []
+    await _flex_refresh()
+    where = _flex_where(days, start, end, conId, symbol, currency, account)
+    if type:
+        types = await asyncio.to_thread(_FLEX.cash_types, type)
+        if not types:
+            return _flex_page(response, [], 0)
+        where.append((f"type IN ({','.join('?' * len(types))})", types))
+    rows, total = await asyncio.to_thread(_FLEX.query, "flex_cash", _FLEX_CASH_COLS, where,
+                                          max(1, min(5000, int(limit))), max(0, int(offset)))
+    return _flex_page(response, rows, total)
 
 
 @router.get("/dividends")
-async def dividends(days: int = 365):
+async def dividends(days: int = 365, years: int | None = None, conId: int | None = None,
+                    symbol: str | None = None, currency: str | None = None, account: str | None = None,
+                    start: str | None = None, end: str | None = None,
+                    limit: int = 500, offset: int = 0, response: Response = None):
     """
-    Placeholder for account-level dividend history.
-    Returns an empty array to keep UI happy until a data source is wired.
+    Dividends, payments in lieu and withholding tax from imported Flex
+    statements (newest first); `years` overrides `days`. Total in X-Total-Count.
     """
-    return []
+    await _flex_refresh()
+    where = _flex_where(years * 365 if years else days, start, end, conId, symbol, currency, account)
+    rows, total = await asyncio.to_thread(_FLEX.query, "flex_dividends", _FLEX_DIV_COLS, where,
+                                          max(1, min(5000, int(limit))), max(0, int(offset)))
+    return _flex_page(response, rows, total)
+
+
+@router.get("/flex/trades")
+async def flex_trades(days: int = 365, conId: int | None = None, symbol: str | None = None,
+                      currency: str | None = None, account: str | None = None,
+                      start: str | None = None, end: str | None = None,
+                      limit: int = 500, offset: int = 0, response: Response = None):
+    """Trades imported from Flex statements (newest first)."""
+    await _flex_refresh()
+    where = _flex_where(days, start, end, conId, symbol, currency, account)
+    rows, total = await asyncio.to_thread(_FLEX.query, "flex_trades", _FLEX_TRADE_COLS, where,
+                                          max(1, min(5000, int(limit))), max(0, int(offset)))
+    return _flex_page(response, rows, total)
+
+
+@router.post("/flex/import")
+async def flex_import():
+    """Import any new or changed Flex XML files in runtime/flex/ now."""
+    return await asyncio.to_thread(_FLEX.scan)
+
+
+@router.get("/flex/status")
+async def flex_status():
+    rows = await asyncio.to_thread(lambda: _FLEX._db().execute(
+        "SELECT name, size, mtime, imported, rows FROM flex_files ORDER BY imported DESC").fetchall())
+    return {"dir": str(FLEX_DIR), "lastError": _FLEX.last_error,
+            "files": [dict(zip(("name", "size", "mtime", "imported", "rows"), r)) for r in rows]}
+
+
+# --- tax lots ------------------------------------------------------------------
+# Lots are matched from the execution store as fills arrive: each (account,
+# conId) keeps a deque of open lots (all on one side), closing fills consume
+# from the front (FIFO) or back (LIFO), so every lot is pushed/popped once.
+# Only rows past the last processed store rowid are read; a fill older than
+# the newest one already applied for its instrument (late catch-up) triggers a
+# replay of just that instrument. Realized PnL is price-based (gross of fees).
+# Whatever part of the mirrored position the stored fills do not explain was
+# opened before the store's history starts; it becomes an "opening" lot at the
+# position's avgCost, flagged basisKnown=false.
+TAXLOT_LONG_TERM_DAYS = int(os.getenv("IB_TAXLOT_LONG_TERM_DAYS", "365"))
+_LOT_METHODS = ("fifo", "lifo")
+_LOT_OPENING = "opening"
+
+def _lot_term(lot_id: str, held_s: float) -> str | None:
+    if lot_id == _LOT_OPENING:
+        return None  # real open date unknown
+    return "long" if held_s > TAXLOT_LONG_TERM_DAYS * 86400 else "short"
+
+class _LotBook:
+    __slots__ = ("account", "conId", "symbol", "mult", "lots", "closed", "realized", "last_ts",
+                 "net", "opening", "opening_px")
+
+    def __init__(self, account: str, conId: int, symbol: str | None, mult: float):
+        self.account, self.conId, self.symbol, self.mult = account, conId, symbol, mult
+        self.lots: deque = deque()        # [execId, ts, remaining qty (signed), price, original qty]
+        self.closed: list[dict] = []
+        self.realized = 0.0
+        self.last_ts = float("-inf")
+        self.net = 0.0                    # signed quantity of the applied fills
+        self.opening = 0.0                # quantity of the seeded opening lot
+        self.opening_px = 0.0
+
+    def seed(self, qty: float, price: float, ts: float) -> None:
+        """Opening lot for a position held before the first stored fill (call before apply)."""
+        self.opening, self.opening_px = qty, price
+        if abs(qty) > 1e-9:
+            self.lots.appendleft([_LOT_OPENING, ts, qty, price, qty])
+
+    def apply(self, r: dict, lifo: bool) -> None:
+        shares, price = r["shares"] or 0.0, r["price"]
+        if not shares or price is None:
+            return
+        qty = shares if str(r["side"] or "").upper() in ("BOT", "BUY") else -shares
+        ts = r["ts"]
+        self.last_ts = ts
+        self.net += qty
+        lots = self.lots
+        while abs(qty) > 1e-9 and lots and (lots[0][2] > 0) != (qty > 0):
+            lot = lots[-1] if lifo else lots[0]
+            sign = 1.0 if lot[2] > 0 else -1.0
+            take = min(abs(qty), abs(lot[2]))
+            pnl = (price - lot[3]) * take * sign * self.mult
+            self.realized += pnl
+            self.closed.append({
+                "account": self.account, "conId": self.conId, "symbol": self.symbol,
+                "lotId": lot[0], "closeExecId": r["execId"], "openTs": lot[1], "closeTs": ts,
+                "quantity": sign * take, "openPrice": lot[3], "closePrice": price,
+                "realized": pnl, "holdingDays": (ts - lot[1]) / 86400.0,
+                "term": _lot_term(lot[0], ts - lot[1]), "basisKnown": lot[0] != _LOT_OPENING,
+                "status": "closed",
+            })
+            lot[2] -= sign * take
+            qty += sign * take
+            if abs(lot[2]) <= 1e-9:
+                lots.pop() if lifo else lots.popleft()
+        if abs(qty) > 1e-9:
+            lots.append([r["execId"], ts, qty, price, qty])
+
+    def open_lots(self, now: float) -> list[dict]:
+        return [{
+            "account": self.account, "conId": self.conId, "symbol": self.symbol,
+            "lotId": eid, "openTs": ts, "openTime": util.formatIBDatetime(datetime.fromtimestamp(ts, timezone.utc)),
+            "quantity": q, "openQuantity": q0, "price": px, "costBasis": q * px * self.mult,
+            "holdingDays": (now - ts) / 86400.0,
+            "term": _lot_term(eid, now - ts), "basisKnown": eid != _LOT_OPENING, "status": "open",
+        } for eid, ts, q, px, q0 in self.lots]
+
+class _LotEngine:
+    def __init__(self):
+        self.books: dict[str, dict[tuple[str, int], _LotBook]] = {m: {} for m in _LOT_METHODS}
+        self.seq = dict.fromkeys(_LOT_METHODS, 0)
+        self.seen = dict.fromkeys(_LOT_METHODS, -1)      # _EXEC.version last synced
+        self._mult: dict[int, float] = {}
+
+    def _multiplier(self, conId: int) -> float:
+        m = self._mult.get(conId)
+        if m is None:
+            m = 1.0
+            try:
+                row = _EXEC._db().execute("SELECT contract FROM executions WHERE conId=? LIMIT 1", (conId,)).fetchone()
+                m = float((json.loads(row[0]) if row and row[0] else {}).get("multiplier") or 1.0)
+            except Exception:
+                pass
+            self._mult[conId] = m
+        return m
+
+    def _book(self, method: str, r: dict) -> _LotBook:
+        key = (r["account"] or "", int(r["conId"]))
+        b = self.books[method].get(key)
+        if b is None:
+            b = self.books[method][key] = _LotBook(key[0], key[1], r["symbol"], self._multiplier(key[1]))
+        return b
+
+    def _rebuild(self, method: str, key: tuple[str, int], opening: float = 0.0,
+                 price: float = 0.0, symbol: str | None = None) -> None:
+        """Replay one instrument's stored fills, after an opening lot when given."""
+        acct, cid = key
+        lifo = method == "lifo"
+        self.books[method].pop(key, None)
+        rows = [r for r in _EXEC.query(conId=cid) if (r["account"] or "") == acct]
+        if abs(opening) > 1e-9:
+            b = self._book(method, rows[0] if rows else {"account": acct, "conId": cid, "symbol": symbol})
+            b.seed(opening, price, rows[0]["ts"] if rows else time.time())
+        for r in rows:
+            self._book(method, r).apply(r, lifo)
+
+    def reconcile(self, method: str, conId: int) -> None:
+        """Seed/adjust opening lots so each book's quantity matches the mirrored position."""
+        if not _MIRROR.seeded:
+            return
+        pos = {k: p for k, p in _MIRROR.positions.items() if k[1] == int(conId)}
+        keys = set(pos) | {k for k in self.books[method] if k[1] == int(conId)}
+        for key in keys:
+            b = self.books[method].get(key)
+            p = pos.get(key) or {}
+            opening = (p.get("position") or 0.0) - (b.net if b else 0.0)
+            if abs(opening - (b.opening if b else 0.0)) <= 1e-9:
+                continue
+            # IB's avgCost is per unit including the multiplier
+            price = (p.get("avgCost") or 0.0) / (b.mult if b else self._multiplier(key[1]))
+            self._rebuild(method, key, opening, price, p.get("symbol"))
+
+    def update(self, method: str) -> None:
+        if self.seen[method] == _EXEC.version:
+            return
+        self.seen[method] = _EXEC.version
+        lifo = method == "lifo"
+        replay: set[tuple[str, int]] = set()
+        for r in _EXEC.query(after_rowid=self.seq[method]):
+            self.seq[method] = max(self.seq[method], r["seq"])
+            if not r["conId"]:
+                continue
+            key = (r["account"] or "", int(r["conId"]))
+            if key in replay:
+                continue
+            b = self._book(method, r)
+            if r["ts"] < b.last_ts:
+                replay.add(key)
+                continue
+            b.apply(r, lifo)
+        for key in replay:
+            b = self.books[method].get(key)
+            self._rebuild(method, key, b.opening if b else 0.0, b.opening_px if b else 0.0)
+
+    def for_conid(self, conId: int, method: str) -> list[_LotBook]:
+        self.update(method)
+        self.reconcile(method, conId)
+        return [b for (_, cid), b in self.books[method].items() if cid == int(conId)]
 
+_LOTS = _LotEngine()
+
+def _lot_method(method: str) -> str:
+    m = (method or "fifo").lower()
+    if m not in _LOT_METHODS:
+        raise HTTPException(400, "method must be fifo or lifo")
+    return m
 
 @router.get("/taxlots")
-async def taxlots(conId: int):
+async def taxlots(conId: int, method: str = "fifo", closed: bool = False):
     """
-    Placeholder for tax lot breakdown by instrument; IBKR API access is limited here.
-    Returns an empty array for now.
+    Open tax lots for conId from the lot engine (FIFO or LIFO matching over the
+    execution store). closed=true appends closed lot matches with realized PnL.
     """
-    return []
+    m = _lot_method(method)
+    await _EXEC.ensure()
+    now = time.time()
+    out: list[dict] = []
+    for b in _LOTS.for_conid(conId, m):
+        out.extend(b.open_lots(now))
+        if closed:
+            out.extend(b.closed)
+    return out
+
+@router.get("/taxlots/summary")
+async def taxlots_summary(conId: int, method: str = "fifo"):
+    m = _lot_method(method)
+    await _EXEC.ensure()
+    books = _LOTS.for_conid(conId, m)
+    pos = sum(l[2] for b in books for l in b.lots)
+    cost = sum(l[2] * l[3] for b in books for l in b.lots)
+    by_term: dict[str | None, float] = defaultdict(float)
+    for b in books:
+        for c in b.closed:
+            by_term[c["term"]] += c["realized"]
+    return {
+        "conId": conId, "method": m, "position": pos, "avgCost": cost / pos if pos else None,
+        "realized": sum(b.realized for b in books), "realizedShortTerm": by_term["short"],
+        "realizedLongTerm": by_term["long"], "realizedUnknownTerm": by_term[None],
+        "openLots": sum(len(b.lots) for b in books), "closedLots": sum(len(b.closed) for b in books),
+        "basisUnknownQty": sum(l[2] for b in books for l in b.lots if l[0] == _LOT_OPENING),
+        "commissions": _EXEC.commissions(conId),
+    }
 
 
 @router.get("/ticks/stream")
@@ -2253,8 +5589,9 @@ async def ticks_stream(
     async def _gen():
         # Replay last-value (per type) so UI has something immediately
         for k in keylist:
-            if k in TICKS_LAST:
-                yield f"event: tick\ndata: {json.dumps(TICKS_LAST[k], separators=(',',':'))}\n\n"
+            last = TICKS_BUF[k].last() if k in TICKS_BUF else None
+            if last:
+                yield f"event: tick\ndata: {json.dumps(last, separators=(',',':'))}\n\n"
         try:
             while True:
                 try:
@@ -2300,10 +5637,11 @@ async def ticks_recent(
     out: dict[str, list[dict]] = {}
     lim = max(1, min(2000, int(limit)))
     for typ in wanted:
-        buf = list(TICKS_BUF.get((int(conId), typ), deque()))
-        out[typ] = buf[-lim:]
+        ring = TICKS_BUF.get((int(conId), typ))
+        out[typ] = ring.rows(lim) if ring else []
     # also include the most recent unified view for convenience
-    out["_last"] = [TICKS_LAST[k] for k in [(int(conId), t) for t in wanted] if k in TICKS_LAST]
+    rings = [TICKS_BUF.get((int(conId), t)) for t in wanted]
+    out["_last"] = [r.last() for r in rings if r and len(r)]
     return out
 
 # --- expanded / “full” quote ------------------------------------------------
@@ -2324,12 +5662,9 @@ async def quote_full(
     except Exception as e:
         raise HTTPException(503, f"IBKR offline for quote/full: {e}")
     c = _mk_contract(symbol, conId, exchange, secType, currency)
-    # snapshot path is generally more reliable across data packages
-    tkr = ib.reqMktData(c, genericTickList="233", snapshot=True)  # 233 = RT Volume
-    await asyncio.sleep(0.35)
-    ib.cancelMktData(c)
-    # try to find the ticker IB created
-    t = next((x for x in ib.tickers() if getattr(x.contract, "conId", None) == getattr(c, "conId", None)), None)
+    if not getattr(c, "conId", None):
+        c = await _qualify(c)
+    t = await _mkt_ticker(c, "233", ("bid", "ask", "last", "close"), wait=1.0)  # 233 = RT Volume
     if not t:
         raise HTTPException(502, "quote/full: no ticker data")
     def _n(x): 
@@ -2370,44 +5705,510 @@ async def history(
     what: str = "TRADES",
     useRTH: bool = True,
 ):
+    """
+    Bars for `duration` ending now, sliced from the local bar store. Only the
+    missing tail (since the last stored bar) and head (before the first) are
+    requested from IB, and coarser timeframes are resampled from a finer
+    stored series; offline, whatever the store holds is served.
+    """
     cache_key = "hist-" + _safe_name(f"{conId or symbol}-{secType or 'STK'}-{duration}-{barSize}-{what}-{int(useRTH)}") + ".json"
+    bar_s = _bar_seconds(barSize)
+    _duration_parts(duration)
+    c = _mk_contract(symbol, conId, exchange, secType, currency)
+    online = True
+    offline_err: Exception | None = None
     try:
         await _ensure_connected()
     except Exception as e:
+        online = False
+        offline_err = e
+    if not getattr(c, "conId", None) or not getattr(c, "exchange", None) or not getattr(c, "currency", None):
+        c = await _qualify(c)  # contract store first, so this works offline for known instruments
+    cid = int(getattr(c, "conId", 0) or 0)
+    # ADJUSTED_LAST is rewritten retroactively and IB rejects an endDateTime for it
+    if not cid or what.upper() == "ADJUSTED_LAST":
+        if not online:
+            cached = _cache_read(cache_key, None)
+            if cached is not None:
+                return cached
+            raise HTTPException(503, f"IBKR offline and no history cache: {offline_err}")
+        try:
+            bars: list[BarData] = await _req_history(c, duration, barSize, what, useRTH)
+        except Exception as e:
+            raise HTTPException(502, detail=f"history failed: {e!s}")
+        out = {"contract": _hist_contract_json(c),
+               "bars": [{"t": b.date, "o": b.open, "h": b.high, "l": b.low, "c": b.close, "v": b.volume} for b in bars]}
+        _cache_write(cache_key, out)
+        return out
+
+    cols = await _bars_get(c, duration, barSize, what, useRTH, online)
+    if cols is None and online:
+        # IB answered but has no bars for this window (illiquid/new contract)
+        return {"contract": _hist_contract_json(c), "bars": []}
+    if cols is None:
         cached = _cache_read(cache_key, None)
         if cached is not None:
             return cached
-        raise HTTPException(503, f"IBKR offline and no history cache: {e}")
-    c = _mk_contract(symbol, conId, exchange, secType, currency)
-    if conId and (not getattr(c, "exchange", None) or not getattr(c, "currency", None)):
+        raise HTTPException(503, f"IBKR offline and no history cache: {offline_err}")
+    return {"contract": _hist_contract_json(c), "bars": _bars_json(cols, bar_s)}
+
+def _hist_contract_json(c: Contract) -> dict:
+    return {
+        "conId": getattr(c, "conId", None),
+        "symbol": getattr(c, "localSymbol", None) or getattr(c, "symbol", None),
+        "secType": getattr(c, "secType", None),
+        "currency": getattr(c, "currency", None),
+    }
+
+# --- bulk historical backfill (resumable jobs) ------------------------------
+BACKFILL_DIR = RUNTIME / "backfill"
+BACKFILL_PARALLEL = int(os.getenv("IB_BACKFILL_PARALLEL", "4"))
+BACKFILL_JOBS: dict[str, "_BackfillJob"] = {}
+
+class _BackfillJob:
+    """
+    Fills the bar store for a list of instruments back to IB's head timestamp
+    (or `since`). The bar files are the data checkpoint; the job file under
+    runtime/backfill records per-item progress so a restart picks up where
+    it stopped. Requests run at background priority through the scheduler,
+    so pacing is shared with (and yields to) interactive use.
+    """
+    def __init__(self, spec: dict):
+        self.spec = spec
+        self.task: asyncio.Task | None = None
+        self.cancelled = False  # set by the cancel endpoint; shutdown cancels leave the job resumable
+        self._t0 = 0.0
+        self._p0 = 0.0
+
+    @property
+    def id(self) -> str:
+        return self.spec["id"]
+
+    @property
+    def path(self) -> Path:
+        return BACKFILL_DIR / f"{self.id}.json"
+
+    def save(self) -> None:
+        try:
+            BACKFILL_DIR.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self.spec), encoding="utf-8")
+            os.replace(tmp, self.path)
+        except Exception:
+            log.exception("backfill checkpoint failed")
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def _item_progress(self, it: dict, now: float) -> float:
+        if it.get("state") == "done":
+            return 1.0
+        start, first = it.get("start"), it.get("from")
+        if not start or not first or now <= start:
+            return 0.0
+        return max(0.0, min(1.0, (now - first) / (now - start)))
+
+    def progress(self) -> float:
+        items = self.spec["items"]
+        now = time.time()
+        return sum(self._item_progress(it, now) for it in items) / len(items) if items else 1.0
+
+    def status(self, items: bool = True) -> dict:
+        p = self.progress()
+        eta = None
+        if self.spec["state"] == "running" and self._t0:
+            rate = (p - self._p0) / max(1e-6, time.time() - self._t0)
+            eta = int((1.0 - p) / rate) if rate > 0 else None
+        out = {k: v for k, v in self.spec.items() if k != "items"}
+        counts: dict[str, int] = defaultdict(int)
+        for it in self.spec["items"]:
+            counts[it.get("state", "queued")] += 1
+        out.update({"progress": round(p, 4), "etaSec": eta, "counts": dict(counts)})
+        if items:
+            out["items"] = self.spec["items"]
+        return out
+
+    async def _run(self) -> None:
+        _IB_PRIO.set(PRIO_BG)
+        self.spec["state"] = "running"
+        self._t0, self._p0 = time.time(), self.progress()
+        self.save()
+        q: asyncio.Queue = asyncio.Queue()
+        for it in self.spec["items"]:
+            if it.get("state") not in ("done", "error"):
+                q.put_nowait(it)
+        async def worker():
+            while not q.empty():
+                await self._item(q.get_nowait())
+        try:
+            await asyncio.gather(*(worker() for _ in range(max(1, min(self.spec.get("parallel", 1), q.qsize())))))
+            self.spec["state"] = "done"
+        except asyncio.CancelledError:
+            if not self.cancelled:
+                self.save()  # app shutdown: stay queued/running so _backfill_resume picks it up
+                raise
+            self.spec["state"] = "cancelled"
+        except Exception as e:
+            self.spec["state"] = "error"
+            self.spec["error"] = str(e)
+        self.spec["finished"] = time.time()
+        self.save()
+
+    async def _contract(self, it: dict) -> Contract:
+        if it.get("conId"):
+            return await _contract_from_conid(int(it["conId"]))
+        return await _resolve_contract(it["symbol"], it.get("secType") or "STK",
+                                       it.get("exchange") or "SMART", it.get("currency") or "USD")
+
+    async def _item(self, it: dict) -> None:
+        sp = self.spec
+        barSize, what, useRTH = sp["barSize"], sp["what"], sp["useRTH"]
+        bar_s = _bar_seconds(barSize)
+        while True:  # wait out disconnects instead of failing the item
+            try:
+                await _ensure_connected()
+                break
+            except Exception:
+                it["state"] = "waiting"
+                await asyncio.sleep(15)
+        it["state"] = "running"
+        try:
+            c = await self._contract(it)
+            it["conId"] = int(c.conId)
+            it.setdefault("symbol", getattr(c, "symbol", None))
+            if it.get("head") is None:
+                ts = await _IB_SCHED.run("hist", lambda: ib.reqHeadTimeStampAsync(
+                    c, whatToShow=what, useRTH=useRTH, formatDate=2))
+                it["head"] = _bar_epoch(ts) if ts else 0.0
+            it["start"] = max(it["head"] or 0.0, sp.get("since") or 0.0)
+            s = _BARS.series(c.conId, barSize, what, useRTH)
+            while True:
+                before = (len(s), s.cols["t"][0] if len(s) else None, s.meta.get("coveredFrom"))
+                s = await _bars_ensure(c, barSize, what, useRTH, it["start"])
+                first = s.cols["t"][0] if len(s) else None
+                it["from"], it["bars"] = first, len(s)
+                if first is not None and it["head"] and first <= it["head"] + bar_s and not s.meta.get("head"):
+                    s.meta["head"] = True
+                    s.save()
+                if first is None or first <= it["start"] + bar_s or s.meta.get("head") or (len(s), first, s.meta.get("coveredFrom")) == before:
+                    break
+                self.save()
+            it["state"] = "done"
+        except asyncio.CancelledError:
+            it["state"] = "queued"
+            raise
+        except HTTPException as e:
+            it["state"], it["error"] = "error", str(e.detail)
+        except Exception as e:
+            it["state"], it["error"] = "error", str(e)
+        self.save()
+
+def _backfill_resume() -> None:
+    """Restart jobs that were queued or running when the app stopped."""
+    try:
+        paths = sorted(BACKFILL_DIR.glob("*.json"))
+    except Exception:
+        return
+    for p in paths:
+        try:
+            spec = json.loads(p.read_text(encoding="utf-8"))
+        except Exception:
+            continue
+        job = BACKFILL_JOBS.setdefault(spec["id"], _BackfillJob(spec))
+        if spec.get("state") in ("queued", "running"):
+            job.start()
+
+@router.post("/backfill")
+async def backfill_start(payload: dict = Body(...)):
+    """
+    Start a backfill job.
+    Body: { "conIds": [...] | "symbols": [...] | "universe": true,
+            "barSize": "1 day", "what": "TRADES", "useRTH": true,
+            "since": "2015-01-01" | "years": 10, "parallel": 4 }
+    Without since/years the job goes back to IB's head timestamp.
+    """
+    items = [{"conId": int(x), "state": "queued"} for x in (payload.get("conIds") or []) if str(x).strip().isdigit()]
+    items += [{"symbol": str(x).strip().upper(), "state": "queued"} for x in (payload.get("symbols") or []) if str(x).strip()]
+    if payload.get("universe"):
+        items += [{"symbol": str(r.get("symbol", "")).upper(), "secType": r.get("secType"), "exchange": r.get("exchange"),
+                   "currency": r.get("currency"), "state": "queued"} for r in _universe() if r.get("symbol")]
+    if not items:
+        raise HTTPException(400, "conIds, symbols or universe required")
+    barSize = str(payload.get("barSize") or "1 day")
+    _bar_seconds(barSize)
+    since = None
+    if payload.get("since"):
+        try:
+            since = datetime.fromisoformat(str(payload["since"])).replace(tzinfo=timezone.utc).timestamp()
+        except Exception:
+            raise HTTPException(400, "since must be an ISO date")
+    elif payload.get("years"):
+        since = time.time() - float(payload["years"]) * 365 * 86400
+    spec = {
+        "id": f"bf-{int(time.time() * 1000):x}",
+        "created": time.time(),
+        "state": "queued",
+        "barSize": barSize,
+        "what": str(payload.get("what") or "TRADES").upper(),
+        "useRTH": bool(payload.get("useRTH", True)),
+        "since": since,
+        "parallel": max(1, min(16, int(payload.get("parallel") or BACKFILL_PARALLEL))),
+        "items": items,
+    }
+    job = BACKFILL_JOBS[spec["id"]] = _BackfillJob(spec)
+    job.save()
+    job.start()
+    return job.status(items=False)
+
+@router.get("/backfill")
+async def backfill_list():
+    return {"jobs": [j.status(items=False) for j in sorted(BACKFILL_JOBS.values(), key=lambda j: -j.spec["created"])]}
+
+@router.get("/backfill/{job_id}")
+async def backfill_status(job_id: str):
+    job = BACKFILL_JOBS.get(job_id)
+    if not job:
+        raise HTTPException(404, "unknown backfill job")
+    return job.status()
+
+@router.post("/backfill/{job_id}/cancel")
+async def backfill_cancel(job_id: str):
+    job = BACKFILL_JOBS.get(job_id)
+    if not job:
+        raise HTTPException(404, "unknown backfill job")
+    job.cancelled = True
+    if job.task and not job.task.done():
+        job.task.cancel()
+    elif job.spec["state"] in ("queued", "running"):
+        job.spec["state"] = "cancelled"
+        job.save()
+    return {"ok": True, "id": job_id}
+
+# --- live bar series (keepUpToDate) ----------------------------------------
+LIVE_IDLE_S = float(os.getenv("IB_LIVE_IDLE", "60"))   # keep an unwatched series this long
+
+class _LiveSeries:
+    def __init__(self, key: tuple, contract: Contract, bars, start: float, sess: "_Sessions | None"):
+        self.key = key                        # (conId, barSize subscribed at IB, what, useRTH)
+        self.contract = contract
+        self.bars = bars                      # ib_insync BarDataList, updated in place by IB
+        self.bar_s = _bar_seconds(key[1])
+        self.start = start                    # oldest time the subscription's duration reaches
+        self.sess = sess                      # session bounds for resampling to coarser charts
+        self.refs = 0
+        self.subs: dict[asyncio.Queue, str] = {}   # queue -> chart barSize
+        self.last_key: dict[int, float] = {}       # chart bar_s -> forming bucket start
+        self.idle: asyncio.TimerHandle | None = None
+
+    def cols(self, bars=None) -> dict[str, list]:
+        rows = _bars_rows(self.bars if bars is None else bars)
+        return {name: array("d", (r[n] for r in rows)) for n, name in enumerate(_BAR_COLS)}
+
+    def chart(self, bar_s: int, bars=None) -> dict[str, array]:
+        """Columns at a chart's bar size: the IB bars, or resampled from them."""
+        cols = self.cols(bars)
+        return cols if bar_s == self.bar_s else _resample(cols, bar_s, self.sess)
+
+class _LiveBars:
+    """
+    One reqHistoricalData(keepUpToDate=True) per (conId, barSize, what,
+    useRTH), shared by every chart watching it. The subscription is made at
+    the bar size /history itself reads (the _resample_base of the chart's
+    size, so coarser charts are resampled from it) and sized to the longest
+    duration asked for. Updates fan out to SSE queues and are written through
+    to the bar store, so /history on the same key needs no tail request while
+    the series is live. Unwatched series are cancelled after LIVE_IDLE_S.
+    """
+    def __init__(self):
+        self._series: dict[tuple, _LiveSeries] = {}
+        self._locks: dict[tuple, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    def active(self, key: tuple) -> bool:
+        return key in self._series
+
+    def covers(self, key: tuple, last: float) -> bool:
+        """True when a live series on key writes through contiguously after a stored bar at `last`."""
+        ls = self._series.get(key)
+        if ls is None:
+            return False
+        try:
+            return bool(ls.bars) and last >= _bar_epoch(ls.bars[0].date) - ls.bar_s
+        except Exception:
+            return False
+
+    async def _subscribe(self, c: Contract, src: str, what: str, useRTH: bool, duration: str):
+        return await _IB_SCHED.run(_hist_class(src), lambda: ib.reqHistoricalDataAsync(
+            c, endDateTime="", durationStr=duration, barSizeSetting=src, whatToShow=what,
+            useRTH=useRTH, formatDate=2, keepUpToDate=True))
+
+    async def acquire(self, c: Contract, barSize: str, what: str, useRTH: bool, duration: str) -> _LiveSeries:
+        src = _resample_base(barSize, duration) or barSize
+        key = (int(c.conId), src, what.upper(), bool(useRTH))
+        start = _bars_window(duration, _bar_seconds(src), time.time())
+        async with self._locks[key]:
+            ls = self._series.get(key)
+            if ls is None or start < ls.start:
+                # bring the stored tail up to now first, so write-through stays contiguous
+                try:
+                    await _bars_ensure(c, src, what, useRTH, time.time())
+                except Exception:
+                    pass
+                bars = await self._subscribe(c, src, what, useRTH, duration)
+                if ls is None:
+                    sess = None
+                    if src != barSize:
+                        try:
+                            d = (await _details_for(Contract(conId=int(c.conId))))[0]
+                            sess = _Sessions(d.liquidHours if useRTH else d.tradingHours, d.timeZoneId)
+                        except Exception:
+                            pass
+                    ls = self._series[key] = _LiveSeries(key, c, bars, start, sess)
+                else:
+                    # a longer window than the current subscription covers: swap it in place
+                    try:
+                        ib.cancelHistoricalData(ls.bars)
+                    except Exception:
+                        pass
+                    ls.bars, ls.start = bars, start
+                self._store(ls, _bars_rows(bars), closed=True)
+                bars.updateEvent += lambda b, hasNewBar, ls=ls, bars=bars: ls.bars is bars and self._on_update(ls, hasNewBar)
+            ls.refs += 1
+            if ls.idle:
+                ls.idle.cancel()
+                ls.idle = None
+            return ls
+
+    def release(self, ls: _LiveSeries) -> None:
+        ls.refs = max(0, ls.refs - 1)
+        if ls.refs == 0 and ls.idle is None and self._series.get(ls.key) is ls:
+            ls.idle = asyncio.get_running_loop().call_later(LIVE_IDLE_S, self._drop, ls.key)
+
+    def _drop(self, key: tuple) -> None:
+        ls = self._series.get(key)
+        if ls is None or ls.refs > 0:
+            return
+        self._series.pop(key, None)
+        try:
+            ib.cancelHistoricalData(ls.bars)
+        except Exception:
+            pass
+
+    def reset(self) -> None:
+        """Connection lost: the subscriptions are gone; end every stream so clients reconnect."""
+        for ls in list(self._series.values()):
+            if ls.idle:
+                ls.idle.cancel()
+            for q in list(ls.subs):
+                try:
+                    q.put_nowait(None)
+                except asyncio.QueueFull:
+                    pass
+        self._series.clear()
+
+    def _store(self, ls: _LiveSeries, rows: list[tuple], closed: bool) -> None:
+        """Write through to the bar store when it stays contiguous with what is stored."""
+        if not rows:
+            return
+        conId, barSize, what, useRTH = ls.key
+        s = _BARS.series(conId, barSize, what, useRTH)
+        if len(s) and s.cols["t"][-1] < rows[0][0] - ls.bar_s:
+            return  # leave the gap to the next /history tail pass
+        s.merge(rows)
+        if closed:
+            s.meta["tailTo"] = time.time()
+            s.save()
+
+    def _chart_msgs(self, ls: _LiveSeries, barSize: str, hasNewBar: bool) -> list[dict]:
+        bar_s = _bar_seconds(barSize)
+        if bar_s == ls.bar_s:
+            cols = ls.cols(ls.bars[-2:] if hasNewBar else ls.bars[-1:])
+            closed = [hasNewBar and k == 0 for k in range(len(cols["t"]))]
+        else:
+            # enough source bars to hold the previous and the forming chart bar whole
+            cols = ls.chart(bar_s, ls.bars[-(2 * bar_s // ls.bar_s + 1):])
+            if not cols["t"]:
+                return []
+            prev = ls.last_key.get(bar_s)
+            ls.last_key[bar_s] = cols["t"][-1]
+            k0 = len(cols["t"]) - (2 if prev is not None and cols["t"][-1] > prev and len(cols["t"]) > 1 else 1)
+            cols = {name: a[k0:] for name, a in cols.items()}
+            closed = [k < len(cols["t"]) - 1 for k in range(len(cols["t"]))]
+        return [{"conId": ls.key[0], "barSize": barSize,
+                 "bar": _bars_json({name: a[k:k + 1] for name, a in cols.items()}, bar_s)[0], "closed": closed[k]}
+                for k in range(len(cols["t"]))]
+
+    def _on_update(self, ls: _LiveSeries, hasNewBar: bool) -> None:
         try:
-            [c] = await ib.qualifyContractsAsync(c)
+            rows = _bars_rows(ls.bars[-2:] if hasNewBar else ls.bars[-1:])
+            self._store(ls, rows, closed=hasNewBar)
+            if not ls.subs:
+                return
+            msgs = {bs: self._chart_msgs(ls, bs, hasNewBar) for bs in set(ls.subs.values())}
+            for q, bs in list(ls.subs.items()):
+                for m in msgs[bs]:
+                    try:
+                        q.put_nowait(m)
+                    except asyncio.QueueFull:
+                        pass
         except Exception:
             pass
+
+_LIVE = _LiveBars()
+ib.disconnectedEvent += _LIVE.reset
+
+@router.get("/history/stream")
+async def history_stream(
+    conId: int,
+    barSize: str = "5 mins",
+    what: str = "TRADES",
+    useRTH: bool = True,
+    duration: str = "1 D",
+    keepalive: float = 20.0,
+):
+    """
+    SSE of a live bar series (IB keepUpToDate). Charts on the same key share
+    one IB subscription.
+      event: snapshot  data: { conId, barSize, bars: [{t,o,h,l,c,v}, ...] }
+      event: bar       data: { conId, barSize, bar: {...}, closed }   (closed = bar is final)
+    The stream ends if the IB connection drops; reconnect to resubscribe.
+    """
+    bar_s = _bar_seconds(barSize)
+    if bar_s < 5:
+        raise HTTPException(400, "keepUpToDate needs bars of 5 secs or more")
+    _duration_parts(duration)
+    await _ensure_connected()
+    c = await _contract_from_conid(int(conId))
     try:
-        bars: list[BarData] = await ib.reqHistoricalDataAsync(
-            c,
-            endDateTime="",
-            durationStr=duration,
-            barSizeSetting=barSize,
-            whatToShow=what,
-            useRTH=useRTH,
-            formatDate=2,
-            keepUpToDate=False,
-        )
+        ls = await _LIVE.acquire(c, barSize, what, useRTH, duration)
     except Exception as e:
-        raise HTTPException(502, detail=f"history failed: {e!s}")
-    out = {
-        "contract": {
-            "conId": getattr(c, "conId", None),
-            "symbol": getattr(c, "localSymbol", None) or getattr(c, "symbol", None),
-            "secType": c.secType,
-            "currency": c.currency,
-        },
-        "bars": [{"t": b.date, "o": b.open, "h": b.high, "l": b.low, "c": b.close, "v": b.volume} for b in bars],
-    }
-    _cache_write(cache_key, out)
-    return out
+        raise HTTPException(502, f"live history failed: {e!s}")
+    q: asyncio.Queue = asyncio.Queue(maxsize=1000)
+    ls.subs[q] = barSize
+    async def _gen():
+        try:
+            cols = ls.chart(bar_s)
+            if cols["t"]:
+                ls.last_key.setdefault(bar_s, cols["t"][-1])
+            i = bisect.bisect_left(cols["t"], _bars_window(duration, bar_s, time.time()))
+            cols = {name: a[i:] for name, a in cols.items()}
+            snap = {"conId": int(conId), "barSize": barSize, "bars": _bars_json(cols, bar_s)}
+            yield f"event: snapshot\ndata: {json.dumps(snap, separators=(',',':'))}\n\n"
+            while True:
+                try:
+                    item = await asyncio.wait_for(q.get(), timeout=max(5.0, float(keepalive)))
+                except asyncio.TimeoutError:
+                    yield f": keepalive {int(time.time())}\n\n"
+                    continue
+                if item is None:
+                    return
+                yield f"event: bar\ndata: {json.dumps(item, separators=(',',':'))}\n\n"
+        except asyncio.CancelledError:
+            return
+        finally:
+            ls.subs.pop(q, None)
+            _LIVE.release(ls)
+    return StreamingResponse(_gen(), media_type="text/event-stream")
 
 # --- Contract details (minTick, tradingHours, multiplier, etc.) -------------
 @router.get("/contract/details")
@@ -2418,9 +6219,8 @@ async def contract_details(
     exchange: str = "SMART",
     currency: str = "USD",
 ):
-    await _ensure_connected()
     c = _mk_contract(symbol, conId, exchange, secType, currency)
-    cds = await ib.reqContractDetailsAsync(c)
+    cds = await _details_for(c)
     if not cds:
         raise HTTPException(404, "No contract details")
     def _cd_json(cd):
@@ -2437,13 +6237,19 @@ async def contract_details(
             "evRule": getattr(cd, "evRule", None),
             "evMultiplier": getattr(cd, "evMultiplier", None),
             "secIdList": getattr(cd, "secIdList", None),
+            "marketRuleIds": getattr(cd, "marketRuleIds", None),
         }
-    return {"details": [_cd_json(cd) for cd in cds]}
+    out = [_cd_json(cd) for cd in cds]
+    if ib.isConnected():
+        for row, cd in zip(out, cds):
+            row["marketRules"] = await _market_rules(cd)
+    return {"details": out}
 
 def _parse_ib_hours(s: str | None) -> list[dict]:
     """
-    Parse IB's tradingHours/liquidHours format like 'YYYYMMDD:HHMM-HHMM;YYYYMMDD:CLOSED;...'
-    into a structured list.
+    Parse IB's tradingHours/liquidHours into a structured list. Handles both
+    'YYYYMMDD:HHMM-HHMM[,HHMM-HHMM];YYYYMMDD:CLOSED' and the current
+    'YYYYMMDD:HHMM-YYYYMMDD:HHMM;...' form (closeDate is set for the latter).
     """
     out = []
     if not s:
@@ -2458,9 +6264,14 @@ def _parse_ib_hours(s: str | None) -> list[dict]:
         if span.upper() == "CLOSED":
             out.append({"date": day, "closed": True})
             continue
-        if "-" in span:
-            o, c = span.split("-", 1)
-            out.append({"date": day, "open": o, "close": c, "closed": False})
+        for rng in span.split(","):
+            if "-" not in rng:
+                continue
+            o, c = rng.split("-", 1)
+            row = {"date": day, "open": o, "close": c, "closed": False}
+            if ":" in c:
+                row["closeDate"], row["close"] = c.split(":", 1)
+            out.append(row)
     return out
 
 @router.get("/tradinghours")
@@ -2472,9 +6283,8 @@ async def trading_hours(
     """
     Convenience endpoint exposing trading/liquid hours without the full details blob.
     """
-    await _ensure_connected()
     c = await _contract_from_conid(int(conId)) if conId else await _resolve_contract(symbol or "", "STK", exchange, "USD")
-    cds = await ib.reqContractDetailsAsync(c)
+    cds = await _details_for(c)
     if not cds:
         raise HTTPException(404, "No contract details")
     cd = cds[0]
@@ -2491,6 +6301,11 @@ async def trading_hours(
 # --- Market depth (Level 2) -------------------------------------------------
 @router.get("/marketdepth")
 async def market_depth(conId: int, depth: int = 10, smart: bool = True):
+    book = DEPTH_BOOKS.get(conId)
+    if book is not None and (book.bids or book.asks):
+        # a stream already maintains this book; don't open a second depth line
+        snap = book.snapshot()
+        return {"conId": conId, "bids": snap["bids"][:depth], "asks": snap["asks"][:depth], "stats": snap["stats"]}
     await _ensure_connected()
     c = await _contract_from_conid(conId)
     tkr = ib.reqMktDepth(c, numRows=max(1, min(20, depth)), isSmartDepth=bool(smart))
@@ -2613,7 +6428,7 @@ async def earnings(conId: int):
     await _ensure_connected()
     c = await _contract_from_conid(conId)
     try:
-        xml = await ib.reqFundamentalDataAsync(c, reportType="CalendarReport")
+        xml = await _req_fundamentals(c, "CalendarReport")
     except Exception as e:
         raise HTTPException(502, f"earnings fetch failed: {e!s}")
     out = {"conId": conId, "symbol": c.symbol}
@@ -2664,7 +6479,7 @@ async def what_if(payload: dict = Body(...)):
         order = MarketOrder(side, qty)
     order.whatIf = True
     try:
-        rep = await ib.whatIfOrderAsync(c, order)
+        rep = await _IB_SCHED.run("details", lambda: ib.whatIfOrderAsync(c, order))
     except Exception as e:
         raise HTTPException(502, f"what-if failed: {e!s}")
     # ib_insync returns OrderState-like with margin/commission fields
@@ -2700,10 +6515,7 @@ async def shortability(conId: int):
     """
     await _ensure_connected()
     c = await _contract_from_conid(conId)
-    tkr = ib.reqMktData(c, genericTickList="236,593", snapshot=True)
-    await asyncio.sleep(0.4)
-    ib.cancelMktData(c)
-    t = next((x for x in ib.tickers() if getattr(x.contract, "conId", None) == conId), None)
+    t = await _mkt_ticker(c, "236,593", ("shortableShares", "feeRate"), wait=1.0)
     if not t:
         raise HTTPException(502, "shortability: no data")
     # Field names vary; use getattr defensively
@@ -2736,46 +6548,169 @@ async def realized_pnl(conId: int, days: int = 365):
     realized PnL from these if desired. (IB doesn’t expose a simple per-conId
     realized PnL endpoint.)
     """
-    await _ensure_connected()
-    # Time filter: last N days
-    since = datetime.utcnow().timestamp() - max(1, int(days)) * 86400
-    exe_filter = util.ExecutionFilter(time=datetime.utcfromtimestamp(since))
-    exes = await ib.reqExecutionsAsync(exe_filter)
-    rows = []
-    for r in exes or []:
+    await _EXEC.ensure()
+    since = time.time() - max(1, int(days)) * 86400
+    return [{k: r[k] for k in ("time", "side", "price", "shares", "commission", "realizedPNL", "orderId", "execId")}
+            for r in _EXEC.query(conId=int(conId), since=since)]
+
+# --- live PnL subscriptions --------------------------------------------------
+# One reqPnL per managed account and one reqPnLSingle per mirrored position,
+# opened/closed as positions come and go. Totals over positions are adjusted
+# by the delta of each pnlSingleEvent and re-summed on sync and each sweep.
+PNL_IDLE_S = float(os.getenv("IB_PNL_IDLE", "300"))     # on-demand /pnl/single subs without a position
+_PNL_FIELDS = (("daily", "dailyPnL"), ("unrealized", "unrealizedPnL"), ("realized", "realizedPnL"))
+
+class _PnLManager:
+    def __init__(self):
+        self.accounts: dict[str, dict] = {}              # account -> {daily, unrealized, realized, ts}
+        self.single: dict[tuple[str, int], dict] = {}     # (account, conId) -> row
+        self.totals = {"daily": 0.0, "unrealized": 0.0, "realized": 0.0}
+        self.subs: set[tuple[str, int]] = set()
+        self.held: set[tuple[str, int]] = set()          # keys counted in totals (mirrored positions)
+        self.acct_subs: set[str] = set()
+        self.extra: dict[tuple[str, int], float] = {}     # on-demand keys -> last access
+        self.version = 0
+        self.queues: set[asyncio.Queue] = set()
+        self._sync_pending = False
+        self._cached_version = -1
+
+    # ---- subscriptions ----
+    def schedule_sync(self, *_):
+        if self._sync_pending:
+            return
+        self._sync_pending = True
         try:
-            c = getattr(r, "contract", None)
-            if not c or getattr(c, "conId", None) != int(conId):
-                continue
-            cr = getattr(r, "commissionReport", None)
-            rows.append({
-                "time": util.formatIBDatetime(getattr(r, "time", None)) if getattr(r, "time", None) else None,
-                "side": getattr(r, "side", None),
-                "price": _num_or_none(getattr(r, "price", None)),
-                "shares": _num_or_none(getattr(r, "shares", None)),
-                "commission": _num_or_none(getattr(cr, "commission", None)) if cr else None,
-                "realizedPNL": _num_or_none(getattr(cr, "realizedPNL", None)) if cr else None,
-                "orderId": getattr(r, "orderId", None),
-                "execId": getattr(r, "execId", None),
-            })
+            asyncio.get_running_loop().call_soon(self.sync)
+        except RuntimeError:
+            self.sync()
+
+    def sync(self) -> None:
+        self._sync_pending = False
+        if not ib.isConnected():
+            return
+        try: accts = set(ib.managedAccounts() or ())
+        except Exception: accts = set()
+        held = {(p["account"], int(p["conId"])) for p in _MIRROR.view("positions") if p.get("conId")}
+        self.held = held
+        self.retotal()
+        accts |= {a for a, _ in held}
+        for a in accts - self.acct_subs:
+            try:
+                ib.reqPnL(a, "")
+                self.acct_subs.add(a)
+            except Exception:
+                pass
+        want = held | set(self.extra)
+        for key in want - self.subs:
+            try:
+                ib.reqPnLSingle(key[0], "", key[1])
+                self.subs.add(key)
+            except Exception:
+                pass
+        for key in self.subs - want:
+            try: ib.cancelPnLSingle(key[0], "", key[1])
+            except Exception: pass
+            self.subs.discard(key)
+            self._drop(key)
+
+    def retotal(self) -> None:
+        """Re-sum totals over held positions, so delta updates cannot drift."""
+        rows = [self.single[k] for k in self.held if k in self.single]
+        self.totals = {f: sum(r[f] or 0.0 for r in rows) for f, _ in _PNL_FIELDS}
+
+    def sweep(self) -> None:
+        cutoff = time.time() - PNL_IDLE_S
+        stale = [k for k, ts in self.extra.items() if ts < cutoff]
+        for k in stale:
+            del self.extra[k]
+        if stale:
+            self.sync()
+        else:
+            self.retotal()
+
+    def reset(self, *_) -> None:
+        """Connection lost: IB dropped the subscriptions; keep last values for reads."""
+        self.subs.clear()
+        self.acct_subs.clear()
+
+    # ---- updates ----
+    def _publish(self, item: dict) -> None:
+        self.version += 1
+        for q in list(self.queues):
+            try: q.put_nowait(item)
+            except asyncio.QueueFull: pass
+
+    def _drop(self, key: tuple[str, int]) -> None:
+        if self.single.pop(key, None) is None:
+            return
+        self._publish({"type": "closed", "account": key[0], "conId": key[1], "totals": dict(self.totals)})
+
+    def on_single(self, v) -> None:
+        try:
+            key = (v.account, int(v.conId))
+            if key not in self.subs:
+                return
+            row = {"account": v.account, "conId": key[1], "ts": time.time(),
+                   "position": _ib_num(getattr(v, "position", None)),
+                   "value": _ib_num(getattr(v, "value", None))}
+            old = self.single.get(key) if key in self.held else None
+            for f, attr in _PNL_FIELDS:
+                row[f] = _ib_num(getattr(v, attr, None))
+                if key in self.held:
+                    self.totals[f] += (row[f] or 0.0) - ((old[f] or 0.0) if old else 0.0)
+            self.single[key] = row
+            self._publish({"type": "single", **row, "totals": dict(self.totals)})
         except Exception:
-            continue
-    return rows
+            pass
+
+    def on_account(self, v) -> None:
+        try:
+            row = {f: _ib_num(getattr(v, attr, None)) for f, attr in _PNL_FIELDS}
+            row["ts"] = time.time()
+            self.accounts[v.account] = row
+            self._publish({"type": "account", "account": v.account, **row})
+        except Exception:
+            pass
+
+    # ---- views ----
+    def summary(self) -> dict:
+        acct = {f: sum(a[f] or 0.0 for a in self.accounts.values()) for f, _ in _PNL_FIELDS} if self.accounts else None
+        tot = self.totals
+        return {"realized": tot["realized"], "unrealized": tot["unrealized"], "daily": tot["daily"],
+                "account": acct, "positions": len(self.held), "version": self.version,
+                "live": bool(ib.isConnected() and self.subs)}
+
+    async def single_for(self, conId: int, wait: float = 2.0) -> dict | None:
+        keys = [k for k in self.single if k[1] == conId]
+        if keys:
+            for k in keys:
+                if k in self.extra:
+                    self.extra[k] = time.time()
+            return self.single[keys[0]]
+        await _ensure_connected()
+        key = (await _account_code(), int(conId))
+        self.extra[key] = time.time()
+        self.sync()
+        deadline = time.time() + wait
+        while key not in self.single and time.time() < deadline:
+            await asyncio.sleep(0.05)
+        return self.single.get(key)
+
+_PNL = _PnLManager()
+ib.pnlSingleEvent += _PNL.on_single
+ib.pnlEvent += _PNL.on_account
+ib.disconnectedEvent += _PNL.reset
+_MIRROR.on_change.append(lambda section: section == "positions" and _PNL.schedule_sync())
 
-# --- PnL for a single contract --------------------------------------------
 @router.get("/pnl/single")
 async def pnl_single(conId: int):
     cache_key = f"pnl-{int(conId)}.json"
     try:
-        await _ensure_connected()
-        account = await _account_code()
-        pnl = await ib.reqPnLSingleAsync(account, "", conId)
-        out = {
-            "conId": conId,
-            "daily": getattr(pnl, "dailyPnL", 0) or 0,
-            "unrealized": getattr(pnl, "unrealizedPnL", 0) or 0,
-            "realized": getattr(pnl, "realizedPnL", 0) or 0,
-        }
+        row = await _PNL.single_for(int(conId))
+        if row is None:
+            raise RuntimeError("no PnL update yet")
+        out = {"conId": conId, "daily": row["daily"] or 0, "unrealized": row["unrealized"] or 0,
+               "realized": row["realized"] or 0, "position": row["position"], "value": row["value"]}
         _cache_write(cache_key, out)
         return out
     except Exception as e:
@@ -2787,7 +6722,90 @@ async def pnl_single(conId: int):
         "daily": 0, "unrealized": 0, "realized": 0
     }
 
+@router.get("/pnl/stream")
+async def pnl_stream(poll_keepalive: float = 20.0):
+    """
+    SSE of live PnL. Emits `snapshot` first ({summary, positions:[...]}), then
+    `pnl` events: {type: single|closed, ..., totals} or {type: account, ...}.
+    """
+    try:
+        await _MIRROR.ensure()
+    except Exception:
+        pass
+    _PNL.sync()
+    q: asyncio.Queue = asyncio.Queue(maxsize=1000)
+    _PNL.queues.add(q)
+    async def _gen():
+        snap = {"summary": _PNL.summary(), "positions": list(_PNL.single.values())}
+        yield f"event: snapshot\ndata: {json.dumps(snap, separators=(',',':'))}\n\n"
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(q.get(), timeout=max(5.0, float(poll_keepalive)))
+                    yield f"event: pnl\ndata: {json.dumps(item, separators=(',',':'))}\n\n"
+                except asyncio.TimeoutError:
+                    yield f": keepalive {int(time.time())}\n\n"
+        except asyncio.CancelledError:
+            return
+        finally:
+            _PNL.queues.discard(q)
+    return StreamingResponse(_gen(), media_type="text/event-stream")
+
 # --- Portfolio spark by summing USD positions ------------------------------
+# Bars for all positions are fetched concurrently (the IB scheduler still paces
+# the underlying history requests) and merged on the union of their timestamps:
+# each series is forward-filled, and held at its first close before it starts.
+# Curves are cached per (duration, barSize); while positions are unchanged only
+# the tail from the last cached point onward is recomputed (cached points keep
+# the last price seen for a series even after that bar slides out of its window).
+SPARK_CONCURRENCY = int(os.getenv("IB_SPARK_CONCURRENCY", "8"))
+_SPARK: dict[tuple[str, str], dict] = {}   # (duration, barSize) -> {sig, t, v}
+
+def _spark_events(t: array, c: array, qty: float, k: int, i: int):
+    for j in range(i, len(t)):
+        yield t[j], k, c[j] * qty
+
+def _spark_merge(series: list[tuple[array, array, float]], since: float | None = None) -> tuple[array, array]:
+    """
+    Equity on the union grid of all series' timestamps >= since. A running total
+    is adjusted by each series' change, so the k-way merge is O(N log k).
+    """
+    last: list[float] = []
+    streams = []
+    for k, (t, c, qty) in enumerate(series):
+        i = bisect.bisect_left(t, since) if since is not None else 0
+        last.append((c[i - 1] if i > 0 else c[0]) * qty if len(c) else 0.0)
+        streams.append(_spark_events(t, c, qty, k, i))
+    total = math.fsum(last)
+    out_t, out_v = array("d"), array("d")
+    for ts, k, v in heapq.merge(*streams):
+        total += v - last[k]
+        last[k] = v
+        if out_t and out_t[-1] == ts:
+            out_v[-1] = total
+        else:
+            out_t.append(ts)
+            out_v.append(total)
+    return out_t, out_v
+
+def _spark_update(key: tuple[str, str], sig: tuple, series: dict[int, tuple[array, array, float]]) -> tuple[array, array]:
+    ser = [series[cid] for cid in sorted(series)]
+    w0 = min((s[0][0] for s in ser if len(s[0])), default=0.0)
+    st = _SPARK.get(key)
+    # the cached prefix stays valid while positions are unchanged and the window
+    # only slid forward (an earlier start means history was filled in: rebuild)
+    if st and st["sig"] == sig and len(st["t"]) and st["t"][0] <= w0:
+        cut = st["t"][-1]
+        lo = bisect.bisect_left(st["t"], w0)
+        hi = bisect.bisect_left(st["t"], cut)
+        tail_t, tail_v = _spark_merge(ser, since=cut)
+        t = st["t"][lo:hi] + tail_t
+        v = st["v"][lo:hi] + tail_v
+    else:
+        t, v = _spark_merge(ser)
+    _SPARK[key] = {"sig": sig, "t": t, "v": v}
+    return t, v
+
 @router.get("/portfolio/spark")
 async def portfolio_spark(duration: str = "1 D", barSize: str = "5 mins"):
     """
@@ -2802,38 +6820,28 @@ async def portfolio_spark(duration: str = "1 D", barSize: str = "5 mins"):
         if cached is not None:
             return cached
         return {"points": [], "note": "offline and no cache"}
-    # mirror /positions robustness
-    try:
-        if hasattr(ib, "reqPositionsAsync"):
-            pos = await ib.reqPositionsAsync()
-        else:
-            ib.reqPositions()
-            await asyncio.sleep(1.0)
-            pos = list(ib.positions())
-    finally:
-        try: ib.cancelPositions()
-        except Exception: pass
-    usd = [p for p in pos if (p.contract.currency or "USD") == "USD"]
+    await _MIRROR.ensure()
+    usd = [p for p in _MIRROR.view("positions") if (p["currency"] or "USD") == "USD" and p["conId"] and p["position"]]
     if not usd:
         return {"points": [], "note": "no USD positions"}
-    # fetch bars per conId and align by index
-    series = []
-    for p in usd:
-        bars = await ib.reqHistoricalDataAsync(
-            p.contract, endDateTime="", durationStr=duration, barSizeSetting=barSize,
-            whatToShow="TRADES", useRTH=True, formatDate=2
-        )
-        series.append([ (b.date.timestamp() if hasattr(b.date, "timestamp") else util.parseIBDatetime(b.date).timestamp(), b.close * p.position) for b in bars ])
-    # align by index position (IB returns same count for same params typically)
-    length = min(len(s) for s in series)
-    if length == 0:
+    sem = asyncio.Semaphore(max(1, SPARK_CONCURRENCY))
+    async def _one(p: dict):
+        async with sem:
+            c = await _contract_from_conid(int(p["conId"]))
+            return await _bars_get(c, duration, barSize, "TRADES", True, True) if getattr(c, "conId", 0) else None
+    res = await asyncio.gather(*(_one(p) for p in usd), return_exceptions=True)
+    series: dict[int, tuple[array, array, float]] = {}
+    for p, cols in zip(usd, res):
+        if isinstance(cols, BaseException):
+            log.warning("portfolio spark: bars for %s failed: %s", p["conId"], cols)
+            continue
+        if cols and len(cols["t"]):
+            series[int(p["conId"])] = (cols["t"], cols["c"], float(p["position"]))
+    if not series:
         return {"points": [], "note": "no bars"}
-    points = []
-    for i in range(length):
-        ts = series[0][i][0]
-        total = sum(s[i][1] for s in series if len(s) > i)
-        points.append([ts, float(total)])
-    out = {"points": points}
+    sig = tuple(sorted((cid, s[2]) for cid, s in series.items()))
+    t, v = _spark_update((duration, barSize), sig, series)
+    out = {"points": [[ts, val] for ts, val in zip(t, v)]}
     _cache_write(cache_key, out)
     return out
     
@@ -2842,29 +6850,12 @@ async def portfolio_spark(duration: str = "1 D", barSize: str = "5 mins"):
 async def pnl_summary():
     cache_key = "pnl_summary.json"
     try:
-        await _ensure_connected()
-        account = await _account_code()
-        try:
-            if hasattr(ib, "reqPositionsAsync"):
-                pos = await ib.reqPositionsAsync()
-            else:
-                ib.reqPositions()
-                await asyncio.sleep(1.0)
-                pos = list(ib.positions())
-        finally:
-            try: ib.cancelPositions()
-            except Exception: pass
-        total_realized = 0.0
-        total_unrealized = 0.0
-        for p in pos or []:
-            try:
-                pnl = await ib.reqPnLSingleAsync(account, "", int(p.contract.conId))
-                total_realized += float(getattr(pnl, "realizedPnL", 0) or 0)
-                total_unrealized += float(getattr(pnl, "unrealizedPnL", 0) or 0)
-            except Exception:
-                continue
-        out = {"realized": total_realized, "unrealized": total_unrealized}
-        _cache_write(cache_key, out)
+        await _MIRROR.ensure()
+        _PNL.sync()
+        out = _PNL.summary()
+        if _PNL.version != _PNL._cached_version:
+            _PNL._cached_version = _PNL.version
+            _cache_write(cache_key, out)
         return out
     except Exception as e:
         cached = _cache_read(cache_key, None)
@@ -2872,6 +6863,165 @@ async def pnl_summary():
             return cached
         return {"realized": 0.0, "unrealized": 0.0}
     
+# --- NAV recorder ------------------------------------------------------------
+# Samples net liquidation, cash and realized/unrealized PnL from the account
+# mirror and live PnL state every IB_NAV_SAMPLE_S into nav.db. Each sample is
+# also folded into 1-minute and 1-hour rollups (last value + min/max NetLiq),
+# so long ranges are answered from a coarse tier. Unchanged samples are only
+# written as a heartbeat once a minute.
+NAV_DB = RUNTIME / "nav.db"
+NAV_SAMPLE_S = float(os.getenv("IB_NAV_SAMPLE_S", "5"))
+NAV_RAW_DAYS = float(os.getenv("IB_NAV_RAW_DAYS", "3"))
+NAV_1M_DAYS = float(os.getenv("IB_NAV_1M_DAYS", "120"))
+_NAV_TIERS = (("raw", 0), ("1m", 60), ("1h", 3600))     # 1h is kept forever
+_NAV_COLS = ("t", "netLiq", "cash", "realized", "unrealized", "min", "max")
+
+class _NavStore:
+    """
+    nav_raw(account, ts, netliq, cash, realized, unrealized)
+    nav_1m / nav_1h(account, ts, netliq, lo, hi, cash, realized, unrealized, n)
+    All keyed (account, ts) WITHOUT ROWID, so range reads are index scans.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self._con: sqlite3.Connection | None = None
+        self._last: dict[str, tuple] = {}      # account -> (values, ts written)
+        self._pruned = 0.0
+        self.samples = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._con is None:
+            con = _sqlite(self.path)
+            con.executescript("""
+                CREATE TABLE IF NOT EXISTS nav_raw(account TEXT NOT NULL, ts REAL NOT NULL, netliq REAL,
+                    cash REAL, realized REAL, unrealized REAL, PRIMARY KEY(account, ts)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS nav_1m(account TEXT NOT NULL, ts REAL NOT NULL, netliq REAL, lo REAL,
+                    hi REAL, cash REAL, realized REAL, unrealized REAL, n INTEGER NOT NULL,
+                    PRIMARY KEY(account, ts)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS nav_1h(account TEXT NOT NULL, ts REAL NOT NULL, netliq REAL, lo REAL,
+                    hi REAL, cash REAL, realized REAL, unrealized REAL, n INTEGER NOT NULL,
+                    PRIMARY KEY(account, ts)) WITHOUT ROWID;
+            """)
+            self._con = con
+        return self._con
+
+    def record(self, account: str, ts: float, netliq: float, cash, realized, unrealized) -> bool:
+        vals = (netliq, cash, realized, unrealized)
+        prev = self._last.get(account)
+        if prev and prev[0] == vals and ts - prev[1] < 60:
+            return False
+        con = self._db()
+        con.execute("BEGIN")
+        try:
+            con.execute("INSERT OR REPLACE INTO nav_raw VALUES(?,?,?,?,?,?)", (account, ts) + vals)
+            for name, step in _NAV_TIERS[1:]:
+                con.execute(
+                    f"INSERT INTO nav_{name} VALUES(?,?,?,?,?,?,?,?,1) "
+                    "ON CONFLICT(account, ts) DO UPDATE SET netliq=excluded.netliq, lo=min(lo, excluded.lo), "
+                    "hi=max(hi, excluded.hi), cash=excluded.cash, realized=excluded.realized, "
+                    "unrealized=excluded.unrealized, n=n+1",
+                    (account, ts - ts % step, netliq, netliq, netliq, cash, realized, unrealized))
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        self._last[account] = (vals, ts)
+        self.samples += 1
+        if ts - self._pruned > 3600:
+            self._pruned = ts
+            con.execute("DELETE FROM nav_raw WHERE ts < ?", (ts - NAV_RAW_DAYS * 86400,))
+            con.execute("DELETE FROM nav_1m WHERE ts < ?", (ts - NAV_1M_DAYS * 86400,))
+        return True
+
+    def accounts(self) -> list[str]:
+        return [r[0] for r in self._db().execute("SELECT DISTINCT account FROM nav_1h ORDER BY account")]
+
+    def query(self, account: str, t0: float, t1: float, points: int) -> dict:
+        con = self._db()
+        span = max(1.0, t1 - t0)
+        now = time.time()
+        # coarsest tier still at least as fine as one output point, among tiers whose
+        # retention covers t0 (the hourly tier is kept forever)
+        tier, step = _NAV_TIERS[-1]
+        for name, st in reversed(_NAV_TIERS[:-1]):
+            keep = NAV_RAW_DAYS if name == "raw" else NAV_1M_DAYS
+            if step <= span / points or t0 < now - keep * 86400:
+                break
+            tier, step = name, st
+        if tier == "raw":
+            sql = ("SELECT ts, netliq, cash, realized, unrealized, netliq, netliq FROM nav_raw "
+                   "WHERE account=? AND ts BETWEEN ? AND ? ORDER BY ts")
+        else:
+            sql = (f"SELECT ts, netliq, cash, realized, unrealized, lo, hi FROM nav_{tier} "
+                   "WHERE account=? AND ts BETWEEN ? AND ? ORDER BY ts")
+        rows = con.execute(sql, (account, t0 - step, t1)).fetchall()
+        # bucket to <= points: last value per bucket, min/max NetLiq across it
+        width = span / points
+        out: list[list] = []
+        cur = None
+        for r in rows:
+            b = max(0, int((r[0] - t0) // width))   # rollup bucket straddling t0 joins the first point
+            if cur is not None and b == cur:
+                p = out[-1]
+                lo, hi = p[5], p[6]
+                p[:] = list(r)
+                p[5] = r[5] if lo is None else lo if r[5] is None else min(lo, r[5])
+                p[6] = r[6] if hi is None else hi if r[6] is None else max(hi, r[6])
+            else:
+                out.append(list(r))
+                cur = b
+        return {"account": account, "tier": tier, "start": t0, "end": t1, "columns": list(_NAV_COLS), "points": out}
+
+_NAV = _NavStore(NAV_DB)
+_NAV_TASK: asyncio.Task | None = None
+
+def _nav_sample() -> None:
+    if not (_MIRROR.live and ib.isConnected()):
+        return
+    now = time.time()
+    for acct, tags in list(_MIRROR.summary.items()):
+        netliq = _num_or_none(tags.get("NetLiquidation"))
+        if netliq is None:
+            continue
+        pnl = _PNL.accounts.get(acct)
+        if pnl is None:
+            # no account-level PnL yet: sum this account's own positions, never other accounts'
+            rows = [r for k, r in _PNL.single.items() if k[0] == acct and k in _PNL.held]
+            pnl = {f: sum(r[f] or 0.0 for r in rows) if rows else None for f in ("realized", "unrealized")}
+        realized, unrealized = pnl["realized"], pnl["unrealized"]
+        try:
+            _NAV.record(acct, now, netliq, _num_or_none(tags.get("TotalCashValue")), realized, unrealized)
+        except Exception as e:
+            log.warning("nav sample failed: %s", e)
+
+async def _nav_loop() -> None:
+    while True:
+        try:
+            _nav_sample()
+        except Exception:
+            pass
+        await asyncio.sleep(max(1.0, NAV_SAMPLE_S))
+
+@router.get("/nav/series")
+async def nav_series(account: str | None = None, start: str | None = None, end: str | None = None,
+                     points: int = 500):
+    """
+    Recorded NAV between start and end (epoch seconds or ISO; default: last 24h),
+    downsampled to at most `points` rows of [t, netLiq, cash, realized, unrealized, min, max].
+    """
+    now = time.time()
+    t1 = _parse_when(end, now)
+    t0 = _parse_when(start, t1 - 86400)
+    if t1 <= t0:
+        raise HTTPException(400, "end must be after start")
+    n = max(2, min(5000, int(points)))
+    if not account:
+        accts = sorted(_MIRROR.summary) or await asyncio.to_thread(_NAV.accounts)
+        if not accts:
+            return {"account": None, "columns": list(_NAV_COLS), "points": []}
+        account = accts[0]
+    return await asyncio.to_thread(_NAV.query, account, t0, t1, n)
+
 # --- place / cancel ---------------------------------------------------------
 @router.post("/orders/place")
 async def orders_place(payload: dict = Body(...)):
@@ -2909,7 +7059,7 @@ async def orders_place(payload: dict = Body(...)):
         else:
             order = MarketOrder(side, qty, tif=tif)
 
-        trade = ib.placeOrder(c, order)
+        trade = await _IB_SCHED.run("orders", lambda: ib.placeOrder(c, order), prio=PRIO_ORDER)
         # attach live listener so clients on /orders/stream get push updates
         _attach_trade_listener(trade)
         st = await _await_status(trade)
@@ -2982,7 +7132,7 @@ async def orders_bracket(payload: dict = Body(...)):
         o.ocaGroup = oca
         o.ocaType = 1
     # send
-    ptrade = ib.placeOrder(c, parent)
+    ptrade = await _IB_SCHED.run("orders", lambda: ib.placeOrder(c, parent), prio=PRIO_ORDER)
     # push updates for parent
     _attach_trade_listener(ptrade)
     pst = await _await_status(ptrade)
@@ -2991,8 +7141,8 @@ async def orders_bracket(payload: dict = Body(...)):
         raise HTTPException(502, "Parent orderId missing")
     tp.parentId = pid
     sl.parentId = pid
-    t1 = ib.placeOrder(c, tp)
-    t2 = ib.placeOrder(c, sl)
+    t1 = await _IB_SCHED.run("orders", lambda: ib.placeOrder(c, tp), prio=PRIO_ORDER)
+    t2 = await _IB_SCHED.run("orders", lambda: ib.placeOrder(c, sl), prio=PRIO_ORDER)
     # push updates for children
     _attach_trade_listener(t1)
     _attach_trade_listener(t2)
@@ -3023,7 +7173,7 @@ async def orders_cancel(payload: dict = Body(...)):
     tr = next((t for t in ib.trades() if getattr(t.order, "orderId", None) == int(oid)), None)
     if not tr:
         raise HTTPException(404, f"order {oid} not found")
-    ib.cancelOrder(tr.order)
+    await _IB_SCHED.run("orders", lambda: ib.cancelOrder(tr.order), prio=PRIO_ORDER)
     _log_order("cancel", {"orderId": int(oid)})
     return {"ok": True}
 
@@ -3041,7 +7191,7 @@ async def orders_replace(payload: dict = Body(...)):
     # cancel old
     for t in ib.trades():
         if getattr(t.order, "orderId", None) == int(old):
-            ib.cancelOrder(t.order)
+            await _IB_SCHED.run("orders", lambda: ib.cancelOrder(t.order), prio=PRIO_ORDER)
             break
     # strip and place new
     payload = {k: v for k, v in payload.items() if k != "orderId"}
@@ -3066,7 +7216,7 @@ async def orders_replace(payload: dict = Body(...)):
         order: Order = LimitOrder(side, qty, float(limit), tif=tif)
     else:
         order = MarketOrder(side, qty, tif=tif)
-    trade = ib.placeOrder(c, order)
+    trade = await _IB_SCHED.run("orders", lambda: ib.placeOrder(c, order), prio=PRIO_ORDER)
     # push updates for the replacement order as well
     _attach_trade_listener(trade)
     st = await _await_status(trade)